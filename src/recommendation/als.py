@@ -0,0 +1,160 @@
+#! -*- encoding: utf-8 -*-
+"""
+Alternating least squares for implicit feedback, trained with all the cores of the machine. Each half iteration solves
+the users against the fixed items, or the items against the fixed users, and the rows are split in chunks solved by a
+pool of processes. The factors live in shared memory, so the processes read the fixed side and the parent writes the
+solved side without copies between them.
+"""
+from __future__ import division, absolute_import, print_function
+import ctypes
+import multiprocessing
+import numpy as np
+from django.conf import settings
+from recommendation.models import TensorCoFi, fold_in, FOLD_IN_ALPHA, FOLD_IN_REGULARIZATION
+
+__author__ = "joaonrb"
+
+ALS_FACTORS = getattr(settings, "ALS_FACTORS", 20)
+ALS_ITERATIONS = getattr(settings, "ALS_ITERATIONS", 5)
+ALS_PROCESSES = getattr(settings, "ALS_PROCESSES", None)
+ALS_CHUNK = 4096  # Rows solved in each task of the pool
+
+_training = {}  # State of the training inherited by the processes of the pool
+
+
+def shared_array(shape):
+    """
+    Create a float32 array in shared memory. The processes forked after its creation see the writes of the parent.
+    :param shape: The shape of the array
+    :return: A numpy array
+    """
+    return np.frombuffer(multiprocessing.RawArray(ctypes.c_float, int(np.prod(shape))), dtype=np.float32)\
+        .reshape(shape)
+
+
+def compressed_rows(rows, columns, n_rows):
+    """
+    Get the columns of each row in compressed sparse row format
+
+    >>> indptr, indices = compressed_rows(np.array([1, 0, 1]), np.array([5, 6, 7]), 3)
+    >>> print(indptr.tolist(), indices.tolist())
+    [0, 1, 3, 3] [6, 5, 7]
+
+    :param rows: The row of each entry
+    :param columns: The column of each entry
+    :param n_rows: The number of rows
+    :return: A tuple with the row pointers and the column indexes
+    """
+    order = np.argsort(rows, kind="mergesort")
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n_rows))])
+    return indptr, columns[order]
+
+
+def solve_chunk(args):
+    """
+    Solve a chunk of rows of one side against the other side
+
+    :param args: A tuple with the side to solve, the first and the last row and the gram matrix of the other side
+    :return: A tuple with the first row and the solved factors
+    """
+    side, start, end, gram = args
+    fixed = _training["items" if side == "users" else "users"]
+    indptr, indices = _training["%s_rows" % side]
+    rows = [indices[indptr[i]:indptr[i+1]] for i in range(start, end)]
+    return start, fold_in(fixed, rows, _training["alpha"], _training["regularization"], gram)
+
+
+class ALS(object):
+    """
+    Implicit alternating least squares factorization of the user item matrix
+
+    >>> data = np.array([[0, 0, 1], [0, 1, 1], [1, 1, 1], [1, 2, 1], [2, 0, 1], [2, 2, 1]])
+    >>> users, items = ALS(3, 3, factors=2, iterations=3, processes=1).fit(data)
+    >>> print(users.shape, items.shape)
+    (3, 2) (3, 2)
+    """
+
+    def __init__(self, n_users, n_items, factors=ALS_FACTORS, iterations=ALS_ITERATIONS, alpha=FOLD_IN_ALPHA,
+                 regularization=FOLD_IN_REGULARIZATION, processes=ALS_PROCESSES, seed=0):
+        """
+        :param n_users: The number of users
+        :param n_items: The number of items
+        :param factors: The number of factors
+        :param iterations: The number of iterations
+        :param alpha: The confidence of the observed items
+        :param regularization: The regularization of the factors
+        :param processes: The number of processes. Default is the number of cpus.
+        :param seed: The seed of the initial factors
+        """
+        self.n_users, self.n_items = n_users, n_items
+        self.factors, self.iterations = factors, iterations
+        self.alpha, self.regularization = alpha, regularization
+        self.processes = processes or multiprocessing.cpu_count()
+        self.seed = seed
+
+    def solve(self, side, pool):
+        """
+        Solve all the rows of one side
+        :param side: users or items
+        :param pool: The pool of processes or None to solve in this process
+        """
+        fixed = _training["items" if side == "users" else "users"]
+        gram = np.dot(fixed.transpose(), fixed).astype(np.float64)
+        tasks = [(side, start, min(start+ALS_CHUNK, len(_training[side])), gram)
+                 for start in range(0, len(_training[side]), ALS_CHUNK)]
+        for start, factors in (pool.imap_unordered if pool else map)(solve_chunk, tasks):
+            _training[side][start:start+len(factors)] = factors
+
+    def fit(self, data):
+        """
+        Train the factors
+
+        :param data: A matrix with a row (user index, item index, ...) for each owned item
+        :return: A tuple with the user factors and the item factors
+        """
+        users, items = np.asarray(data[:, 0], dtype=np.int64), np.asarray(data[:, 1], dtype=np.int64)
+        _training.clear()
+        _training.update(alpha=self.alpha, regularization=self.regularization,
+                         users_rows=compressed_rows(users, items, self.n_users),
+                         items_rows=compressed_rows(items, users, self.n_items),
+                         users=shared_array((self.n_users, self.factors)),
+                         items=shared_array((self.n_items, self.factors)))
+        random = np.random.RandomState(self.seed)
+        _training["users"][:] = random.normal(scale=.01, size=(self.n_users, self.factors))
+        _training["items"][:] = random.normal(scale=.01, size=(self.n_items, self.factors))
+        pool = multiprocessing.Pool(self.processes) if self.processes > 1 else None
+        try:
+            for _ in range(self.iterations):
+                self.solve("users", pool)
+                self.solve("items", pool)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        result = np.array(_training["users"]), np.array(_training["items"])
+        _training.clear()
+        return result
+
+
+class ALSTensorCoFi(TensorCoFi):
+    """
+    TensorCoFi model trained with the multi-core ALS instead of test.fm. The factors are published the same way.
+    """
+
+    def __init__(self, n_users=None, n_items=None, n_factors=ALS_FACTORS, n_iterations=ALS_ITERATIONS,
+                 c_lambda=FOLD_IN_REGULARIZATION, c_alpha=FOLD_IN_ALPHA, **kwargs):
+        """
+        The parameters are the ones of TensorCoFi. By default the factors and the iterations are ALS_FACTORS and
+        ALS_ITERATIONS and the alpha and lambda are the ones of the fold in.
+        """
+        super(ALSTensorCoFi, self).__init__(n_users=n_users, n_items=n_items, n_factors=n_factors,
+                                            n_iterations=n_iterations, c_lambda=c_lambda, c_alpha=c_alpha, **kwargs)
+
+    def train(self, data):
+        """
+        Trains the model in to data base
+        """
+        users, items = ALS(self.n_users, self.n_items, factors=self.number_of_factors,
+                           iterations=self.number_of_iterations, alpha=self.constant_alpha,
+                           regularization=self.constant_lambda).fit(data)
+        return TensorCoFi.publish_factors(users, items)
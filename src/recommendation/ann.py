@@ -0,0 +1,136 @@
+#! -*- encoding: utf-8 -*-
+"""
+Approximate nearest neighbour retrieval over the TensorCoFi item factors. Instead of scoring every item in the catalog,
+the items are grouped in clusters of similar factors and only the items in the clusters closer to the user are scored.
+"""
+from __future__ import division, absolute_import, print_function
+import numpy as np
+from django.conf import settings
+from recommendation.models import TensorCoFi, Generation
+
+__author__ = "joaonrb"
+
+ANN_INDEX = getattr(settings, "ANN_INDEX", False)
+ANN_CLUSTERS = getattr(settings, "ANN_CLUSTERS", None)
+ANN_PROBES = getattr(settings, "ANN_PROBES", 8)
+ANN_ITERATIONS = 10
+ANN_CHUNK = 4096  # Items assigned to clusters in each matrix product
+
+
+class IVFIndex(object):
+    """
+    Inverted file index for maximum inner product search. The items are clustered with spherical k-means over the
+    direction of their factors and the factors of each cluster are stored together. A query scores the clusters, takes
+    the best ones and scores exactly the items in them. The clustering is seeded, so every process builds the same
+    index for the same factors.
+
+    >>> factors = np.array([[1., 0.], [.9, .1], [0., 1.], [.1, .9]], dtype=np.float32)
+    >>> index = IVFIndex(factors, n_clusters=2)
+    >>> items, scores = index.search(np.array([1., 0.], dtype=np.float32), probes=1)
+    >>> print(sorted(items.tolist()))
+    [0, 1]
+    """
+
+    indexes = {}  # Indexes of this process by item matrix id
+
+    def __init__(self, factors, n_clusters=None, iterations=ANN_ITERATIONS, seed=0):
+        """
+        Build the index
+
+        :param factors: The item factors matrix
+        :param n_clusters: The number of clusters. Default is the square root of the number of items.
+        :param iterations: Number of k-means iterations
+        :param seed: The seed of the initial centroids
+        """
+        factors = np.asarray(factors, dtype=np.float32)
+        self.n_items = factors.shape[0]
+        n_clusters = min(n_clusters or max(1, int(np.sqrt(self.n_items))), self.n_items)
+        norms = np.sqrt(np.sum(factors * factors, axis=1))
+        directions = factors / np.maximum(norms, np.finfo(np.float32).tiny)[:, np.newaxis]
+        centroids = directions[np.random.RandomState(seed).choice(self.n_items, n_clusters, replace=False)]
+        for _ in range(iterations):
+            assignment = self.assign(directions, centroids)
+            sums = np.array([np.bincount(assignment, weights=directions[:, d], minlength=n_clusters)
+                             for d in range(factors.shape[1])], dtype=np.float32).transpose()
+            sum_norms = np.sqrt(np.sum(sums * sums, axis=1))
+            filled = sum_norms > 0  # Empty clusters keep the old centroid
+            centroids[filled] = sums[filled] / sum_norms[filled, np.newaxis]
+        assignment = self.assign(directions, centroids)
+        self.order = np.argsort(assignment, kind="mergesort").astype(np.int32)
+        self.offsets = np.searchsorted(assignment[self.order], np.arange(n_clusters+1))
+        self.factors = factors[self.order]
+        self.centroids = centroids
+        # The best score in a cluster is at most the score of its direction times the biggest norm in it
+        self.max_norms = np.zeros(n_clusters, dtype=np.float32)
+        np.maximum.at(self.max_norms, assignment, norms)
+
+    @staticmethod
+    def assign(directions, centroids):
+        """
+        Get the closest centroid of each item
+        :param directions: The normalized item factors
+        :param centroids: The normalized centroids
+        :return: The cluster of each item
+        """
+        return np.concatenate([np.argmax(np.dot(directions[i:i+ANN_CHUNK], centroids.transpose()), axis=1)
+                               for i in range(0, directions.shape[0], ANN_CHUNK)])
+
+    @property
+    def n_clusters(self):
+        return self.centroids.shape[0]
+
+    def search(self, user_factors, probes=ANN_PROBES, size=0):
+        """
+        Get the items in the best clusters for the user with their exact scores. More clusters than the probes are
+        taken when they don't have enough items.
+
+        :param user_factors: The user factors
+        :param probes: The number of clusters to score
+        :param size: The minimum number of items to get
+        :return: A tuple with the indexes of the items (item id - 1) and their scores
+        """
+        best = np.argsort(-np.dot(self.centroids, user_factors) * self.max_norms)
+        counts = np.cumsum(self.offsets[best+1] - self.offsets[best])
+        best = best[:max(probes, np.searchsorted(counts, size)+1)]
+        index = np.concatenate([np.arange(self.offsets[c], self.offsets[c+1]) for c in best])
+        return self.order[index], np.dot(self.factors[index], user_factors)
+
+    def get_recommendation(self, user_factors, probes=ANN_PROBES, size=0):
+        """
+        Get the candidate items for the user and a scores array in which the items out of the best clusters get minus
+        infinity. The filters run over the array and the top is taken only from the candidates.
+
+        :param user_factors: The user factors
+        :param probes: The number of clusters to score
+        :param size: The minimum number of candidates
+        :return: A tuple with the indexes of the candidates and an array with the scores of every item
+        """
+        items, scores = self.search(user_factors, probes, size)
+        result = np.empty((self.n_items,), dtype=np.float32)
+        result.fill(-np.inf)
+        result[items] = scores
+        return items, result
+
+    @staticmethod
+    def get_index(matrix_id):
+        """
+        Get the index of the item factors. It is built once in each process, the first time the process sees the item
+        factors of a generation. The indexes of older factors are dropped.
+
+        :param matrix_id: The item factors matrix id
+        :return: The index
+        """
+        try:
+            return IVFIndex.indexes[matrix_id]
+        except KeyError:
+            index = IVFIndex(TensorCoFi.get_item_matrix(matrix_id), n_clusters=ANN_CLUSTERS)
+            IVFIndex.indexes.clear()
+            IVFIndex.indexes[matrix_id] = index
+            return index
+
+    @staticmethod
+    def load_to_cache():
+        """
+        Build the index of the current item factors in this process
+        """
+        IVFIndex.get_index(Generation.get_current().items_id)
@@ -28,5 +28,8 @@ urlpatterns = patterns("",
         name="user_items_file_api"),
     url(r"^users/(?P<data_format>\w+)/$", views.UsersAPI().as_view(), name="user_api"),
     url(r"^users/$", views.UsersAPI().as_view(), name="user_no_format_api"),
-    url(r"^users.(?P<data_format>\w+)$", views.UsersAPI().as_view(), name="user_file_api")
+    url(r"^users.(?P<data_format>\w+)$", views.UsersAPI().as_view(), name="user_file_api"),
+    url(r"^metrics/(?P<data_format>\w+)/$", views.MetricsAPI().as_view(), name="metrics_api"),
+    url(r"^metrics/$", views.MetricsAPI().as_view(), name="metrics_no_format_api"),
+    url(r"^metrics.(?P<data_format>\w+)$", views.MetricsAPI().as_view(), name="metrics_file_api")
 )
\ No newline at end of file
@@ -12,8 +12,10 @@ from django.utils.translation import ugettext as _
 from rest_framework.renderers import JSONRenderer, XMLRenderer
 from rest_framework.parsers import JSONParser, XMLParser
 from rest_framework.views import APIView
-from recommendation.models import User, Inventory, Item, TensorCoFi
+from recommendation.models import User, Inventory, Item, TensorCoFi, InventoryChange, Candidates, Popularity, \
+    ResponseCache
 from recommendation.core import get_controller
+from recommendation import metrics
 # from recommendation.decorators import ExecuteInBackground
 from recommendation.core import log_event
 # from django.db import connection
@@ -159,6 +161,26 @@ class UserRecommendationAPI(RecommendationAPI):
         return self.format_response(data)
 
 
+class MetricsAPI(RecommendationAPI):
+    """
+    Latency of each stage of the recommendation, joined from all the workers
+    """
+
+    http_method_names = [
+        "get"
+    ]
+
+    def get(self, request):
+        """
+        Get method to request the latency metrics
+
+        :param request: The HTTP request.
+        :return: A HTTP response with the number of workers and the count, mean, percentiles and max latency of each
+            stage in milliseconds.
+        """
+        return self.format_response(metrics.report())
+
+
 class UsersAPI(RecommendationAPI):
     """
     Class for API view of the users
@@ -249,10 +271,14 @@ class UserItemsAPI(RecommendationAPI):
         """
         Inventory.objects.filter(user=user).delete()
         Inventory.objects.bulk_create(Inventory(item=item, user=user) for item in items)
+        Popularity.counter.add([item.pk for item in items])  # bulk_create sends no post_save
         User.get_user_items.lock_this(
             User.get_user_items.cache.delete
         )(User.get_user_items.key(user.pk))
         del TensorCoFi.user_matrix[user.pk-1]
+        InventoryChange.register(user.pk)
+        Candidates.remove(user.pk)
+        ResponseCache.drop(user.pk)
 
     @staticmethod
     #@ExecuteInBackground()
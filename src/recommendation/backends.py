@@ -10,11 +10,16 @@ from health_check.plugins import BaseHealthCheckBackend
 from health_check.backends.base import ServiceUnavailable
 from django.core.cache import get_cache
 from django.core.cache.backends.base import InvalidCacheBackendError
+from django.conf import settings
 from django.db import OperationalError
 from recommendation.models import Item
+from recommendation.metrics import cache_report, METRICS
 
 __author__ = "joaonrb"
 
+CACHE_MIN_HIT_RATIO = getattr(settings, "CACHE_MIN_HIT_RATIO", .5)
+CACHE_MIN_CALLS = getattr(settings, "CACHE_MIN_CALLS", 1000)  # Calls of a function before its hit ratio is checked
+
 
 class CheckDefaultCacheBackend(BaseHealthCheckBackend):
 
@@ -50,4 +55,21 @@ class CheckDatabaseCacheBackend(BaseHealthCheckBackend):
             if items != None:
                 return True
         except OperationalError:
-            raise ServiceUnavailable("Database unavailable")
\ No newline at end of file
+            raise ServiceUnavailable("Database unavailable")
+
+
+class CheckCacheHitRatio(BaseHealthCheckBackend):
+    """
+    Fails when a cached function with more than CACHE_MIN_CALLS calls in all the workers hits the cache less than
+    CACHE_MIN_HIT_RATIO. Without METRICS there is nothing to check.
+    """
+
+    def check_status(self):
+        if not METRICS:
+            return True
+        cold = ["%s (%.2f)" % (name, function["hit_ratio"]) for name, function in sorted(cache_report().items())
+                if function["hits"] + function["misses"] > CACHE_MIN_CALLS and
+                function["hit_ratio"] < CACHE_MIN_HIT_RATIO]
+        if cold:
+            raise ServiceUnavailable("Cache hit ratio under %s in %s" % (CACHE_MIN_HIT_RATIO, ", ".join(cold)))
+        return True
@@ -0,0 +1,179 @@
+#! -*- encoding: utf-8 -*-
+"""
+Cache backend in the memory of the process that keeps the read mostly data of the models without serializing it. The
+numpy arrays, the tuples of them and the immutable values are kept by reference, so a read gives the same object
+without any copy. The arrays in cache are read only, so writing on them raises instead of changing the cache. A
+writable array is copied when it is put in cache and a read only array is kept as it is. Any other value is pickled
+as in the LocMemCache, so changing it after a read doesn't change the cache.
+
+The memory is accounted in bytes and the least recently used values are dropped when the cache is over MAX_BYTES or
+MAX_ENTRIES::
+
+    CACHES = {
+        "default": {
+            "BACKEND": "recommendation.cache.ObjectCache",
+            "LOCATION": "frappe",
+            "OPTIONS": {"MAX_ENTRIES": 10000000, "MAX_BYTES": 2 * 1024 ** 3}
+        }
+    }
+"""
+from __future__ import division, absolute_import, print_function
+import sys
+import time
+import threading
+import numpy as np
+from collections import OrderedDict
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+from django.utils.six import string_types, integer_types
+from django.utils.six.moves import cPickle as pickle
+
+__author__ = "joaonrb"
+
+IMMUTABLE_TYPES = string_types + integer_types + (bytes, float, bool, type(None), np.generic)
+
+_stores = {}  # Stores of this process by location, so every instance of the same location shares them
+
+
+class Store(object):
+    """
+    The values of a location from the least recently used, with the total of bytes
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()  # Tuples (value, pickled, expire time, bytes) by key
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+
+def freeze(value):
+    """
+    Prepare a value to be kept by reference. A writable array is copied, so the caller keeps its array as it is and
+    can't change the cache through it. The read only arrays that own their data and the memory maps are kept without
+    copy.
+
+    >>> array = np.arange(4)
+    >>> frozen, size = freeze((array, 1))
+    >>> print(frozen[0] is array, array.flags.writeable, frozen[0].flags.writeable, size > array.nbytes)
+    False True False True
+    >>> print(freeze(frozen[0])[0] is frozen[0])
+    True
+    >>> print(freeze([1, 2]))
+    None
+
+    :param value: The value to put in cache
+    :return: A tuple with the value to keep and its size in bytes, or None if the value must be pickled
+    """
+    if isinstance(value, IMMUTABLE_TYPES):
+        return value, sys.getsizeof(value)
+    if isinstance(value, np.ndarray) and value.dtype != np.object_:
+        if isinstance(value, np.memmap):
+            if value.flags.writeable:
+                value = value.view()  # Read only view of the same map
+                value.setflags(write=False)
+        elif value.flags.writeable or not value.flags.owndata:
+            value = np.array(value)  # A view would keep the whole base alive
+            value.setflags(write=False)
+        return value, sys.getsizeof(value)  # With the data of the arrays that own it
+    if type(value) is tuple:
+        frozen = [freeze(v) for v in value]
+        if all(f is not None for f in frozen):
+            return tuple(f[0] for f in frozen), sum(f[1] for f in frozen) + sys.getsizeof(value)
+    return None
+
+
+class ObjectCache(BaseCache):
+    """
+    Cache in this process that keeps arrays and immutable values without copies
+    """
+
+    def __init__(self, name, params):
+        super(ObjectCache, self).__init__(params)
+        options = params.get("OPTIONS", {})
+        self._max_bytes = int(params.get("max_bytes", options.get("MAX_BYTES", 1024 ** 3)))
+        self._store = _stores.setdefault(name, Store())
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        entry = self._entry(value, timeout)
+        with self._store.lock:
+            if not self._has_expired(key):
+                return False
+            self._set(key, entry)
+            return True
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._store.lock:
+            if self._has_expired(key):
+                self._delete(key)
+                return default
+            value, pickled, expires, size = entry = self._store.entries.pop(key)
+            self._store.entries[key] = entry
+        return pickle.loads(value) if pickled else value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        entry = self._entry(value, timeout)
+        with self._store.lock:
+            self._set(key, entry)
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._store.lock:
+            if self._has_expired(key):
+                self._delete(key)
+                return False
+            return True
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._store.lock:
+            self._delete(key)
+
+    def clear(self):
+        with self._store.lock:
+            self._store.entries.clear()
+            self._store.bytes = 0
+
+    def _entry(self, value, timeout):
+        """
+        Build the entry of a value. The frozen values are kept as they are and the others are pickled.
+        """
+        frozen = freeze(value)
+        if frozen is None:
+            value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            return value, True, self.get_backend_timeout(timeout), len(value)
+        return frozen[0], False, self.get_backend_timeout(timeout), frozen[1]
+
+    def _set(self, key, entry):
+        self._delete(key)
+        self._store.entries[key] = entry
+        self._store.bytes += entry[3]
+        while self._store.entries and (self._store.bytes > self._max_bytes or
+                                       len(self._store.entries) > self._max_entries):
+            self._store.bytes -= self._store.entries.popitem(last=False)[1][3]
+
+    def _has_expired(self, key):
+        try:
+            expires = self._store.entries[key][2]
+        except KeyError:
+            return True
+        return expires is not None and expires <= time.time()
+
+    def _delete(self, key):
+        try:
+            self._store.bytes -= self._store.entries.pop(key)[3]
+        except KeyError:
+            pass
+
+    def size(self):
+        """
+        Get the number of values and the bytes in cache
+        """
+        with self._store.lock:
+            return len(self._store.entries), self._store.bytes
@@ -4,10 +4,17 @@ The core module for the recommendation system. Here is defined the flow for a re
 """
 from __future__ import division, absolute_import, print_function
 import logging
+import random
 import numpy as np
 import traceback
 from django.conf import settings
-from recommendation.models import Item, User, TensorCoFi, Popularity
+from django.core.exceptions import ObjectDoesNotExist
+from recommendation.models import Item, User, TensorCoFi, Popularity, Generation, Candidates, NotCached, UserMatrix, \
+    ResponseCache, RESPONSE_CACHE_TIMEOUT
+from recommendation.ann import IVFIndex, ANN_INDEX
+from recommendation.filters import apply_filters, apply_filters_batch
+from recommendation.metrics import timed_plugin, time_methods
+from recommendation.decorators import ContingencyProtocol, check_deadline, SAMPLE
 from recommendation.util import initialize
 
 try:
@@ -27,6 +34,21 @@ __author__ = "joaonrb"
 log_event = logger
 
 MAX_SORT = 1000
+BATCH_SIZE = 256  # Users scored in each matrix product of the batch recommendation
+CONTINGENCY_ITEMS = getattr(settings, "CONTINGENCY_ITEMS", SAMPLE)
+CONTINGENCY_SIZE = getattr(settings, "CONTINGENCY_SIZE", 100)  # Size of the precomputed contingency recommendations
+STAGES = (  # Methods of the controller timed when METRICS is on
+    ("get_external_id_recommendations", "request"),
+    ("get_recommendation", "recommendation"),
+    ("compute_recommendation", "computed"),
+    ("get_precomputed_recommendation", "precomputed"),
+    ("get_approximate_recommendation", "approximate"),
+    ("get_recommendation_from_model", "model"),
+    ("get_alternative_recommendation", "alternative"),
+    ("filter_recommendation", "filters"),
+    ("sort_recommendation", "sort"),
+    ("get_external_ids", "external_ids"),
+)
 
 
 class IController(object):
@@ -43,10 +65,14 @@ class IController(object):
         """
         self._filters = []
         self._re_rankers = []
+        self._contingency = {}
+        self.name = type(self).__name__  # Engine name in the response cache
+        time_methods(self, STAGES)
 
     def register_filter(self, *filters):
         """
-        Register a filter in this controller queue
+        Register a filter in this controller queue. Filters that extend recommendation.filters.ExclusionFilter give the
+        items to exclude and their exclusions are written together. Any other callable gets the scores and returns them.
 
         >>> class Filter:
         ...     pass
@@ -59,7 +85,7 @@ class IController(object):
         """
         for f in filters:
             f.controller = self
-            self._filters.append(f)
+            self._filters.append(timed_plugin("filter", f))
 
     @property
     def filters(self):
@@ -72,6 +98,28 @@ class IController(object):
         """
         return self._filters[:]
 
+    @property
+    def static_filters(self):
+        """
+        The filters that depend only on the user and the catalog, not on the request. They run when the candidates are
+        precomputed. A filter is static when it has the attribute static set to True.
+
+        >>> class Filter:
+        ...     static = True
+        >>> controller = IController()
+        >>> controller.register_filter(Filter())
+        >>> print(controller.static_filters == controller.filters, controller.online_filters)
+        True []
+        """
+        return [f for f in self._filters if getattr(f, "static", False)]
+
+    @property
+    def online_filters(self):
+        """
+        The filters that must run on each request even if the user has precomputed candidates
+        """
+        return [f for f in self._filters if not getattr(f, "static", False)]
+
     def register_reranker(self, *rerankers):
         """
         Register a reranker for this controller.
@@ -87,7 +135,7 @@ class IController(object):
         """
         for r in rerankers:
             r.controller = self
-            self._re_rankers.append(r)
+            self._re_rankers.append(timed_plugin("reranker", r))
 
     @property
     def rerankers(self):
@@ -158,10 +206,102 @@ class IController(object):
             TensorCoFi.user_matrix[user.pk-1] = u_factors  # store new documentation in Cache
             return np.squeeze(np.asarray(np.dot(u_factors, model.factors[1].transpose())))
 
+    def get_recommendations_from_model(self, users):
+        """
+        Get the significance values of each item for many users. The model scores in one go the users it has factors
+        for. The others go one by one through get_recommendation_from_model or the alternative recommendation.
+
+        :param users: A list of users
+        :return: A matrix with a row of app scores for each user
+        """
+        result, has_factors = self.get_model().get_recommendations(users)
+        for i in np.flatnonzero(~has_factors):
+            try:
+                scores = self.get_recommendation_from_model(user=users[i])
+            except NotEnoughItemsToCompute:
+                logging.debug(traceback.format_exc())
+                scores = self.get_alternative_recommendation(users[i])
+            size = min(len(scores), result.shape[1])
+            result[i, :size] = scores[:size]
+        return result
+
+    def get_recommendations(self, users, n=10):
+        """
+        Get the recommendation for many users at once. Scores are computed with a matrix product for each batch of
+        BATCH_SIZE users, the filters exclude the items of the whole batch with one mask and the top of each user is
+        selected with a single argpartition over the batch. The re-rankers still run for each user. This is meant
+        for offline jobs, so the recommendations are not logged.
+
+        :param users: A list of users
+        :param n: The number of recommendations to give to each user.
+        :return: A list with the recommendation (list of item ids) of each user in the same order of the users
+        """
+        recommendations = []
+        for start in range(0, len(users), BATCH_SIZE):
+            batch = users[start:start+BATCH_SIZE]
+            result = self.get_recommendations_from_model(batch)
+            result = apply_filters_batch(batch, result, self.filters, size=n)
+            for user, user_top in zip(batch, top_items(result, MAX_SORT) + 1):
+                recommendation = list(user_top)
+                for r in self.rerankers:
+                    recommendation = r(user, recommendation, size=n)
+                recommendations.append(recommendation[:n])
+        return recommendations
+
+    def get_candidates(self, users, size):
+        """
+        Get the top items of many users with their scores, after the static filters. This is what is stored by the
+        precompute command.
+
+        :param users: A list of users
+        :param size: The number of candidates of each user
+        :return: A tuple with a matrix of item ids and a matrix with their scores, with a row for each user
+        """
+        items, scores = [], []
+        static_filters = self.static_filters
+        for start in range(0, len(users), BATCH_SIZE):
+            batch = users[start:start+BATCH_SIZE]
+            result = self.get_recommendations_from_model(batch)
+            result = apply_filters_batch(batch, result, static_filters, size=size)
+            top = top_items(result, size)
+            items.append(top + 1)
+            scores.append(result[np.arange(len(batch))[:, np.newaxis], top])
+        return np.concatenate(items), np.concatenate(scores)
+
+    def get_precomputed_recommendation(self, user):
+        """
+        Get the precomputed candidates of the user and their scores. Only the online filters run over them.
+
+        >>> print(IController().get_precomputed_recommendation(object()))
+        None
+
+        :param user: The user to get the recommendation
+        :return: A tuple with the indexes of the candidates (item id - 1) and an array with the app scores for that
+            user, or None when the user doesn't have precomputed candidates
+        """
+        return None
+
+    def get_approximate_recommendation(self, user, n=10):
+        """
+        Get a set of candidates for the user from an approximate retrieval and their scores. All the filters run over
+        them and the top is taken only from the candidates.
+
+        >>> print(IController().get_approximate_recommendation(object()))
+        None
+
+        :param user: The user to get the recommendation
+        :param n: The number of recommendations to give in response
+        :return: A tuple with the indexes of the candidates (item id - 1) and an array with the app scores for that
+            user, or None when there is no approximate retrieval for the user
+        """
+        return None
+
     @log_event(log_event.RECOMMEND)
     def get_recommendation(self, user, n=10):
         """
-        Method to get recommendation according with some user id
+        Method to get recommendation according with some user id. With RESPONSE_CACHE_TIMEOUT on, the recommendation
+        is reused for that many seconds or until the user inventory changes, the user has new logs or new factors
+        are published. The recommendations from the cache are logged as the computed ones.
 
         >>> class TestController(IController):
         ...     pass
@@ -175,21 +315,76 @@ class IController(object):
         :return: A Python list the recommendation apps ids.
         :rtype: list
         """
+        if not RESPONSE_CACHE_TIMEOUT:
+            return self.compute_recommendation(user, n)
         try:
-            result = self.get_recommendation_from_model(user=user)
-        except NotEnoughItemsToCompute:
-            logging.debug(traceback.format_exc())
-            result = self.get_alternative_recommendation(user)
-        for f in self.filters:
-            result = f(user, result, size=n)
-        max_sort = len(result) if len(result) < MAX_SORT else MAX_SORT
-        top = np.argpartition(-result, max_sort-1)[:max_sort]
-        result = list(top[np.argsort(result[top])[::-1]] + 1)
+            factor_ids = Generation.get_current().factor_ids
+        except NotCached:
+            factor_ids = None
+        result = ResponseCache.get(self.name, user.pk, n, factor_ids)
+        if result is None:
+            result = self.compute_recommendation(user, n)
+            ResponseCache.put(result, self.name, user.pk, n, factor_ids)
+        return result
+
+    def compute_recommendation(self, user, n=10):
+        """
+        Run the recommendation of the user
+
+        :param user: The user to get the recommendation
+        :param n: The number of recommendations to give in response
+        :return: A list with the item ids
+        """
+        precomputed, filters = self.get_precomputed_recommendation(user), self.online_filters
+        if precomputed is None:
+            precomputed, filters = self.get_approximate_recommendation(user, n), self.filters
+        if precomputed is None:
+            try:
+                result = self.get_recommendation_from_model(user=user)
+            except NotEnoughItemsToCompute:
+                logging.debug(traceback.format_exc())
+                result = self.get_alternative_recommendation(user)
+            candidates = None
+        else:
+            candidates, result = precomputed
+        check_deadline()
+        result = self.filter_recommendation(user, result, filters, n)
+        check_deadline()
+        result = self.sort_recommendation(result, candidates)
         for r in self.rerankers:
+            check_deadline()
             result = r(user, result, size=n)
         return result[:n]
 
-    # @ContingencyProtocol()
+    def filter_recommendation(self, user, result, filters, n):
+        """
+        Run the filters over the scores of the user
+
+        :param user: The user to get the recommendation
+        :param result: The scores array
+        :param filters: The filters to run
+        :param n: The number of recommendations to give in response
+        :return: The filtered scores
+        """
+        return apply_filters(user, result, filters, size=n)
+
+    @staticmethod
+    def sort_recommendation(result, candidates=None):
+        """
+        Get the items with the best scores sorted from the best, up to MAX_SORT items
+
+        >>> print(IController.sort_recommendation(np.array([.1, .5, .3])))
+        [2, 3, 1]
+
+        :param result: The scores array
+        :param candidates: The indexes of the candidates or None when every item is a candidate
+        :return: A list with the item ids
+        """
+        if candidates is None:
+            return list(top_items(result[np.newaxis], MAX_SORT)[0] + 1)
+        return list(candidates[top_items(result[candidates][np.newaxis], MAX_SORT)[0]] + 1)
+
+    @ContingencyProtocol()
     def get_external_id_recommendations(self, user, n=10):
         """
         Returns the recommendations with a list of external_is's
@@ -204,7 +399,37 @@ class IController(object):
             logging.info("User %s not exist. Is going to be created")
             user = User.objects.create(external_id=user)
         result = self.get_recommendation(user=user, n=n)
-        return [Item.get_item_external_id_by_id(r) for r in result]
+        return self.get_external_ids(result)
+
+    @staticmethod
+    def get_external_ids(recommendation):
+        """
+        Map the item ids of a recommendation to their external ids, with one read of the cache
+
+        :param recommendation: A list of item ids
+        :return: A list of item external ids
+        """
+        return Item.get_item_external_id_by_id.get_many(list(recommendation))
+
+    def load_contingency(self):
+        """
+        Precompute the contingency recommendations. It runs out of the latency budget of the requests.
+        """
+        pass
+
+    def get_contingency_recommendation(self, user, n=10):
+        """
+        Recommendation given when the normal one is over the latency budget or fails. It must be cheap and should not
+        touch the database.
+
+        >>> print(len(IController().get_contingency_recommendation("someone", 5)))
+        5
+
+        :param user: The user external_id
+        :param n: The number of recommendations to give in response
+        :return: Item external id list
+        """
+        return random.sample(CONTINGENCY_ITEMS, min(n, len(CONTINGENCY_ITEMS)))
 
 
 class TensorCoFiController(IController):
@@ -227,6 +452,118 @@ class TensorCoFiController(IController):
         """
         return Popularity.get_model().recommendation
 
+    def get_precomputed_recommendation(self, user):
+        """
+        Get the precomputed candidates of the user. In the scores array the items that are not candidates get minus
+        infinity. The candidates are ignored when they were computed with other item factors than the current ones.
+
+        :param user: The user to get the recommendation
+        :return: A tuple with the indexes of the candidates and an array with the app scores for that user, or None
+            when the user doesn't have valid candidates
+        """
+        try:
+            generation = Generation.get_current()
+        except NotCached:
+            return None
+        if generation.items_id is None:
+            return None
+        item_matrix_id, items, scores = Candidates.get_user_candidates(generation.items_id, user.pk)
+        if item_matrix_id is None or item_matrix_id != generation.items_id or len(items) == 0:
+            return None
+        result = np.empty((items.max(),), dtype=np.float32)
+        result.fill(-np.inf)
+        result[items-1] = scores
+        return items-1, result
+
+    def get_approximate_recommendation(self, user, n=10):
+        """
+        Get the candidates from the approximate nearest neighbour index over the item factors when ANN_INDEX is on.
+        Users without factors in the current generation, or with no generation published, get None and are scored the
+        usual way.
+
+        :param user: The user to get the recommendation
+        :param n: The number of recommendations to give in response
+        :return: A tuple with the indexes of the candidates and an array with the app scores for that user, or None
+        """
+        if not ANN_INDEX:
+            return None
+        try:
+            generation = Generation.get_current()
+            user_factors = UserMatrix.get_user_factors(generation, user.pk-1)
+        except (NotCached, ObjectDoesNotExist, KeyError, IndexError):
+            return None
+        return IVFIndex.get_index(generation.items_id).get_recommendation(user_factors, size=n)
+
+    def load_contingency(self):
+        """
+        Precompute the most popular items, in total and in each region, as external ids. Without a popularity model,
+        as in a new database, nothing is precomputed and the contingency items are given.
+        """
+        try:
+            scores = np.array(Popularity.get_model().recommendation, dtype=np.float32)
+        except NotCached:
+            logging.warning("There is no popularity model for the contingency recommendations")
+            self._contingency = {}
+            return
+        contingency = {None: self.get_external_ids(top_items(scores[np.newaxis], CONTINGENCY_SIZE)[0] + 1)}
+        if "recommendation.language" in settings.INSTALLED_APPS:
+            from recommendation.language.models import Region
+            for region_id in Region.objects.values_list("pk", flat=True):
+                out = np.unpackbits(Region.get_items_out_of_region(region_id)).view(np.bool_)[:len(scores)]
+                region_scores = scores.copy()
+                region_scores[np.flatnonzero(out)] = -np.inf
+                top = top_items(region_scores[np.newaxis], CONTINGENCY_SIZE)[0]
+                contingency[region_id] = self.get_external_ids(top[np.isfinite(region_scores[top])] + 1)
+        self._contingency = contingency
+
+    def get_contingency_recommendation(self, user, n=10):
+        """
+        Give the precomputed popular items of the user regions. The regions are only read when they are in cache, so
+        this never touches the database. Users without regions get the most popular items. When there is nothing
+        precomputed it gives the contingency items.
+
+        :param user: The user external_id
+        :param n: The number of recommendations to give in response
+        :return: Item external id list
+        """
+        contingency = self._contingency
+        result = contingency.get(None)
+        if len(contingency) > 1:
+            try:
+                from recommendation.language.models import Region
+                user_id = User.get_user_id_by_external_id.peek(user)
+                regions = [] if user_id is None else \
+                    [contingency[r] for r in Region.get_user_regions.peek(user_id) or () if r in contingency]
+            except Exception:
+                logging.debug(traceback.format_exc())
+                regions = []
+            if len(regions) == 1:
+                result = regions[0]
+            elif regions:
+                order = {item: i for i, item in enumerate(result)}
+                result = sorted(set().union(*regions), key=lambda item: order.get(item, len(order)))
+        if not result or len(result) < n:
+            return super(TensorCoFiController, self).get_contingency_recommendation(user, n)
+        return result[:n]
+
+
+def top_items(scores, size):
+    """
+    Get the indexes of the top scores of each row sorted from the highest score
+
+    >>> top_items(np.array([[.1, .5, .3], [.9, .2, .4]]), 2)
+    array([[1, 2],
+           [0, 2]])
+
+    :param scores: A matrix with the scores of the items for each user
+    :param size: The number of top items to get
+    :return: A matrix with the indexes of the top items in each row
+    """
+    size = min(size, scores.shape[1])
+    rows = np.arange(scores.shape[0])[:, np.newaxis]
+    top = np.argpartition(-scores, size-1, axis=1)[:, :size]
+    return top[rows, np.argsort(-scores[rows, top], axis=1)]
+
 
 class NotEnoughItemsToCompute(Exception):
     """
@@ -240,6 +577,7 @@ for engine, engine_settings in RECOMMENDATION_SETTINGS.items():
     if engine != "logger":
         cls, args, kwargs = initialize(engine_settings["core"])
         RECOMMENDATION_ENGINES[engine] = cls(*args, **kwargs)
+        RECOMMENDATION_ENGINES[engine].name = engine
 
         # Register Filters
         for filter_cls in engine_settings["filters"]:
@@ -1,18 +1,25 @@
 #! -*- encoding: utf-8 -*-
 
 from __future__ import division, absolute_import, print_function
-#import os
+import os
 from concurrent.futures import ThreadPoolExecutor  # , TimeoutError
-#from django.conf import settings
+from django.conf import settings
 from django.core.cache import get_cache
+from django.db import connection, DatabaseError
 import functools
 #import atexit
 import itertools
 import warnings
 #import random
-#import logging
+import logging
 import sys
+import threading
+import time
 import traceback
+from collections import OrderedDict
+from timeit import default_timer
+import numpy as np
+from recommendation.metrics import record, count, METRICS
 #import recommendation.settings
 try:
     from uwsgi import lock, i_am_the_spooler, unlock, mule_msg
@@ -23,6 +30,15 @@ except ImportError:
 
 __author__ = "joaonrb"
 
+RESPONSE_TIMEOUT = None if int(os.environ.get("FRAPPE_TEST", 0)) else getattr(settings, "RESPONSE_TIMEOUT", None)
+CONTINGENCY_REFRESH = getattr(settings, "CONTINGENCY_REFRESH", 600)
+CACHE_BATCH_SIZE = 1000  # Keys in each get_many and set_many of the cache
+SINGLE_FLIGHT_WAIT = getattr(settings, "SINGLE_FLIGHT_WAIT", 10)  # Seconds waiting for other caller to load a value
+CACHE_LOCAL_TIMEOUT = 0 if int(os.environ.get("FRAPPE_TEST", 0)) else getattr(settings, "CACHE_LOCAL_TIMEOUT", 5)
+
+deadline = threading.local()  # Deadline of the recommendation in each thread
+statement_timeout = [True]  # False when the database doesn't support max_execution_time
+
 
 class ThreadPoolExecutorStackTraced(ThreadPoolExecutor):
 
@@ -92,35 +108,253 @@ class NoLogger(ILogger):
         return decorated
 
 
+class LocalCache(object):
+    """
+    Bounded cache in this process in front of a Django cache. The values read or written are kept in the process up
+    to local_timeout seconds and the least recently used are dropped when there are more than size, so the hot values
+    don't pay the unpickle and the network on each read. The writes and deletes go to both. The values changed by other
+    processes are seen in this one after local_timeout seconds at most.
+
+    The values are shared by all the readers in the process, so they must not be changed in place.
+
+    >>> cache = LocalCache(get_cache("default"), size=2, local_timeout=60)
+    >>> cache.set("local_a", 1)
+    >>> cache.set("local_b", 2)
+    >>> cache.set("local_c", 3)
+    >>> print(list(cache.entries))
+    ['local_b', 'local_c']
+    >>> cache.delete("local_b")
+    >>> print(cache.get("local_b"), cache.get("local_a"), list(cache.entries))
+    None 1 ['local_c', 'local_a']
+    """
+
+    def __init__(self, backend, size, local_timeout=CACHE_LOCAL_TIMEOUT):
+        self.backend = backend
+        self.size = size
+        self.local_timeout = local_timeout
+        self.entries = OrderedDict()  # Tuples (value, expire time) by key from the least recently used
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def get(self, key, default=None, *args, **kwargs):
+        with self.lock:
+            value, expires = self.entries.pop(key, (None, 0))
+            if expires > default_timer():
+                self.entries[key] = value, expires
+                return value
+        value = self.backend.get(key, *args, **kwargs)
+        if value is None:
+            return default
+        self.keep(key, value)
+        return value
+
+    def set(self, key, value, *args, **kwargs):
+        self.backend.set(key, value, *args, **kwargs)
+        self.keep(key, value)
+
+    def get_many(self, keys, *args, **kwargs):
+        result, missing, now = {}, [], default_timer()
+        with self.lock:
+            for key in keys:
+                value, expires = self.entries.get(key, (None, 0))
+                if expires > now:
+                    result[key] = value
+                else:
+                    missing.append(key)
+        if missing:
+            found = self.backend.get_many(missing, *args, **kwargs)
+            for key, value in found.items():
+                self.keep(key, value)
+            result.update(found)
+        return result
+
+    def set_many(self, data, *args, **kwargs):
+        self.backend.set_many(data, *args, **kwargs)
+        for key, value in data.items():
+            self.keep(key, value)
+
+    def delete(self, key, *args, **kwargs):
+        with self.lock:
+            self.entries.pop(key, None)
+        self.backend.delete(key, *args, **kwargs)
+
+    def delete_many(self, keys, *args, **kwargs):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+        self.backend.delete_many(keys, *args, **kwargs)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        self.backend.clear()
+
+    def keep(self, key, value):
+        """
+        Keep a value in this process
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value, default_timer() + self.local_timeout
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
 class Cached(object):
 
-    def __init__(self, timeout=None, cache="default", lock_id=None):
+    def __init__(self, timeout=None, cache="default", lock_id=None, local=None, single_flight=False):
+        """
+        :param timeout: Seconds the values are kept in cache. None keeps them forever.
+        :param cache: The name of the Django cache
+        :param lock_id: The uWSGI lock used in the writes
+        :param local: Most values kept in this process in front of the cache. None or CACHE_LOCAL_TIMEOUT 0 reads
+            the cache on each call.
+        :param single_flight: When a value is missing only one caller loads it and the others wait for it up to
+            SINGLE_FLIGHT_WAIT seconds. For values that are slow to load.
+        """
         self.timeout = timeout
         self.cache = get_cache(cache)
+        if local and CACHE_LOCAL_TIMEOUT:
+            self.cache = LocalCache(self.cache, local)
         self.lock_id = lock_id
         self.lock_this = self.no_lock if lock_id is None else self.put_lock
+        self.single_flight = single_flight
+        self.flights = {}  # Events of the values being loaded in this process by key
+        self.flights_lock = threading.Lock()
 
     def __call__(self, function):
         """
         The call of the view.
         """
+        stage = "cache.%s" % function.__name__  # Name of the function in the metrics
+
         @functools.wraps(function)
         def decorated(*args):
             key = "_".join(itertools.chain([function.__name__], map(lambda x: str(x), args)))
             result = self.cache.get(key)
             if result is None:
-                return self.reload(key, function(*args))
+                start = default_timer()
+                result = self.load(key, function, args) if self.single_flight else self.reload(key, function(*args))
+                if METRICS:
+                    count_miss(stage, result, default_timer() - start)
+            elif METRICS:
+                count(stage + ".hits")
             return result
         decorated.lock_this = self.lock_this
         decorated.cache = self.cache
         decorated.key = lambda *a: "_".join(itertools.chain([function.__name__], map(lambda x: str(x), a)))
         decorated.timeout = self.timeout
+        decorated.get_many = lambda args_list: self.get_many(function, decorated.key, args_list, stage)
+        decorated.set_many = lambda mapping: self.set_many(decorated.key, mapping)
+        decorated.peek = lambda *a: self.cache.get(decorated.key(*a))  # The cached value, None without loading it
         return decorated
 
     def reload(self, key, result):
         self.lock_this(self.cache.set)(key, result, self.timeout)
         return result
 
+    def load(self, key, function, args):
+        """
+        Load a missing value once. In this process the first thread loads it and the others wait for its event. Across
+        processes the loader takes a lease in the cache, so with a shared cache the other workers wait for the value
+        to be there. When the wait ends without the value the caller loads it.
+
+        :param key: The cache key
+        :param function: The cached function
+        :param args: The arguments of the call
+        :return: The value
+        """
+        with self.flights_lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = threading.Event()
+        if not leader:
+            flight.wait(SINGLE_FLIGHT_WAIT)
+            result = self.cache.get(key)
+            return self.reload(key, function(*args)) if result is None else result
+        lease = "lease_%s" % key
+        try:
+            if not self.cache.add(lease, os.getpid(), SINGLE_FLIGHT_WAIT):
+                result = self.wait_for(key)
+                if result is not None:
+                    return result
+                return self.reload(key, function(*args))
+            try:
+                return self.reload(key, function(*args))
+            finally:
+                self.cache.delete(lease)
+        finally:
+            with self.flights_lock:
+                del self.flights[key]
+            flight.set()
+
+    def wait_for(self, key):
+        """
+        Wait for other process to put a value in cache, up to SINGLE_FLIGHT_WAIT seconds or until it drops its lease
+        :param key: The cache key
+        :return: The value or None
+        """
+        end, pause = default_timer() + SINGLE_FLIGHT_WAIT, .01
+        while default_timer() < end:
+            time.sleep(pause)
+            result = self.cache.get(key)
+            if result is not None or self.cache.get("lease_%s" % key) is None:
+                return result
+            pause = min(pause * 2, .2)
+        return None
+
+    def get_many(self, function, key, args_list, stage=None):
+        """
+        Get the results of many calls with a read of the cache for each CACHE_BATCH_SIZE calls. The calls missing in
+        cache run and their results are written together.
+
+        :param function: The cached function
+        :param key: The key function of the decorated function
+        :param args_list: A list with the arguments of each call. The argument of a function with a single argument may
+            be given without tuple.
+        :param stage: The name of the function in the metrics
+        :return: A list with the result of each call
+        """
+        args_list = [args if isinstance(args, tuple) else (args,) for args in args_list]
+        keys = [key(*args) for args in args_list]
+        found = {}
+        for start in range(0, len(keys), CACHE_BATCH_SIZE):
+            found.update(self.cache.get_many(keys[start:start+CACHE_BATCH_SIZE]))
+        missing = {}
+        for k, args in zip(keys, args_list):
+            if found.get(k) is None and k not in missing:
+                start = default_timer()
+                missing[k] = function(*args)
+                if METRICS and stage:
+                    count_miss(stage, missing[k], default_timer() - start)
+        if METRICS and stage and len(keys) > len(missing):
+            count(stage + ".hits", len(keys) - len(missing))
+        if missing:
+            self.put_many(missing)
+            found.update(missing)
+        return [found[k] for k in keys]
+
+    def set_many(self, key, mapping):
+        """
+        Write the results of many calls with a write of the cache for each CACHE_BATCH_SIZE calls
+
+        :param key: The key function of the decorated function
+        :param mapping: A dict with the result by the arguments of each call. The argument of a function with a single
+            argument may be given without tuple.
+        """
+        self.put_many({key(*(args if isinstance(args, tuple) else (args,))): value for args, value in mapping.items()})
+
+    def put_many(self, data):
+        """
+        Write many values by cache key in batches
+        """
+        items = list(data.items())
+        for start in range(0, len(items), CACHE_BATCH_SIZE):
+            self.lock_this(self.cache.set_many)(dict(items[start:start+CACHE_BATCH_SIZE]), self.timeout)
+
     def put_lock(self, function):
         def decorated(*args, **kwargs):
             # ensure the spooler will not call it
@@ -139,48 +373,147 @@ class Cached(object):
         return decorated
 
 
-# class ContingencyProtocol(object):
-#    """
-#    Execute in threading pool
-#    """
-#    def __init__(self):
-#        self.__name__ = "ContingencyProtocol"
-#        self.decorator = self.no_contingency if int(os.environ.get("FRAPPE_TEST", 0)) else self.with_contingency
+def count_miss(stage, value, seconds):
+    """
+    Record a cache miss of a Cached function in the metrics: the latency of the load in the histogram of the function
+    and the bytes of the value loaded in the counter <stage>.bytes
 
-#    def with_contingency(self, function):
-#        """
-#        The call of the view.
-#        """
+    :param stage: The name of the function in the metrics
+    :param value: The value loaded
+    :param seconds: The time of the load
+    """
+    record(stage, seconds)
+    count(stage + ".bytes", size_of(value))
 
-#        def decorated(self, user, n=10):
-#            future = clone_pool.submit(function, self, user, n)
-#            try:
-#                result = future.result(getattr(settings, "RESPONSE_TIMEOUT", 150./1000.))
-#            except TimeoutError:
-#                future.cancel()
-#                logging.error("TimeOut error: Contingency Protocol delivered the recommendation")
-#                result = random.sample(getattr(settings, "CONTINGENCY_ITEMS", SAMPLE), n)
-#            except Exception:
-#                future.cancel()
-#                logging.error(traceback.format_exc())
-#                result = random.sample(getattr(settings, "CONTINGENCY_ITEMS", SAMPLE), n)
-#            return result
-#        return decorated
 
-#    def no_contingency(self, function):
-#        """
-#        The call of the view.
-#        """
-#
-#        def decorated(self, user, n=10):
-#            return function(self, user, n)
-#        return decorated
+def size_of(value):
+    """
+    Estimate the size of a value in cache without serializing it, so the misses of the models stay cheap. The arrays
+    count their data, the tuples their values and any other value its own size with the arrays in its attributes.
+
+    >>> print(size_of(np.zeros(10)), size_of((np.zeros(10), np.zeros(5))) > 120, size_of(None) > 0)
+    80 True True
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if type(value) is tuple:
+        return sys.getsizeof(value) + sum(size_of(v) for v in value)
+    attributes = getattr(value, "__dict__", {}).values()
+    return sys.getsizeof(value) + sum(v.nbytes for v in attributes if isinstance(v, np.ndarray))
+
+
+class DeadlineExceeded(Exception):
+    """
+    Exception for when the recommendation runs out of its latency budget
+    """
+    pass
+
+
+def check_deadline():
+    """
+    Raise DeadlineExceeded when the recommendation in this thread is over its latency budget. Without a budget it does
+    nothing.
+    """
+    limit = getattr(deadline, "limit", None)
+    if limit is not None and default_timer() > limit:
+        raise DeadlineExceeded()
+
+
+def bound_statements(seconds):
+    """
+    Limit the time of each select of this thread in the database, so a stalled database can't hold the request past
+    its budget. It uses max_execution_time of MySQL 5.7.8 or later. Other databases are not bound and when MySQL
+    doesn't support it the bound is turned off for this process.
+
+    :param seconds: The most seconds of each select. None removes the limit.
+    """
+    if not statement_timeout[0] or connection.vendor != "mysql":
+        return
+    try:
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SET SESSION max_execution_time = %d" % int((seconds or 0) * 1000))
+        finally:
+            cursor.close()
+    except DatabaseError:
+        statement_timeout[0] = False
+        logging.warning("The database doesn't support max_execution_time. The selects are not bound.")
+
+
+class ContingencyProtocol(object):
+    """
+    Latency budget of the recommendation. The recommendation runs in the request thread with a deadline that the
+    controller checks between the stages. When it goes over the deadline or raises, the contingency recommendation of
+    the controller is given instead. No thread is started, so nothing is left running after the fallback. A stage that
+    blocks is only noticed when it returns, so in MySQL the selects of the request are bound to the budget too (see
+    bound_statements). The cache calls are only bound by the timeout of the cache client.
+
+    Each fallback is recorded in the metrics as contingency.timeout or contingency.error, even with METRICS off. The
+    controller precomputes the contingency recommendations in a daemon thread of each worker every CONTINGENCY_REFRESH
+    seconds, so no request waits for them. The first ones are loaded in the warm up of the workers.
+    """
+
+    def __init__(self, budget=None):
+        """
+        :param budget: The latency budget in seconds. Default is RESPONSE_TIMEOUT. None or 0 turns it off.
+        """
+        self.budget = budget or RESPONSE_TIMEOUT
+        self.refreshers = {}  # Process of the refresh thread by controller
+        self.lock = threading.Lock()
+
+    def __call__(self, function):
+        """
+        The call of the view.
+        """
+        if not self.budget:
+            return function
+
+        @functools.wraps(function)
+        def decorated(controller, user, n=10):
+            self.refresh_contingency(controller)
+            start = default_timer()
+            deadline.limit = start + self.budget
+            bound_statements(self.budget)
+            try:
+                return function(controller, user, n)
+            except DeadlineExceeded:
+                reason = "timeout"
+            except Exception:
+                reason = "timeout" if default_timer() > deadline.limit else "error"  # A select killed by the bound
+                logging.error(traceback.format_exc())
+            finally:
+                deadline.limit = None
+                bound_statements(None)
+            record("contingency.%s" % reason, default_timer() - start)
+            logging.warning("Contingency protocol delivered the recommendation for %s (%s)" % (user, reason))
+            return controller.get_contingency_recommendation(user, n)
+        return decorated
+
+    def refresh_contingency(self, controller):
+        """
+        Start the thread that refreshes the contingency recommendations of the controller in this process
+        """
+        if self.refreshers.get(id(controller)) == os.getpid():
+            return
+        with self.lock:
+            if self.refreshers.get(id(controller)) != os.getpid():
+                self.refreshers[id(controller)] = os.getpid()
+                thread = threading.Thread(target=self.work, args=(controller,), name="contingency refresh")
+                thread.daemon = True
+                thread.start()
+
+    @staticmethod
+    def work(controller):
+        """
+        Compute again the contingency recommendations of the controller periodically
+        """
+        while True:
+            time.sleep(CONTINGENCY_REFRESH)
+            try:
+                controller.load_contingency()
+            except Exception:
+                logging.error(traceback.format_exc())
 
-#    def __call__(self, function):
-#        """
-#        The call of the view.
-#        """
-#        return self.decorator(function)
 
 SAMPLE = ["364927",
           "409126",
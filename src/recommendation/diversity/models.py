@@ -10,12 +10,13 @@ Diversification models necessary to apply the diversification to a recommendatio
 
 from __future__ import division, absolute_import, print_function
 import click
+import numpy as np
 from itertools import chain
 from collections import Counter
 from django.utils.translation import ugettext as _
 from django.db import models
 from django.db.models import Count
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.contrib import admin
 from recommendation.models import Item
@@ -59,6 +60,16 @@ class Genre(models.Model):
         """
         return [genre_id for genre_id, in Genre.objects.all().values_list("pk")]
 
+    @staticmethod
+    @Cached(single_flight=True)
+    def get_genre_counts():
+        """
+        Get the number of items of each genre
+        :return: An array with the number of items indexed by genre id
+        """
+        genres = np.array(list(ItemGenre.objects.all().values_list("type_id", flat=True)), dtype=np.int64)
+        return np.bincount(genres, minlength=(Genre.objects.aggregate(max=models.Max("pk"))["max"] or 0)+1)
+
     @staticmethod
     def load_to_cache():
         """
@@ -66,16 +77,15 @@ class Genre(models.Model):
 
         :return:
         """
-        cache = Genre.get_genre_by_id.cache
-        for genre in Genre.objects.all().annotate(count_items=Count("items")):
-        #with click.progressbar(Genre.objects.all().annotate(count_items=Count("items")),
-        #                       label="Loading genres to cache") as bar:
-        #    for genre in bar:
-                Genre.get_genre_by_id.lock_this(
-                    cache.set
-                )(Genre.get_genre_by_id.key(genre.pk), genre, Genre.get_genre_by_id.timeout)
+        Genre.get_genre_by_id.set_many({
+            genre.pk: genre for genre in Genre.objects.all().annotate(count_items=Count("items"))
+        })
 
         Genre.get_all_genres()
+        Genre.get_genre_counts.lock_this(
+            Genre.get_genre_counts.cache.delete
+        )(Genre.get_genre_counts.key())
+        Genre.get_genre_counts()
 
 
 class ItemGenre(models.Model):
@@ -106,6 +116,55 @@ class ItemGenre(models.Model):
         """
         return [item_genre.type.pk for item_genre in ItemGenre.objects.filter(item_id=item_id)]
 
+    @staticmethod
+    @Cached(single_flight=True)
+    def get_genre_matrix():
+        """
+        Get the genres of all the items in compressed sparse rows, a row for each item index (item id - 1)
+        :return: A tuple with the row pointers and the genre ids
+        """
+        n_items = Item.objects.aggregate(max=models.Max("pk"))["max"] or 0
+        item_genres = ItemGenre.objects.all().order_by("item_id", "type_id").values_list("item_id", "type_id")
+        item_genres = np.array(list(item_genres), dtype=np.int64).reshape((-1, 2))
+        item_genres = item_genres[item_genres[:, 0] <= n_items]
+        return np.concatenate([[0], np.cumsum(np.bincount(item_genres[:, 0]-1, minlength=n_items))]), \
+            item_genres[:, 1]
+
+    @staticmethod
+    def genres_of(matrix, indexes):
+        """
+        Get the genres of many items from the genre matrix. Items out of the matrix have no genres.
+
+        >>> matrix = np.array([0, 1, 1, 3]), np.array([3, 1, 2])
+        >>> rows, genres = ItemGenre.genres_of(matrix, np.array([2, 0, 7]))
+        >>> print(rows.tolist(), genres.tolist())
+        [0, 0, 1] [1, 2, 3]
+
+        :param matrix: The genre matrix as given by ItemGenre.get_genre_matrix
+        :param indexes: The item indexes (item id - 1)
+        :return: A tuple with the position in indexes and the genre id of each item genre
+        """
+        indptr, genres = matrix
+        valid = (indexes >= 0) & (indexes < len(indptr)-1)
+        indexes = np.where(valid, indexes, 0)
+        starts = indptr[indexes]
+        lengths = np.where(valid, indptr[np.minimum(indexes+1, len(indptr)-1)] - starts, 0)
+        rows = np.repeat(np.arange(len(indexes)), lengths)
+        offsets = np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return rows, genres[np.repeat(starts, lengths) + offsets]
+
+    @staticmethod
+    def drop_genre_matrix():
+        """
+        Drop the genre matrix and the genre counts from cache. They are built again with the new catalog.
+        """
+        ItemGenre.get_genre_matrix.lock_this(
+            ItemGenre.get_genre_matrix.cache.delete
+        )(ItemGenre.get_genre_matrix.key())
+        Genre.get_genre_counts.lock_this(
+            Genre.get_genre_counts.cache.delete
+        )(Genre.get_genre_counts.key())
+
     @staticmethod
     def load_to_cache():
         """
@@ -121,13 +180,10 @@ class ItemGenre(models.Model):
                     genres[item_genre.item_id].append(item_genre.type_id)
                 except KeyError:
                     genres[item_genre.item_id] = [item_genre.type_id]
-        cache = ItemGenre.get_genre_by_item.cache
-        for item_id, genre in genres.items():
-        #with click.progressbar(genres.items(), label="Loading genres by item to cache") as bar:
-        #    for item_id, genre in bar:
-                ItemGenre.get_genre_by_item.lock_this(
-                    cache.set
-                )(ItemGenre.get_genre_by_item.key(item_id), genre, ItemGenre.get_genre_by_item.timeout)
+        ItemGenre.get_genre_by_item.set_many(genres)
+        ItemGenre.drop_genre_matrix()
+        ItemGenre.get_genre_matrix()
+        Genre.get_genre_counts()
 
     @staticmethod
     def load_item(item):
@@ -146,4 +202,10 @@ class ItemGenre(models.Model):
 def load_item_to_cache(sender, **kwargs):
     ItemGenre.get_genre_by_item(kwargs["instance"].pk)
 
+
+@receiver(post_save, sender=ItemGenre)
+@receiver(post_delete, sender=ItemGenre)
+def drop_genre_matrix(sender, **kwargs):
+    ItemGenre.drop_genre_matrix()
+
 admin.site.register([Genre, ItemGenre])
\ No newline at end of file
@@ -9,6 +9,8 @@ Implementation of the simple diversity for
 """
 
 from __future__ import division, absolute_import, print_function
+import numpy as np
+from recommendation.models import User, TensorCoFi, Generation, UserMatrix, NotCached
 from recommendation.diversity.models import Genre, ItemGenre
 
 __author__ = "joaonrb"
@@ -27,42 +29,42 @@ def weighted_p(p_global, p_local, alpha):
 
 class SimpleDiversity(object):
     """
-    A simpler way to imply diversity
+    A simpler way to imply diversity. The quota of each genre in the recommendation is computed from the genre counts
+    and the genres of the user items, all as arrays indexed by genre id.
     """
 
     def __init__(self, items, size, user, alpha_constant, lambda_constant):
         number_items = len(items)
+        self.matrix = ItemGenre.get_genre_matrix()
+        genre_counts = Genre.get_genre_counts()
 
-        user_items = user.owned_items
-        user_genres = ItemGenre.genre_in((item for item in user_items.values()))
-        user_items_count = len(user_items)
-
-        self.counter = {}
-        for genre_id in Genre.get_all_genres():
-            genre = Genre.get_genre_by_id(genre_id)
-            try:
-                p_global = genre.count_items / float(number_items)
-            except ZeroDivisionError:
-                p_global = 0.
-            try:
-                p_local = user_genres.get(genre, 0.) / float(user_items_count)
-            except ZeroDivisionError:
-                p_local = 0.
-            self.counter[genre.pk] = int(weighted_p(p_global, p_local, alpha_constant) * size)
-
-    def __call__(self, recommendation, item_id):
-        genres = ItemGenre.get_genre_by_item(item_id)
-        dropped = 0
-        for genre in genres:
-            self.counter[genre] -= 1
-            if self.counter[genre] < 0:
-                dropped += 1
+        user_items = User.get_user_items(user.pk)
+        user_items = np.array([item_id for item_id, is_dropped in user_items.items() if not is_dropped], dtype=np.int64)
+        _, user_genres = ItemGenre.genres_of(self.matrix, user_items-1)
+        user_genres = np.bincount(user_genres, minlength=len(genre_counts))[:len(genre_counts)]
+
+        p_global = genre_counts / float(number_items) if number_items else np.zeros(len(genre_counts))
+        p_local = user_genres / float(len(user_items)) if len(user_items) else np.zeros(len(genre_counts))
+        self.counter = (weighted_p(p_global, p_local, alpha_constant) * size).astype(np.int64)
+
+    def __call__(self, items):
+        """
+        Check which items keep the diversity when taken in order. Each item takes one from the quota of each of its
+        genres, even when it is dropped.
+
+        :param items: An array with the item ids in the order of the recommendation
+        :return: A boolean array with True for the items to keep
+        """
+        rows, genres = ItemGenre.genres_of(self.matrix, items-1)
+        order = np.lexsort((rows, genres))
+        taken = np.empty((len(order),), dtype=np.int64)  # Quota taken until each item genre, including it
+        taken[order] = np.arange(len(order)) - np.searchsorted(genres[order], genres[order]) + 1
+        quota = np.zeros((len(genres),), dtype=np.int64)
+        known = genres < len(self.counter)
+        quota[known] = self.counter[genres[known]]
+        dropped = np.bincount(rows, weights=quota < taken, minlength=len(items))
         # Change "<" to "<=" improve greatly
-        if dropped <= len(genres):
-            # recommendation.append(item)
-            return True
-        return False
-        # return recommendation
+        return dropped <= np.bincount(rows, minlength=len(items))
 
 
 class SimpleDiversityReRanker(object):
@@ -95,13 +97,94 @@ class SimpleDiversityReRanker(object):
         :rtype: list
         """
         diversity = SimpleDiversity(recommendation, size, user, self.alpha_constant, self.lambda_constant)
-        new_recommendation = []
-        dropped_items = []
-        for item_id in recommendation:
-            if diversity(new_recommendation, item_id):
-                new_recommendation.append(item_id)
-            else:
-                dropped_items.append(item_id)
-            if len(new_recommendation) > size:
-                break
-        return new_recommendation + dropped_items + recommendation[len(new_recommendation)+len(dropped_items):]
+        items = np.array(recommendation, dtype=np.int64)
+        keep = diversity(items)
+        # The greedy pass stops after it keeps more than size items
+        end = np.searchsorted(np.cumsum(keep), size+1) + 1
+        head, keep = items[:end], keep[:end]
+        return head[keep].tolist() + head[~keep].tolist() + list(recommendation[len(head):])
+
+
+def mmr(relevance, factors, size, lambda_constant):
+    """
+    Maximal marginal relevance selection. Each step takes the item with the best relevance discounted by its highest
+    cosine similarity with the items already taken. The similarity of each taken item with all the candidates is a
+    single product with the factors, so each step costs O(candidates * factors).
+
+    >>> factors = np.array([[1., 0.], [1., .1], [0., 1.]])
+    >>> print(mmr(np.array([1., .9, .5]), factors, 2, .5).tolist())
+    [0, 2]
+
+    :param relevance: The relevance of each candidate
+    :param factors: The factors of each candidate
+    :param size: The number of candidates to take
+    :param lambda_constant: Weight of the relevance against the diversity, between 0 and 1
+    :return: An array with the indexes of the candidates taken in order
+    """
+    norms = np.sqrt(np.sum(factors * factors, axis=1))
+    directions = factors / np.maximum(norms, np.finfo(np.float32).tiny)[:, np.newaxis]
+    span = relevance.max() - relevance.min() if len(relevance) else 0.
+    relevance = lambda_constant * (relevance - relevance.min()) / (span or 1.) if len(relevance) else relevance
+    max_similarity = np.empty((len(relevance),), dtype=np.float64)
+    max_similarity.fill(-1.)
+    selected = np.zeros((len(relevance),), dtype=np.bool_)
+    order = []
+    for _ in range(min(size, len(relevance))):
+        marginal = relevance - (1. - lambda_constant) * max_similarity
+        marginal[selected] = -np.inf
+        best = np.argmax(marginal)
+        order.append(best)
+        selected[best] = True
+        np.maximum(max_similarity, np.dot(directions, directions[best]), out=max_similarity)
+    return np.array(order, dtype=np.int64)
+
+
+class MMRReRanker(object):
+    """
+    Maximal marginal relevance re-ranker over the TensorCoFi item factors. The head of the recommendation is chosen
+    from the first candidates so that each item is relevant and not similar to the ones before it. The relevance is
+    the score of the user factors or, for users without factors, given by the position in the recommendation.
+
+    To use it, add it to the rerankers in RECOMMENDATION_SETTINGS::
+
+        "rerankers": [
+            ("recommendation.diversity.rerankers.MMRReRanker", {"lambda_constant": .7, "candidates": 100})
+        ]
+    """
+
+    def __init__(self, lambda_constant=.7, candidates=100):
+        """
+        Constructor
+
+        :param lambda_constant: Weight of the relevance against the diversity. It has to be between 0 and 1.
+        :param candidates: Number of items from the head of the recommendation to choose from.
+        """
+        self.lambda_constant = lambda_constant
+        self.candidates = candidates
+
+    def __call__(self, user, recommendation, size, *args, **kwargs):
+        """
+
+        :param user: The user that want the recommendation
+        :param recommendation: The recommendation to re-rank
+        :type recommendation: list
+        :param size: The size of the recommendation asked
+        :type size: int
+        :return: The re-ranked recommendation
+        :rtype: list
+        """
+        try:
+            generation = Generation.get_current()
+            item_factors = TensorCoFi.get_item_matrix(generation.items_id)
+        except NotCached:
+            return recommendation
+        candidates = np.array(recommendation[:self.candidates], dtype=np.int64)
+        candidates = candidates[candidates <= len(item_factors)]
+        factors = np.asarray(item_factors[candidates-1], dtype=np.float64)
+        try:
+            relevance = np.dot(factors, UserMatrix.get_user_factors(generation, user.pk-1))
+        except (KeyError, IndexError, NotCached):
+            relevance = -np.arange(len(candidates), dtype=np.float64)
+        head = candidates[mmr(relevance, factors, size, self.lambda_constant)].tolist()
+        taken = set(head)
+        return head + [item_id for item_id in recommendation if item_id not in taken]
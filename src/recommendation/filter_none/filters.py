@@ -8,17 +8,21 @@ import numpy as np
 from django.db import models
 from recommendation.decorators import Cached
 from recommendation.models import Item
+from recommendation.filters import ExclusionFilter
 
 __author__ = "joaonrb"
 
 
-class FilterNoneItems(object):
+class FilterNoneItems(ExclusionFilter):
     """
     Filter items in database that don't exist in database
     """
 
+    static = True  # Runs when the candidates are precomputed
+    score = float("-inf")
+
     @staticmethod
-    @Cached()
+    @Cached(single_flight=True)
     def get_none_items():
         n = Item.objects.aggregate(max=models.Max("pk"))["max"]
         none_items = np.zeros((n,), dtype=np.float32)
@@ -30,5 +34,8 @@ class FilterNoneItems(object):
                 none_items[i] = float("-inf")
         return none_items
 
-    def __call__(self, user, recommendation, *args, **kwargs):
-        return recommendation + self.get_none_items()[:len(recommendation)]
+    def exclude(self, user, n_items, *args, **kwargs):
+        return np.isinf(self.get_none_items())
+
+    def exclude_batch(self, users, n_items, *args, **kwargs):
+        return self.exclude(None, n_items)  # The same for every user
@@ -5,27 +5,43 @@ Plugin to remove owned items
 """
 
 from __future__ import division, absolute_import, print_function
+import numpy as np
+from recommendation.models import User
+from recommendation.filters import ExclusionFilter
 
 __author__ = "joaonrb"
 
 
-class FilterOwned(object):
+class FilterOwned(ExclusionFilter):
     """
     Filter To filter the owned items
     """
 
-    def __call__(self, user, recommendation, size=None, **kwargs):
+    def exclude(self, user, n_items, size=None, **kwargs):
         """
 
         :param user: User that requested the recommendation
-        :param recommendation: List of scores for each item. The index of the score represents the id of the item in db.
+        :param n_items: The size of the scores array
         :param size: The size of the recommendation
         :param kwargs: Extra parameters
-        :return:
+        :return: The indexes of the owned items
         """
-        for item in user.owned_items.values():
-            try:
-                recommendation[item.pk-1] = -1000
-            except IndexError:
-                pass
-        return recommendation
\ No newline at end of file
+        return np.array([item_id for item_id, is_dropped in User.get_user_items(user.pk).items() if not is_dropped],
+                        dtype=np.int64) - 1
+
+    def exclude_batch(self, users, n_items, size=None, **kwargs):
+        """
+        Get the owned items of many users, with one read of the cache
+
+        :return: A boolean matrix with True for the owned items of each user
+        """
+        rows, items = [], []
+        for i, user_items in enumerate(User.get_user_items.get_many([user.pk for user in users])):
+            owned = [item_id for item_id, is_dropped in user_items.items() if not is_dropped]
+            rows.extend([i] * len(owned))
+            items.extend(owned)
+        rows, items = np.array(rows, dtype=np.int64), np.array(items, dtype=np.int64) - 1
+        inside = (items >= 0) & (items < n_items)
+        mask = np.zeros((len(users), n_items), dtype=np.bool_)
+        mask[rows[inside], items[inside]] = True
+        return mask
@@ -0,0 +1,192 @@
+#! -*- encoding: utf-8 -*-
+"""
+Base of the filters that exclude items from the recommendation. Instead of writing the scores of the excluded items
+one by one, these filters give the items to exclude as a boolean mask or as an array of item indexes (item id - 1). The
+controller joins the exclusions of all of them and writes the scores with a single numpy operation.
+
+The filters that change the scores in other ways are still called with the scores array and return the new one.
+
+The batch recommendation runs the filters over a matrix with the scores of many users. The exclusion filters give a
+boolean mask for the whole batch with exclude_batch and the other filters may score the whole batch with a batch method.
+"""
+
+from __future__ import division, absolute_import, print_function
+import numpy as np
+
+__author__ = "joaonrb"
+
+EXCLUDED_SCORE = -1000  # Score of the items sent to the end of the recommendation
+
+
+class ExclusionFilter(object):
+    """
+    A filter that gives the items to exclude for a user. Calling it with a scores array applies the exclusion to it,
+    so it can still be used as any other filter.
+
+    >>> class OddFilter(ExclusionFilter):
+    ...     def exclude(self, user, n_items, **kwargs):
+    ...         return np.arange(1, n_items, 2)
+    >>> print(OddFilter()(None, np.ones(5)).tolist())
+    [1.0, -1000.0, 1.0, -1000.0, 1.0]
+    """
+
+    score = EXCLUDED_SCORE  # Score given to the excluded items
+
+    def exclude(self, user, n_items, size=None, **kwargs):
+        """
+        Get the items to exclude from the recommendation of the user
+
+        :param user: User that requested the recommendation
+        :param n_items: The size of the scores array
+        :param size: The size of the recommendation
+        :return: A boolean mask with True for the items to exclude or an array with the indexes of the items to
+            exclude. The mask may be shorter or longer than the scores and the indexes may be out of them.
+        """
+        raise NotImplementedError()
+
+    def exclude_batch(self, users, n_items, size=None, **kwargs):
+        """
+        Get the items to exclude for many users. By default it joins the exclusions of each user, the filters that can
+        build the mask of the whole batch at once override it.
+
+        >>> class OddFilter(ExclusionFilter):
+        ...     def exclude(self, user, n_items, **kwargs):
+        ...         return np.arange(user, n_items, 2)
+        >>> print(OddFilter().exclude_batch([0, 1], 3).astype(int).tolist())
+        [[1, 0, 1], [0, 1, 0]]
+
+        :param users: A list of users
+        :param n_items: The number of items in the scores
+        :param size: The size of the recommendation
+        :return: A boolean matrix with a row for each user and True for the items to exclude. A single row (1-d mask)
+            excludes the same items for all the users. It may be shorter or longer than the scores.
+        """
+        mask = np.zeros((len(users), n_items), dtype=np.bool_)
+        for i, user in enumerate(users):
+            mask[i] = exclusion_mask(n_items, [self.exclude(user, n_items, size=size, **kwargs)])
+        return mask
+
+    def __call__(self, user, recommendation, size=None, **kwargs):
+        excluded = exclusion_mask(len(recommendation), [self.exclude(user, len(recommendation), size=size, **kwargs)])
+        recommendation[excluded] = self.score
+        return recommendation
+
+
+def exclusion_mask(n_items, exclusions):
+    """
+    Join many exclusions in a single boolean mask
+
+    >>> print(exclusion_mask(4, [np.array([True, False]), np.array([3, 7])]).tolist())
+    [True, False, False, True]
+
+    :param n_items: The size of the mask
+    :param exclusions: A list of boolean masks or arrays of indexes
+    :return: A boolean mask with True for the items excluded by any of them
+    """
+    mask = np.zeros((n_items,), dtype=np.bool_)
+    for exclusion in exclusions:
+        exclusion = np.asarray(exclusion)
+        if exclusion.dtype == np.bool_:
+            size = min(len(exclusion), n_items)
+            mask[:size] |= exclusion[:size]
+        elif len(exclusion):
+            exclusion = exclusion.astype(np.int64, copy=False)
+            mask[exclusion[(exclusion >= 0) & (exclusion < n_items)]] = True
+    return mask
+
+
+def apply_filters(user, recommendation, filters, size=None):
+    """
+    Run the filters over the scores. The exclusions of consecutive exclusion filters are joined and written at once,
+    so the other filters see the scores as if all of them ran in order. When the same item is excluded with different
+    scores, the lowest wins.
+
+    >>> class OddFilter(ExclusionFilter):
+    ...     def exclude(self, user, n_items, **kwargs):
+    ...         return np.arange(1, n_items, 2)
+    >>> class FirstFilter(ExclusionFilter):
+    ...     score = -np.inf
+    ...     def exclude(self, user, n_items, **kwargs):
+    ...         return np.array([True])
+    >>> print(apply_filters(None, np.ones(4), [OddFilter(), FirstFilter(), lambda u, r, size: r + 1]).tolist())
+    [-inf, -999.0, 2.0, -999.0]
+
+    :param user: User that requested the recommendation
+    :param recommendation: The scores array. It may be changed in place.
+    :param filters: The filters in the order they run
+    :param size: The size of the recommendation
+    :return: The filtered scores
+    """
+    pending = {}  # Exclusions to write by score
+    for f in filters:
+        if isinstance(f, ExclusionFilter):
+            pending.setdefault(f.score, []).append(f.exclude(user, len(recommendation), size=size))
+            continue
+        recommendation = write_exclusions(recommendation, pending)
+        pending = {}
+        recommendation = f(user, recommendation, size=size)
+    return write_exclusions(recommendation, pending)
+
+
+def write_exclusions(recommendation, pending):
+    """
+    Write the scores of the pending exclusions, from the highest score to the lowest
+
+    :param recommendation: The scores array
+    :param pending: A dict with the list of exclusions of each score
+    :return: The scores array
+    """
+    for score in sorted(pending, reverse=True):
+        recommendation[exclusion_mask(len(recommendation), pending[score])] = score
+    return recommendation
+
+
+def apply_filters_batch(users, recommendations, filters, size=None):
+    """
+    Run the filters over the scores of many users. It works as apply_filters, but the exclusions of each score are
+    joined in one mask of the whole batch and written with a single numpy operation. The filters that are not
+    exclusion filters run once over the batch when they have a batch method and for each user when they don't.
+
+    >>> class OddFilter(ExclusionFilter):
+    ...     def exclude_batch(self, users, n_items, **kwargs):
+    ...         return np.arange(n_items) % 2 == 1
+    >>> print(apply_filters_batch([None, None], np.ones((2, 3)), [OddFilter(), lambda u, r, size: r + 1]).tolist())
+    [[2.0, -999.0, 2.0], [2.0, -999.0, 2.0]]
+
+    :param users: A list of users
+    :param recommendations: A matrix with the scores of each user in a row. It may be changed in place.
+    :param filters: The filters in the order they run
+    :param size: The size of the recommendation
+    :return: The filtered scores
+    """
+    pending = {}  # Exclusion masks to write by score
+    n_items = recommendations.shape[1]
+    for f in filters:
+        if isinstance(f, ExclusionFilter):
+            pending.setdefault(f.score, []).append(f.exclude_batch(users, n_items, size=size))
+            continue
+        recommendations = write_batch_exclusions(recommendations, pending)
+        pending = {}
+        if hasattr(f, "batch"):
+            recommendations = f.batch(users, recommendations, size=size)
+        else:
+            for i, user in enumerate(users):
+                recommendations[i] = f(user, recommendations[i], size=size)
+    return write_batch_exclusions(recommendations, pending)
+
+
+def write_batch_exclusions(recommendations, pending):
+    """
+    Write the scores of the pending exclusion masks of a batch, from the highest score to the lowest
+
+    :param recommendations: The scores matrix
+    :param pending: A dict with the list of exclusion masks of each score
+    :return: The scores matrix
+    """
+    for score in sorted(pending, reverse=True):
+        mask = np.zeros(recommendations.shape, dtype=np.bool_)
+        for exclusion in pending[score]:
+            size = min(exclusion.shape[-1], mask.shape[1])
+            mask[:, :size] |= exclusion[..., :size]
+        recommendations[mask] = score
+    return recommendations
@@ -5,49 +5,82 @@ The filters for the locale functionality
 
 from __future__ import division, absolute_import, print_function
 import numpy as np
-from itertools import chain
 from recommendation.language.models import Locale, Region
+from recommendation.filters import ExclusionFilter
 
 __author__ = "joaonrb"
 
 
-class SimpleLocaleFilter(object):
+class SimpleLocaleFilter(ExclusionFilter):
     """
     A locale filter.
     Fetch the locale of the user and put every item in the recommendation that is not from that locale to the end.
     User can have multiple locales.
     """
 
-    def __call__(self, user, early_recommendation, size=None, **kwargs):
+    static = True  # Runs when the candidates are precomputed
+
+    def exclude(self, user, n_items, size=None, **kwargs):
+        """
+        Get the items with locales but none of the user locales
+        """
+        key = Locale.locales_key(Locale.get_user_locales(user.pk))
+        return np.unpackbits(Locale.get_items_out_of_locales(key)).view(np.bool_)
+
+    def exclude_batch(self, users, n_items, size=None, **kwargs):
         """
-        Call the filter
+        Get the items out of the locales of many users. The mask of each combination of locales is unpacked once.
         """
-        unsupported_langs = Locale.get_user_locales(user.pk).symmetric_difference(Locale.get_all_locales())
-        #print list(Locale.items_by_locale[l] for l in unsupported_langs)
-        unsupported_items = set(chain(*(Locale.get_items_by_locale(l) for l in unsupported_langs)))
-        for item in unsupported_items:
-            if not any(x in Locale.get_item_locales(item) for x in Locale.get_user_locales(user.pk)):
-                early_recommendation[item-1] = -1000
-        return early_recommendation
+        keys = [Locale.locales_key(locales) for locales in Locale.get_user_locales.get_many([u.pk for u in users])]
+        return batch_mask(keys, n_items, lambda key: Locale.get_items_out_of_locales(key))
 
 
-class SimpleRegionFilter(object):
+class SimpleRegionFilter(ExclusionFilter):
     """
     A locale filter.
     Fetch the locale of the user and put every item in the recommendation that is not from that locale to the end.
     User can have multiple locales.
     """
 
-    def __call__(self, user, early_recommendation, size=None, **kwargs):
+    static = True  # Runs when the candidates are precomputed
+
+    def exclude(self, user, n_items, size=None, **kwargs):
+        """
+        Get the items out of all the user regions
+        """
+        user_regions = Region.get_user_regions(user.pk)
+        if len(user_regions) == 0:
+            return np.zeros((0,), dtype=np.bool_)
+        return np.unpackbits(Region.get_items_out_of_regions(Region.regions_key(user_regions))).view(np.bool_)
+
+    def exclude_batch(self, users, n_items, size=None, **kwargs):
         """
-        Call the filter
+        Get the items out of the regions of many users. The mask of each combination of regions is unpacked once and
+        users without regions get nothing out.
         """
-        user_regions = tuple([Region.get_item_list_by_region(region) for region in Region.get_user_regions(user.pk)])
-        if len(user_regions) > 0:
-            for item_id, score in enumerate(np.sum(user_regions, axis=0), start=1):
-                if score == 0:
-                    try:
-                        early_recommendation[item_id-1] = -1000
-                    except IndexError:
-                        pass
-        return early_recommendation
+        keys = [Region.regions_key(regions) if regions else None
+                for regions in Region.get_user_regions.get_many([u.pk for u in users])]
+        return batch_mask(keys, n_items, lambda key: Region.get_items_out_of_regions(key))
+
+
+def batch_mask(keys, n_items, get_packed):
+    """
+    Build the mask of a batch of users from the packed bits of the combination of each user
+
+    >>> print(batch_mask(["a", None, "a"], 3, lambda key: np.packbits([1, 0, 1])).astype(int).tolist())
+    [[1, 0, 1], [0, 0, 0], [1, 0, 1]]
+
+    :param keys: The key of the combination of each user. None excludes nothing.
+    :param n_items: The number of items in the scores
+    :param get_packed: A function that gives the packed bits of a key
+    :return: A boolean matrix with a row for each user
+    """
+    mask = np.zeros((len(keys), n_items), dtype=np.bool_)
+    rows = {}
+    for i, key in enumerate(keys):
+        if key is not None:
+            rows.setdefault(key, []).append(i)
+    for key, key_rows in rows.items():
+        out = np.unpackbits(get_packed(key)).view(np.bool_)[:n_items]
+        mask[np.array(key_rows)[:, np.newaxis], np.arange(len(out))] = out
+    return mask
@@ -6,9 +6,11 @@ The locale models moudle. It must contain the locale
 from __future__ import division, absolute_import, print_function
 import click
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils.translation import ugettext as _
 import numpy as np
-from recommendation.models import Item, User
+from recommendation.models import Item, User, InventoryChange, Candidates, ResponseCache
 from recommendation.decorators import Cached
 
 __author__ = "joaonrb"
@@ -55,6 +57,63 @@ class Locale(models.Model):
     def get_items_by_locale(locale_id):
         return set([pk[0] for pk in ItemLocale.objects.filter(locale_id=locale_id).values_list("item_id")])
 
+    @staticmethod
+    @Cached(single_flight=True)
+    def get_locale_index():
+        """
+        Get the incidence of the items in the locales in compressed sparse rows, a row for each locale
+
+        :return: A tuple with the number of items, the sorted locale ids, the row pointers and the item ids
+        """
+        item_locales = ItemLocale.objects.all().order_by("locale_id", "item_id").values_list("locale_id", "item_id")
+        item_locales = np.array(list(item_locales), dtype=np.int64).reshape((-1, 2))
+        locales, starts = np.unique(item_locales[:, 0], return_index=True)
+        return Item.objects.aggregate(max=models.Max("pk"))["max"] or 0, locales, \
+            np.append(starts, len(item_locales)), item_locales[:, 1]
+
+    @staticmethod
+    @Cached()
+    def get_items_out_of_locales(locales):
+        """
+        Get the items that have locales but none of these as packed bits, one bit for each item index (item id - 1).
+        Items without locales are never out. It is cached for each combination of locales.
+
+        :param locales: The locale ids sorted and joined by "-", as given by Locale.locales_key
+        """
+        return Locale.pack_items_out(Locale.get_locale_index(), [int(l) for l in locales.split("-") if l])
+
+    @staticmethod
+    def locales_key(locales):
+        """
+        Key of a combination of locales
+
+        >>> print(Locale.locales_key(set([2, 1])))
+        1-2
+        """
+        return "-".join(str(l) for l in sorted(locales))
+
+    @staticmethod
+    def pack_items_out(index, locales):
+        """
+        Pack the items that have locales but none of the given ones
+
+        >>> index = (5, np.array([1, 2]), np.array([0, 2, 4]), np.array([1, 2, 2, 3]))
+        >>> print(np.unpackbits(Locale.pack_items_out(index, [1])).tolist())
+        [0, 0, 1, 0, 0, 0, 0, 0]
+
+        :param index: The incidence of items in locales as given by Locale.get_locale_index
+        :param locales: The locale ids
+        :return: An uint8 array with the packed bits
+        """
+        n_items, locale_ids, indptr, items = index
+        out = np.zeros((n_items,), dtype=np.bool_)
+        out[items[items <= n_items]-1] = True
+        for row in np.searchsorted(locale_ids, locales):
+            if row < len(locale_ids) and locale_ids[row] in locales:
+                in_locale = items[indptr[row]:indptr[row+1]]
+                out[in_locale[in_locale <= n_items]-1] = False
+        return np.packbits(out)
+
     def save(self, *args, **kwargs):
         """
         Makes the codes to be saved always using lower case
@@ -68,9 +127,7 @@ class Locale(models.Model):
 
     @staticmethod
     def load_to_cache():
-        with click.progressbar(Locale.get_all_locales(), label="Loading locales to cache") as bar:
-            for locale_id in bar:
-                Locale.get_items_by_locale(locale_id)
+        Locale.get_items_by_locale.get_many(Locale.get_all_locales())
 
         users = {}
         with click.progressbar(UserLocale.objects.all().values_list("user_id", "locale_id"),
@@ -80,10 +137,7 @@ class Locale(models.Model):
                     users[user_id].add(genre_id)
                 except KeyError:
                     users[user_id] = set([genre_id])
-            for user_id, genres in users.items():
-                Locale.get_user_locales.lock_this(
-                    Locale.get_user_locales.cache.set
-                )(Locale.get_user_locales.key(user_id), genres, Locale.get_user_locales.timeout)
+        Locale.get_user_locales.set_many(users)
 
         items = {}
         with click.progressbar(ItemLocale.objects.all().values_list("item_id", "locale_id"),
@@ -93,10 +147,16 @@ class Locale(models.Model):
                     items[item_id].add(genre_id)
                 except KeyError:
                     items[item_id] = set([genre_id])
-            for item_id, genres in items.items():
-                Locale.get_item_locales.lock_this(
-                    Locale.get_item_locales.cache.set
-                )(Locale.get_item_locales.key(item_id), genres, Locale.get_item_locales.timeout)
+        Locale.get_item_locales.set_many(items)
+
+        Locale.get_locale_index.lock_this(
+            Locale.get_locale_index.cache.delete
+        )(Locale.get_locale_index.key())
+        index = Locale.get_locale_index()
+        Locale.get_items_out_of_locales.set_many({
+            key: Locale.pack_items_out(index, [int(l) for l in key.split("-")])
+            for key in set(Locale.locales_key(locales) for locales in users.values())
+        })
 
 
 class ItemLocale(models.Model):
@@ -171,20 +231,69 @@ class Region(models.Model):
 
     @staticmethod
     @Cached()
-    def get_item_list_by_region(region_id):
-        items = np.zeros((Item.objects.aggregate(max=models.Max("pk"))["max"]))
-        for item, in ItemRegion.objects.filter(region_id=region_id).values_list("item_id"):
-            items[item-1] = 1
-        return items
+    def get_items_out_of_region(region_id):
+        """
+        Get the items that are not in the region as packed bits, one bit for each item index (item id - 1)
+        """
+        items = np.array(list(ItemRegion.objects.filter(region_id=region_id).values_list("item_id", flat=True)),
+                         dtype=np.int64)
+        return Region.pack_items_out(Item.objects.aggregate(max=models.Max("pk"))["max"] or 0, items)
+
+    @staticmethod
+    @Cached()
+    def get_items_out_of_regions(regions):
+        """
+        Get the items that are in none of the regions as packed bits. It is cached for each combination of regions.
+
+        :param regions: The region ids sorted and joined by "-", as given by Region.regions_key
+        """
+        return Region.join_items_out([Region.get_items_out_of_region(int(r)) for r in regions.split("-")])
+
+    @staticmethod
+    def regions_key(regions):
+        """
+        Key of a combination of regions
+
+        >>> print(Region.regions_key([3, 1]))
+        1-3
+        """
+        return "-".join(str(r) for r in sorted(regions))
+
+    @staticmethod
+    def pack_items_out(n_items, items):
+        """
+        Pack the items out of a region. The bits after the last item are zero, so the items created after the bits are
+        not taken as out of the region.
+
+        >>> print(np.unpackbits(Region.pack_items_out(5, np.array([1, 3]))).tolist())
+        [0, 1, 0, 1, 1, 0, 0, 0]
+
+        :param n_items: The number of items
+        :param items: The ids of the items in the region
+        :return: An uint8 array with the packed bits
+        """
+        out = np.ones((n_items,), dtype=np.bool_)
+        out[items[items <= n_items]-1] = False
+        return np.packbits(out)
+
+    @staticmethod
+    def join_items_out(packed):
+        """
+        Join the items out of many regions in the items out of all of them
+
+        >>> a, b = np.packbits([1, 1, 0, 1]), np.packbits([0, 1, 1, 1, 1, 1, 1, 1, 1])
+        >>> print(np.unpackbits(Region.join_items_out([a, b])).tolist())
+        [0, 1, 0, 1, 0, 0, 0, 0]
+
+        :param packed: A list with the packed bits of each region
+        :return: The packed bits of the items out of all the regions
+        """
+        size = min(len(bits) for bits in packed)
+        return np.bitwise_and.reduce([bits[:size] for bits in packed])
 
     @staticmethod
     def load_to_cache():
-        for region in Region.objects.all():
-        #with click.progressbar(Region.objects.all(), label="Loading regions to cache") as bar:
-        #    for region in bar:
-                Region.get_regions.lock_this(
-                    Region.get_regions.cache.set
-                )(Region.get_regions.key(region.pk), region, Region.get_regions.timeout)
+        Region.get_regions.set_many({region.pk: region for region in Region.objects.all()})
         users = {}
         for user_id, region_id in UserRegion.objects.all().values_list("user_id", "region_id"):
         #with click.progressbar(UserRegion.objects.all().values_list("user_id", "region_id"),
@@ -194,21 +303,19 @@ class Region(models.Model):
                     users[user_id].append(region_id)
                 except KeyError:
                     users[user_id] = [region_id]
-        for user, regions in users.items():
-                Region.get_user_regions.lock_this(
-                    Region.get_user_regions.cache.set
-                )(Region.get_user_regions.key(user), regions, Region.get_user_regions.timeout)
-        items = np.zeros((Region.objects.aggregate(max=models.Max("pk"))["max"],
-                          Item.objects.aggregate(max=models.Max("pk"))["max"]))
-        for item_id, region_id in ItemRegion.objects.all().values_list("item_id", "region_id"):
-        #with click.progressbar(ItemRegion.objects.all().values_list("item_id", "region_id"),
-        #                       label="Loading item regions to cache") as bar:
-        #    for item_id, region_id in bar:
-                items[region_id-1, item_id-1] = 1
-        for i in range(items.shape[0]):
-            Region.get_item_list_by_region.lock_this(
-                Region.get_item_list_by_region.cache.set
-            )(Region.get_item_list_by_region.key(i+1), items[i, :], Region.get_item_list_by_region.timeout)
+        Region.get_user_regions.set_many(users)
+        n_items = Item.objects.aggregate(max=models.Max("pk"))["max"] or 0
+        item_regions = ItemRegion.objects.all().order_by("region_id").values_list("region_id", "item_id")
+        item_regions = np.array(list(item_regions), dtype=np.int64).reshape((-1, 2))
+        packed = {}
+        for region_id in Region.objects.all().values_list("pk", flat=True):
+            start, end = np.searchsorted(item_regions[:, 0], [region_id, region_id+1])
+            packed[region_id] = Region.pack_items_out(n_items, item_regions[start:end, 1])
+        Region.get_items_out_of_region.set_many(packed)
+        Region.get_items_out_of_regions.set_many({
+            key: Region.join_items_out([packed[int(r)] for r in key.split("-")])
+            for key in set(Region.regions_key(regions) for regions in users.values())
+        })
 
 
 class UserRegion(models.Model):
@@ -250,5 +357,40 @@ class ItemRegion(models.Model):
     def __unicode__(self):
         return u"%s for %s" % (self.region, self.item)
 
+
+def drop_user_languages(user_ids, register=True):
+    """
+    Drop what was computed with the old regions and locales of the users: their cached regions and locales, their
+    candidates and their cached recommendations. Used by the signals and by the bulk creates that don't send them.
+    :param user_ids: A list of user ids
+    :param register: Put the users in the inventory change queue, so the offline jobs refresh them
+    """
+    for user_id in user_ids:
+        if register:
+            InventoryChange.register(user_id)
+        ResponseCache.drop(user_id)
+    Candidates.remove_many(user_ids)
+    for dec in (Region.get_user_regions, Locale.get_user_locales):
+        dec.cache.delete_many([dec.key(user_id) for user_id in user_ids])
+
+
+@receiver(post_save, sender=UserRegion)
+@receiver(post_save, sender=UserLocale)
+def register_user_change_on_save(sender, instance, *args, **kwargs):
+    """
+    Put user in the inventory change queue and drop what was computed with the old regions and locales
+    """
+    drop_user_languages([instance.user_id])
+
+
+@receiver(post_delete, sender=UserRegion)
+@receiver(post_delete, sender=UserLocale)
+def register_user_change_on_delete(sender, instance, *args, **kwargs):
+    """
+    Drop what was computed with the old regions and locales of the user. The user is not put in the queue because the
+    delete may come from the delete of the user.
+    """
+    drop_user_languages([instance.user_id], register=False)
+
 from django.contrib import admin
 admin.site.register([Locale, ItemLocale, UserLocale, Region, ItemRegion, UserRegion])
\ No newline at end of file
@@ -0,0 +1,226 @@
+"""
+Benchmarks
+==========
+
+Measure the speed and the quality of the fast paths of the recommendation and of the trainers against the reference
+ones::
+
+    $ python manage.py benchmark ann
+    $ python manage.py benchmark ann --items 100000 --factors 20 --users 200
+    $ python manage.py benchmark als
+    $ python manage.py benchmark als --items 10000 --users 100000 --owned 20
+    $ python manage.py benchmark mmr --items 100000 --candidates 1000
+
+By default it uses the models in the current generation or the inventory in database. With --items it uses random
+data drawn from some centers, so it runs without data in the database.
+"""
+
+from __future__ import division, absolute_import, print_function
+import time
+import numpy as np
+from optparse import make_option
+from django.db import models
+from django.core.management.base import BaseCommand, CommandError
+from testfm.models.tensorcofi import PyTensorCoFi
+from recommendation.models import Generation, Matrix, TensorCoFi, User, Item, get_inventory_arrays
+from recommendation.ann import IVFIndex, ANN_CLUSTERS
+from recommendation.als import ALS
+from recommendation.core import top_items
+from recommendation.diversity.rerankers import mmr
+
+
+def get_factors(options):
+    """
+    Get the item factors and a sample of the user factors
+
+    :param options: The command options
+    :return: A tuple with the item factors and the user factors
+    """
+    random = np.random.RandomState(options["seed"])
+    if options["items"]:
+        centers = random.normal(size=(max(1, options["items"] // 1000), options["factors"]))
+        items = centers[random.randint(len(centers), size=options["items"])] + \
+            .3 * random.normal(size=(options["items"], options["factors"]))
+        users = centers[random.randint(len(centers), size=options["users"])] + \
+            .3 * random.normal(size=(options["users"], options["factors"]))
+        return items.astype(np.float32), users.astype(np.float32)
+    generation = Generation.get_current()
+    if generation.items_id is None or generation.users_id is None:
+        raise CommandError("There is no TensorCoFi model in the current generation. Use --items.")
+    users = Matrix.get_array(generation.users_id)
+    sample = random.choice(users.shape[0], min(options["users"], users.shape[0]), replace=False)
+    return np.asarray(TensorCoFi.get_item_matrix(generation.items_id)), np.asarray(users[sample])
+
+
+def timed(function, users):
+    """
+    Run the function for each user
+
+    :param function: A function that receives the user factors
+    :param users: The user factors
+    :return: A tuple with a list of results and the mean time per user in milliseconds
+    """
+    start = time.time()
+    results = [function(user) for user in users]
+    return results, (time.time() - start) * 1000. / len(users)
+
+
+def benchmark_ann(command, options):
+    """
+    Recall and latency of the approximate nearest neighbour index against the exact scoring of all items
+    """
+    items, users = get_factors(options)
+    n = options["n"]
+    command.stdout.write("%d items with %d factors, %d users, top %d" % (items.shape[0], items.shape[1],
+                                                                         users.shape[0], n))
+    exact, exact_time = timed(lambda u: set(top_items(np.dot(items, u)[np.newaxis], n)[0]), users)
+    command.stdout.write("Exact scoring: %.3f ms per user" % exact_time)
+    start = time.time()
+    index = IVFIndex(items, n_clusters=ANN_CLUSTERS)
+    command.stdout.write("Index of %d clusters built in %.2f s" % (index.n_clusters, time.time() - start))
+
+    def approximate(user_factors, probes):
+        candidates, result = index.get_recommendation(user_factors, probes, n)
+        return set(candidates[top_items(result[candidates][np.newaxis], n)[0]])
+
+    command.stdout.write("%8s %12s %12s %10s" % ("probes", "recall@%d" % n, "ms per user", "speedup"))
+    probes = 1
+    while probes < index.n_clusters * 2:
+        results, ann_time = timed(lambda u: approximate(u, probes), users)
+        recall = np.mean([len(a & e) / len(e) for a, e in zip(results, exact)])
+        command.stdout.write("%8d %12.3f %12.3f %10.2f" % (min(probes, index.n_clusters), recall, ann_time,
+                                                           exact_time / ann_time))
+        probes *= 2
+
+
+def get_inventory(options):
+    """
+    Get the owned items of each user as training data
+
+    :param options: The command options
+    :return: A tuple with the number of users, the number of items and a sorted matrix of (user, item, 1) rows
+    """
+    if options["items"]:
+        random = np.random.RandomState(options["seed"])
+        n_users, n_items = options["users"], options["items"]
+        users = random.normal(size=(n_users, options["factors"]))
+        items = random.normal(size=(n_items, options["factors"]))
+        owned = []
+        for start in range(0, n_users, 1000):
+            noise = random.gumbel(size=(min(1000, n_users-start), n_items))  # Samples items by their score
+            owned.append(top_items(np.dot(users[start:start+1000], items.transpose()) + noise, options["owned"]))
+        owned = np.concatenate(owned)
+        users, items = np.repeat(np.arange(n_users), owned.shape[1]), owned.ravel()
+    else:
+        n_users = User.objects.aggregate(max=models.Max("pk"))["max"]
+        n_items = Item.objects.aggregate(max=models.Max("pk"))["max"]
+        users, items = get_inventory_arrays()
+        users, items = users - 1, items - 1
+    order = np.lexsort((items, users))
+    data = np.ones((len(order), 3), dtype=np.int32)
+    data[:, 0], data[:, 1] = users[order], items[order]
+    return n_users, n_items, data
+
+
+def benchmark_als(command, options):
+    """
+    Wall time and quality of the multi-core ALS against test.fm TensorCoFi. One item of each user with more than 2
+    items is held out of the training. The quality is the rate of held out items in the top n of their users and the
+    factors of both models are compared by the overlap of the top n they give.
+    """
+    n_users, n_items, data = get_inventory(options)
+    random = np.random.RandomState(options["seed"])
+    starts = np.searchsorted(data[:, 0], np.arange(n_users))
+    sizes = np.diff(np.append(starts, len(data)))
+    users = np.flatnonzero(sizes > 2)
+    held_out = starts[users] + (random.random_sample(len(users)) * sizes[users]).astype(np.int64)
+    train = np.delete(data, held_out, axis=0)
+    command.stdout.write("%d users, %d items, %d training rows, %d held out" % (n_users, n_items, len(train),
+                                                                                  len(held_out)))
+
+    def train_tensorcofi():
+        tensor = TensorCoFi(n_users=n_users, n_items=n_items)
+        PyTensorCoFi.train(tensor, train)
+        return PyTensorCoFi.get_model(tensor)
+
+    tops = {}
+    command.stdout.write("%12s %10s %12s" % ("trainer", "seconds", "hits@%d" % options["n"]))
+    for name, trainer in (("test.fm", train_tensorcofi), ("als", lambda: ALS(n_users, n_items).fit(train))):
+        start = time.time()
+        user_factors, item_factors = trainer()
+        seconds = time.time() - start
+        tops[name], hits = [], 0
+        for first in range(0, len(users), 1000):
+            batch = users[first:first+1000]
+            scores = np.dot(user_factors[batch], np.transpose(item_factors))
+            rows = np.searchsorted(train[:, 0], batch)
+            for i, user in enumerate(batch):  # Owned items in training are not recommended
+                scores[i, train[rows[i]:np.searchsorted(train[:, 0], user, side="right"), 1]] = -np.inf
+            top = top_items(scores, options["n"])
+            hits += np.sum(top == data[held_out[first:first+1000], 1][:, np.newaxis])
+            tops[name].append(top)
+        tops[name] = np.concatenate(tops[name])
+        command.stdout.write("%12s %10.2f %12.3f" % (name, seconds, hits / max(len(users), 1)))
+    overlap = np.mean([len(set(a) & set(b)) for a, b in zip(tops["test.fm"], tops["als"])]) / options["n"]
+    command.stdout.write("Overlap of the top %d of both trainers: %.3f" % (options["n"], overlap))
+
+
+def benchmark_mmr(command, options):
+    """
+    Latency of the maximal marginal relevance re-ranking of the top candidates of each user and how much it changes
+    the relevance and the similarity of the items in the recommendation against the plain top n
+    """
+    items, users = get_factors(options)
+    n, candidates = options["n"], options["candidates"]
+    command.stdout.write("%d items with %d factors, %d users, top %d of %d candidates" % (
+        items.shape[0], items.shape[1], users.shape[0], n, candidates))
+    tops = [top_items(np.dot(items, u)[np.newaxis], candidates)[0] for u in users]
+    norms = np.sqrt(np.sum(items * items, axis=1))
+    directions = items / np.maximum(norms, np.finfo(np.float32).tiny)[:, np.newaxis]
+
+    def similarity(recommendations):
+        return np.mean([(np.sum(np.dot(directions[r], directions[r].transpose())) - len(r)) / (len(r) * (len(r)-1))
+                        for r in recommendations])
+
+    def relevance(recommendations):
+        return np.mean([np.mean(np.dot(items[r], u)) for r, u in zip(recommendations, users)])
+
+    plain = [top[:n] for top in tops]
+    command.stdout.write("%8s %12s %12s %12s" % ("lambda", "ms per user", "relevance", "similarity"))
+    command.stdout.write("%8s %12s %12.3f %12.3f" % ("top", "-", relevance(plain), similarity(plain)))
+    for lambda_constant in (.9, .7, .5):
+        def rerank(user):
+            top = tops[user]
+            factors = items[top].astype(np.float64)
+            return top[mmr(np.dot(factors, users[user]), factors, n, lambda_constant)]
+        results, mmr_time = timed(rerank, range(len(users)))
+        command.stdout.write("%8.1f %12.3f %12.3f %12.3f" % (lambda_constant, mmr_time, relevance(results),
+                                                             similarity(results)))
+
+
+BENCHMARKS = {
+    "ann": benchmark_ann,
+    "als": benchmark_als,
+    "mmr": benchmark_mmr
+}
+
+
+class Command(BaseCommand):
+    args = "<benchmark>"
+    help = "Run a benchmark. Currently implemented: %s." % ", ".join(sorted(BENCHMARKS))
+    option_list = BaseCommand.option_list + (
+        make_option("--items", type="int", dest="items", default=0,
+                    help="Number of random items. Default uses the models in database."),
+        make_option("--factors", type="int", dest="factors", default=20, help="Number of random factors."),
+        make_option("--users", type="int", dest="users", default=100, help="Number of users in the benchmark."),
+        make_option("--owned", type="int", dest="owned", default=10, help="Number of random items of each user."),
+        make_option("--n", type="int", dest="n", default=10, help="Size of the recommendation."),
+        make_option("--candidates", type="int", dest="candidates", default=1000,
+                    help="Number of candidates of the re-ranking."),
+        make_option("--seed", type="int", dest="seed", default=0, help="Seed of the random data."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or args[0] not in BENCHMARKS:
+            raise CommandError("Benchmark must be one of %s" % str(tuple(sorted(BENCHMARKS))))
+        BENCHMARKS[args[0]](self, options)
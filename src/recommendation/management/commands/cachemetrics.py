@@ -0,0 +1,42 @@
+"""
+Cache Metrics
+=============
+
+Show how often each Cached function hits the cache, how long its misses take to load and how many bytes they put in
+cache, joined from the metrics that the workers publish. The workers only record them with METRICS on in the settings::
+
+    $ python manage.py cachemetrics
+    $ python manage.py cachemetrics --json
+
+The latencies are in milliseconds. Functions with many misses and high latency are the cold paths and the bytes of
+each function tell how much cache it needs.
+"""
+
+from __future__ import division, absolute_import, print_function
+import json
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from recommendation.metrics import report, cache_report
+
+
+class Command(BaseCommand):
+    help = "Show the hits, misses, miss latency and bytes of each cached function in all the workers."
+    option_list = BaseCommand.option_list + (
+        make_option("--json", action="store_true", dest="json", default=False, help="Write the metrics in JSON."),
+    )
+
+    def handle(self, *args, **options):
+        metrics = report()
+        functions = cache_report(metrics)
+        if options["json"]:
+            self.stdout.write(json.dumps(functions, indent=2, sort_keys=True))
+            return
+        if not metrics["enabled"]:
+            self.stdout.write("METRICS is off in this settings. The workers may have it on.")
+        self.stdout.write("%d workers" % metrics["workers"])
+        self.stdout.write("%-36s %10s %10s %8s %10s %10s %12s" % ("function", "hits", "misses", "ratio", "miss mean",
+                                                                   "miss p99", "MB"))
+        for name, function in sorted(functions.items(), key=lambda f: -f[1]["misses"]):
+            self.stdout.write("%-36s %10d %10d %8.3f %10.3f %10.3f %12.3f" % (
+                name, function["hits"], function["misses"], function["hit_ratio"], function["miss_mean"],
+                function["miss_p99"], function["bytes"] / 1024. ** 2))
@@ -0,0 +1,58 @@
+"""
+Convert the Matrices
+====================
+
+Upgrade the databases created before the matrices were stored in the numpy binary format. The matrix column was a
+TEXT with the arrays in base64 and it must be a BLOB now, so the binary values are not mangled by the connection
+encoding or cut by the size of the TEXT column. Run it once after the upgrade, with the workers stopped::
+
+    $ python manage.py convertmatrices
+
+The column is changed in place and the values in base64 are still read after it. To write every matrix again in the
+binary format, so it loads without the decode::
+
+    $ python manage.py convertmatrices --rewrite
+
+Only MySQL and PostgreSQL need the column change. Other databases only get the rewrite.
+"""
+
+from __future__ import division, absolute_import, print_function
+from optparse import make_option
+from django.db import connection, transaction
+from django.core.management.base import BaseCommand
+from recommendation.models import Matrix
+
+ALTER_COLUMN = {
+    "mysql": "ALTER TABLE %(table)s MODIFY %(column)s %(type)s NOT NULL",
+    "postgresql": "ALTER TABLE %(table)s ALTER COLUMN %(column)s TYPE %(type)s USING convert_to(%(column)s, 'UTF8')",
+}
+
+
+class Command(BaseCommand):
+    help = "Convert the matrix column from the old text type to a blob and optionally rewrite the matrices in the " \
+           "numpy binary format."
+    option_list = BaseCommand.option_list + (
+        make_option("--rewrite", action="store_true", dest="rewrite", default=False,
+                    help="Write every matrix again in the numpy binary format."),
+    )
+
+    def handle(self, *args, **options):
+        field = Matrix._meta.get_field("numpy")
+        statement = ALTER_COLUMN.get(connection.vendor)
+        if statement is None:
+            self.stdout.write("Column type is not changed in %s" % connection.vendor)
+        else:
+            with transaction.atomic():
+                connection.cursor().execute(statement % {
+                    "table": connection.ops.quote_name(Matrix._meta.db_table),
+                    "column": connection.ops.quote_name(field.column),
+                    "type": field.db_type(connection)
+                })
+            self.stdout.write("Column %s.%s is now %s" % (Matrix._meta.db_table, field.column,
+                                                          field.db_type(connection)))
+        if options["rewrite"]:
+            matrix_ids = list(Matrix.objects.order_by("pk").values_list("pk", flat=True))
+            for matrix_id in matrix_ids:  # One at a time, the matrices may be big
+                # Update doesn't send the signals or touch the timestamp, that the fold in uses as watermark
+                Matrix.objects.filter(pk=matrix_id).update(numpy=Matrix.objects.get(pk=matrix_id).numpy)
+            self.stdout.write("%d matrices written in the numpy binary format" % len(matrix_ids))
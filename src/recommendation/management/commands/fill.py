@@ -47,7 +47,8 @@ from django_docopt_command import DocOptCommand
 from django.conf import settings
 from recommendation.models import Item, User, Inventory
 from recommendation.diversity.models import Genre, ItemGenre
-from recommendation.language.models import Locale, ItemLocale, Region, ItemRegion, UserRegion, UserLocale
+from recommendation.language.models import Locale, ItemLocale, Region, ItemRegion, UserRegion, UserLocale, \
+    drop_user_languages
 
 __author__ = "joaonrb"
 
@@ -357,6 +358,7 @@ class FillTool(object):
             for item_genre in ItemGenre.objects.filter(query_item_genres):
                 del item_genres[item_genre.item_id, item_genre.type_id]
         ItemGenre.objects.bulk_create(item_genres.values())
+        ItemGenre.drop_genre_matrix()
 
     def fill_item_locale(self, objects, items, locales):
         """
@@ -537,6 +539,7 @@ class FillTool(object):
             for ur in UserRegion.objects.filter(region_query).distinct():
                 del user_regions[ur.region_id][ur.user_id]
         UserRegion.objects.bulk_create(itertools.chain(*(ur.values() for ur in user_regions.values())))
+        drop_user_languages(list(set(itertools.chain(*user_regions.values()))))
 
         locale_query = Q()
         user_locales = {}
@@ -558,6 +561,7 @@ class FillTool(object):
             for ur in UserLocale.objects.filter(locale_query).distinct():
                 del user_locales[ur.locale_id][ur.user_id]
         UserLocale.objects.bulk_create(itertools.chain(*(ur.values() for ur in user_locales.values())))
+        drop_user_languages(list(set(itertools.chain(*user_locales.values()))))
 
 
 class Command(DocOptCommand):
@@ -0,0 +1,45 @@
+"""
+Latency Metrics
+===============
+
+Show the latency of each stage of the recommendation, joined from the histograms that the workers publish to the
+cache. The workers only record them with METRICS on in the settings::
+
+    $ python manage.py metrics
+    $ python manage.py metrics --json
+
+The stages are the controller methods (request, recommendation, model, filters, sort, external_ids, ...), each filter
+and re-ranker by class name (filter.FilterOwned, reranker.SimpleDiversityReRanker, ...) and the logging. The latencies
+are in milliseconds and the percentiles are the upper limit of the histogram bucket. The counters of events, as the
+logs dropped by the log writer, are shown after the stages.
+"""
+
+from __future__ import division, absolute_import, print_function
+import json
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from recommendation.metrics import report
+
+
+class Command(BaseCommand):
+    help = "Show the latency of each stage of the recommendation in all the workers."
+    option_list = BaseCommand.option_list + (
+        make_option("--json", action="store_true", dest="json", default=False, help="Write the metrics in JSON."),
+    )
+
+    def handle(self, *args, **options):
+        metrics = report()
+        if options["json"]:
+            self.stdout.write(json.dumps(metrics, indent=2, sort_keys=True))
+            return
+        if not metrics["enabled"]:
+            self.stdout.write("METRICS is off in this settings. The workers may have it on.")
+        self.stdout.write("%d workers" % metrics["workers"])
+        self.stdout.write("%-40s %10s %10s %10s %10s %10s %10s" % ("stage", "count", "mean", "p50", "p90", "p99",
+                                                                  "max"))
+        for stage, summary in sorted(metrics["stages"].items()):
+            self.stdout.write("%-40s %10d %10.3f %10.3f %10.3f %10.3f %10.3f" % (
+                stage, summary["count"], summary["mean"], summary["p50"], summary["p90"], summary["p99"],
+                summary["max"]))
+        for name, value in sorted(metrics["counters"].items()):
+            self.stdout.write("%-40s %10d" % (name, value))
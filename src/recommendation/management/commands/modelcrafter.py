@@ -24,8 +24,14 @@ To make Gepeto go on vacations just type::
 To make Gepeto build only one model::
 
     $ modelcrafter.py train tensorcofi
+    $ modelcrafter.py train als  # TensorCoFi factors trained with all the cores
     $ modelcrafter.py train popularity
 
+To make Gepeto fold in the users with inventory changes since the last model, without a full training::
+
+    $ modelcrafter.py foldin users
+    $ modelcrafter.py foldin items  # The new items too
+
 Options
 =======
 
@@ -46,6 +52,7 @@ DJANGO_SETTINGS = "firefox.recommendation.settings"
 CRON_JOB_NAME = "joaonrb"
 os.environ["DJANGO_SETTINGS_MODULE"] = DJANGO_SETTINGS
 from recommendation.models import TensorCoFi, Popularity
+from recommendation.als import ALSTensorCoFi
 from django.core.management.base import BaseCommand, CommandError
 
 __author__ = "joaonrb"
@@ -90,6 +97,7 @@ class TimeInterval(object):
 
 MODELS = {
     "tensorcofi": TensorCoFi,
+    "als": ALSTensorCoFi,
     "popularity": Popularity
 }
 
@@ -101,6 +109,13 @@ def craft_model(options="popularity"):
     MODELS[options].train_from_db()
 
 
+def fold_in_model(options="users"):
+    """
+    This folds in the users with inventory changes to the current TensorCoFi model, and the new items with "items".
+    """
+    TensorCoFi.fold_in_from_db(new_items=options == "items")
+
+
 def work(every, **kwargs):
     """
     Make the job to work
@@ -125,6 +140,10 @@ OPTIONS = {
     "train": {
         "command": craft_model,
         "args": []
+    },
+    "foldin": {
+        "command": fold_in_model,
+        "args": []
     }
 }
 
@@ -142,7 +161,8 @@ def main(command, options, every=TimeInterval(1, "minute")):
 
 class Command(BaseCommand):
     args = "<action option>"
-    help = "Trains the model. Currently implemented: train tensorcofi, train popularity."
+    help = "Trains the model. Currently implemented: train tensorcofi, train als, train popularity, foldin users, " \
+           "foldin items."
 
     def handle(self, *args, **options):
 
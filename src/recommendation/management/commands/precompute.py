@@ -0,0 +1,97 @@
+"""
+Precompute the Candidates
+=========================
+
+Scores every user with the current generation of the models and stores his top items, after the static filters, in
+the candidates table. The controller serves the recommendation from there and only the online filters (owned items,
+logs) run in the request. Run it after each training::
+
+    $ python manage.py precompute
+    $ python manage.py precompute --processes 8 --size 500
+
+The users whose inventory changed since their candidates were computed have them removed. To compute only those::
+
+    $ python manage.py precompute --incremental
+
+The inventory changes that were folded in and have new candidates are removed from the queue with the candidates.
+
+The candidates of each user are dropped from the shared cache when they are written, so the workers read the new ones.
+"""
+
+from __future__ import division, absolute_import, print_function
+import multiprocessing
+from optparse import make_option
+from django.conf import settings
+from django.db import connection, transaction
+from django.core.management.base import BaseCommand, CommandError
+from recommendation.models import User, Generation, Candidates, InventoryChange
+from recommendation.core import get_controller, ControllerNotDefined, BATCH_SIZE
+
+PRECOMPUTED_SIZE = getattr(settings, "PRECOMPUTED_SIZE", 200)
+CHUNK_SIZE = 4 * BATCH_SIZE  # Users given to a process at a time
+
+
+def start_process():
+    """
+    Drop the connections inherited from the parent process, so each process opens its own
+    """
+    User.get_user_items.cache.close()
+
+
+def precompute_users(args):
+    """
+    Compute and store the candidates of a chunk of users
+
+    :param args: A tuple with the engine name, the number of candidates and the ids of the users
+    :return: The number of users
+    """
+    engine, size, user_ids = args
+    controller = get_controller(engine)
+    generation = Generation.get_current()
+    users = [User.get_user_by_id(user_id) for user_id in user_ids]
+    items, scores = controller.get_candidates(users, size)
+    with transaction.atomic():
+        Candidates.put_candidates(generation.items_id, users, items, scores)
+        InventoryChange.remove_taken(generation, user_ids)
+    return len(users)
+
+
+class Command(BaseCommand):
+    help = "Precompute the top items of each user for the current generation of the models."
+    option_list = BaseCommand.option_list + (
+        make_option("--incremental", action="store_true", dest="incremental", default=False,
+                    help="Only the users with inventory changes and no candidates for the current models."),
+        make_option("--processes", type="int", dest="processes", default=multiprocessing.cpu_count(),
+                    help="Number of processes. Default is the number of cpus."),
+        make_option("--size", type="int", dest="size", default=PRECOMPUTED_SIZE,
+                    help="Number of candidates of each user. Default is %d." % PRECOMPUTED_SIZE),
+        make_option("--engine", dest="engine", default="default", help="Recommendation engine to use."),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            get_controller(options["engine"])
+        except ControllerNotDefined:
+            raise CommandError("Recommendation engine %s is not defined" % options["engine"])
+        generation = Generation.get_current()
+        if generation.items_id is None:
+            raise CommandError("There is no TensorCoFi model to precompute")
+        if options["incremental"]:
+            current = Candidates.objects.filter(item_matrix_id=generation.items_id).values("user_id")
+            query = InventoryChange.objects.exclude(user_id__in=current).order_by("user")
+            user_ids = [user_id for user_id, in query.values_list("user_id")]
+        else:
+            user_ids = [user_id for user_id, in User.objects.order_by("pk").values_list("pk")]
+        chunks = [(options["engine"], options["size"], user_ids[i:i+CHUNK_SIZE])
+                  for i in range(0, len(user_ids), CHUNK_SIZE)]
+        if options["processes"] > 1 and len(chunks) > 1:
+            connection.close()  # Don't share the database connection with the forked processes
+            pool = multiprocessing.Pool(options["processes"], initializer=start_process)
+            try:
+                done = sum(pool.imap_unordered(precompute_users, chunks))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            done = sum(map(precompute_users, chunks))
+        self.stdout.write("Candidates precomputed for %d users" % done)
@@ -0,0 +1,283 @@
+#! -*- encoding: utf-8 -*-
+"""
+Latency histograms of the stages of the recommendation. Each process keeps its own histograms and publishes them to
+the shared cache METRICS_CACHE every METRICS_INTERVAL seconds, so the metrics command and the metrics API can join the
+histograms of all the workers. With METRICS off nothing is wrapped, so the stages run exactly as without metrics.
+"""
+from __future__ import division, absolute_import, print_function
+import os
+import bisect
+import socket
+import functools
+from timeit import default_timer
+from django.conf import settings
+from django.core.cache import get_cache
+
+__author__ = "joaonrb"
+
+METRICS = getattr(settings, "METRICS", False)
+METRICS_INTERVAL = getattr(settings, "METRICS_INTERVAL", 60)
+METRICS_CACHE = getattr(settings, "METRICS_CACHE", "owned_items")  # Must be shared by all the workers, as memcached
+BUCKETS = [m * 10. ** e for e in range(-2, 4) for m in (1, 2, 5)] + [10000.]  # Bucket limits in milliseconds
+WORKERS_KEY = "metrics_workers"  # Cache key with the keys of the histograms of each worker
+
+histograms = {}  # Histograms of this process by stage
+counters = {}  # Counters of events of this process by name
+published = [default_timer()]  # Time of the last publish of this process
+
+
+class Histogram(object):
+    """
+    Histogram of latencies in fixed buckets from 0.01 ms to 10 s
+
+    >>> histogram = Histogram()
+    >>> for ms in (.3, .4, 3., 70.):
+    ...     histogram.add(ms)
+    >>> print(histogram.count, histogram.percentile(.5), histogram.percentile(.99), histogram.max)
+    4 0.5 100.0 70.0
+    """
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self, counts=None, count=0, total=0., maximum=0.):
+        self.counts = counts or [0] * (len(BUCKETS) + 1)
+        self.count, self.total, self.max = count, total, maximum
+
+    def add(self, ms):
+        """
+        Add a latency
+        :param ms: The latency in milliseconds
+        """
+        self.counts[bisect.bisect_left(BUCKETS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def merge(self, other):
+        """
+        Add the latencies of other histogram to this one
+        """
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        """
+        Get the upper limit of the bucket with the percentile
+        :param q: The percentile between 0 and 1
+        :return: The latency in milliseconds
+        """
+        accumulated = 0
+        for limit, count in zip(BUCKETS, self.counts):
+            accumulated += count
+            if accumulated >= q * self.count:
+                return limit
+        return self.max
+
+    def to_dict(self):
+        return {"counts": self.counts, "count": self.count, "total": self.total, "max": self.max}
+
+    @staticmethod
+    def from_dict(data):
+        return Histogram(list(data["counts"]), data["count"], data["total"], data["max"])
+
+    def summary(self):
+        """
+        Summary of the histogram in milliseconds
+        """
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.,
+            "p50": self.percentile(.5),
+            "p90": self.percentile(.9),
+            "p99": self.percentile(.99),
+            "max": self.max
+        }
+
+
+def record(stage, seconds):
+    """
+    Add a latency to the histogram of the stage. The histograms of this process are published when they are older than
+    METRICS_INTERVAL seconds.
+
+    :param stage: The name of the stage
+    :param seconds: The latency in seconds
+    """
+    try:
+        histograms[stage].add(seconds * 1000.)
+    except KeyError:
+        histograms[stage] = Histogram()
+        histograms[stage].add(seconds * 1000.)
+    if default_timer() - published[0] > METRICS_INTERVAL:
+        publish()
+
+
+def count(name, value=1):
+    """
+    Add to the counter of an event. The counters are published with the histograms.
+
+    :param name: The name of the event
+    :param value: How many events
+    """
+    counters[name] = counters.get(name, 0) + value
+    if default_timer() - published[0] > METRICS_INTERVAL:
+        publish()
+
+
+def timed(stage):
+    """
+    Decorator that records the latency of each call to the stage. With METRICS off the function is returned as it is.
+
+    :param stage: The name of the stage
+    """
+    def decorator(function):
+        if not METRICS:
+            return function
+
+        @functools.wraps(function)
+        def decorated(*args, **kwargs):
+            start = default_timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(stage, default_timer() - start)
+        return decorated
+    return decorator
+
+
+class TimedPlugin(object):
+    """
+    Proxy of a filter or re-ranker that records the latency of each call
+    """
+
+    def __init__(self, stage, plugin):
+        self.stage = stage
+        self.plugin = plugin
+
+    def __getattr__(self, name):
+        return getattr(self.plugin, name)
+
+    def __call__(self, *args, **kwargs):
+        start = default_timer()
+        try:
+            return self.plugin(*args, **kwargs)
+        finally:
+            record(self.stage, default_timer() - start)
+
+
+def timed_plugin(kind, plugin):
+    """
+    Record the latency of a filter or re-ranker as the stage "<kind>.<class name>". Exclusion filters keep their class
+    and get their exclude timed, and their exclude_batch as "<kind>.<class name>.batch". With METRICS off the plugin
+    is returned as it is.
+
+    :param kind: filter or reranker
+    :param plugin: The filter or re-ranker
+    :return: The plugin to register
+    """
+    if not METRICS:
+        return plugin
+    stage = "%s.%s" % (kind, type(plugin).__name__)
+    if hasattr(plugin, "exclude"):
+        plugin.exclude = timed(stage)(plugin.exclude)
+        plugin.exclude_batch = timed(stage + ".batch")(plugin.exclude_batch)
+        return plugin
+    return TimedPlugin(stage, plugin)
+
+
+def time_methods(instance, stages):
+    """
+    Record the latency of methods of an object. The methods are wrapped in the instance, so the implementations of
+    subclasses are timed too. With METRICS off nothing is wrapped.
+
+    :param instance: The object
+    :param stages: A list of tuples (method name, stage)
+    """
+    if METRICS:
+        for name, stage in stages:
+            setattr(instance, name, timed(stage)(getattr(instance, name)))
+
+
+def publish():
+    """
+    Publish the histograms and the counters of this process to the shared cache
+    """
+    published[0] = default_timer()
+    cache = get_cache(METRICS_CACHE)
+    key = "metrics_%s_%d" % (socket.gethostname(), os.getpid())
+    cache.set(key, {"histograms": {stage: histogram.to_dict() for stage, histogram in histograms.items()},
+                    "counters": dict(counters)}, METRICS_INTERVAL * 10)
+    workers = cache.get(WORKERS_KEY) or []
+    if key not in workers:
+        cache.set(WORKERS_KEY, workers + [key], None)
+
+
+def collect():
+    """
+    Join the histograms and the counters published by all the workers. The workers that stopped publishing are
+    dropped.
+
+    :return: A tuple with the number of workers, a dict with the joined histogram of each stage and a dict with the
+        total of each counter
+    """
+    cache = get_cache(METRICS_CACHE)
+    workers = cache.get(WORKERS_KEY) or []
+    snapshots = cache.get_many(workers)
+    if len(snapshots) < len(workers):
+        cache.set(WORKERS_KEY, [key for key in workers if key in snapshots], None)
+    result, totals = {}, {}
+    for snapshot in snapshots.values():
+        for stage, data in snapshot.get("histograms", {}).items():
+            try:
+                result[stage].merge(Histogram.from_dict(data))
+            except KeyError:
+                result[stage] = Histogram.from_dict(data)
+        for name, value in snapshot.get("counters", {}).items():
+            totals[name] = totals.get(name, 0) + value
+    return len(snapshots), result, totals
+
+
+def report():
+    """
+    Summary of the latencies of all the workers, with the histograms of this process up to date
+
+    :return: A dict with the number of workers, the summary of each stage in milliseconds and the counters
+    """
+    if histograms or counters:
+        publish()
+    workers, result, totals = collect()
+    return {"enabled": METRICS, "workers": workers,
+            "stages": {stage: histogram.summary() for stage, histogram in result.items()}, "counters": totals}
+
+
+def cache_report(metrics=None):
+    """
+    Hits, misses and bytes loaded of each Cached function, from the metrics of all the workers. The misses are the
+    count of the histogram cache.<function> with the latency of the loads and the hits and bytes its counters.
+
+    >>> print(cache_report({"stages": {"cache.f": {"count": 1, "mean": 2., "p99": 2., "max": 2.}},
+    ...                     "counters": {"cache.f.hits": 3, "cache.f.bytes": 80}})["f"]["hit_ratio"])
+    0.75
+
+    :param metrics: The metrics as given by report. Default is the current report.
+    :return: A dict with the hits, misses, hit ratio, miss latency in milliseconds and bytes loaded by function
+    """
+    metrics = metrics or report()
+    functions = set(stage[6:] for stage in metrics["stages"] if stage.startswith("cache."))
+    functions.update(name[6:].rsplit(".", 1)[0] for name in metrics["counters"] if name.startswith("cache."))
+    result = {}
+    for function in functions:
+        misses = metrics["stages"].get("cache.%s" % function, {"count": 0, "mean": 0., "p99": 0., "max": 0.})
+        hits = metrics["counters"].get("cache.%s.hits" % function, 0)
+        result[function] = {
+            "hits": hits,
+            "misses": misses["count"],
+            "hit_ratio": hits / (hits + misses["count"]) if hits + misses["count"] else 0.,
+            "miss_mean": misses["mean"],
+            "miss_p99": misses["p99"],
+            "miss_max": misses["max"],
+            "bytes": metrics["counters"].get("cache.%s.bytes" % function, 0)
+        }
+    return result
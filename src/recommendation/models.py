@@ -4,12 +4,24 @@ Models for the base of the recommendation system. The base of the recommendation
 amd connection between them.
 """
 from __future__ import division, absolute_import, print_function
+import os
 import sys
+import io
+import zlib
+import errno
 import base64
+import time
+import atexit
+import logging
+import itertools
+import threading
+import traceback
+from datetime import timedelta
 import numpy as np
-import pandas as pd
 # import click
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction, IntegrityError
+from django.utils import timezone
 from django.utils.translation import ugettext as _
 from django.utils.six import with_metaclass
 from django.core.cache import get_cache
@@ -24,6 +36,24 @@ if sys.version_info >= (3, 0):
 __author__ = "joaonrb"
 
 
+MATRIX_COMPRESSION = getattr(settings, "MATRIX_COMPRESSION", 0)
+SHARED_MATRIX_DIR = getattr(settings, "SHARED_MATRIX_DIR", None)
+GENERATION_REFRESH_INTERVAL = getattr(settings, "GENERATION_REFRESH_INTERVAL", 60)
+INVENTORY_CHUNK = 100000  # Inventory rows read in each query of the training data
+FOLD_IN_ALPHA = getattr(settings, "FOLD_IN_ALPHA", 40.)
+FOLD_IN_REGULARIZATION = getattr(settings, "FOLD_IN_REGULARIZATION", .05)
+FOLD_IN_BATCH = 256  # Rows solved together in the fold in
+POPULARITY_FLUSH_INTERVAL = \
+    None if int(os.environ.get("FRAPPE_TEST", 0)) else getattr(settings, "POPULARITY_FLUSH_INTERVAL", 300)
+POPULARITY_HALF_LIFE = getattr(settings, "POPULARITY_HALF_LIFE", None)
+POPULARITY_KEEP = 10  # Generations whose popularity matrices are kept in database by the flush
+POPULARITY_PENDING = "popularity_pending"  # Name of the matrices with the counts of the workers waiting for the flush
+POPULARITY_FLUSH_LEASE = "popularity_flush"  # Key in the shared cache of the process flushing in this interval
+CACHE_LOCAL_SIZE = getattr(settings, "CACHE_LOCAL_SIZE", 100000)  # Most values of each hot lookup kept in the process
+RESPONSE_CACHE_TIMEOUT = getattr(settings, "RESPONSE_CACHE_TIMEOUT", 0)  # Seconds a recommendation is reused. 0 is off
+isin = getattr(np, "isin", np.in1d)  # np.isin from numpy 1.13, the same as np.in1d for the 1-d arrays used here
+
+
 class NPArrayField(with_metaclass(models.SubfieldBase, models.TextField)):
     """
     Numpy Array field to store numpy arrays in database
@@ -104,6 +134,92 @@ class NPArrayField(with_metaclass(models.SubfieldBase, models.TextField)):
                             base64.b64encode(value.tostring())])
 
 
+class NPBinaryField(with_metaclass(models.SubfieldBase, models.BinaryField)):
+    """
+    Numpy Array field that stores the arrays in the numpy binary format (.npy) in a BLOB column.
+
+    The array is built on top of the buffer returned by the database, so there is no decode and no copy when a
+    matrix is loaded. Because of that the arrays that come from the database are read only. When the compression
+    level is bigger than 0 the data is compressed with zlib before going to the database. Values stored by the old
+    NPArrayField are still understood. The databases created with the old TEXT column are converted by the
+    convertmatrices command.
+    """
+
+    description = """Matrix for tensor controller stored in numpy binary format"""
+    __metaclass__ = models.SubfieldBase
+
+    NPY_MAGIC = b"\x93NUMPY"
+    NPY_HEADER_LIMIT = 65546  # Magic string, version, header length and the biggest header of .npy version 1.0
+
+    def __init__(self, *args, **kwargs):
+        self.compress_level = kwargs.pop("compress_level", MATRIX_COMPRESSION)
+        super(NPBinaryField, self).__init__(*args, **kwargs)
+
+    def to_python(self, value):
+        """
+        Convert the value from the database to python like object
+
+        >>> np_array = NPBinaryField().to_python(NPBinaryField().get_prep_value(np.array([1, 2, 3, 4], dtype=np.int32)))
+        >>> print(np_array)
+        [1 2 3 4]
+
+        >>> np_array.dtype
+        dtype('int32')
+
+        >>> np_array.flags.writeable  # The array is a view over the database buffer
+        False
+
+        >>> compressed = NPBinaryField(compress_level=6).get_prep_value(np.zeros((100, 10), dtype=np.float32))
+        >>> len(compressed) < 100 * 10 * 4
+        True
+        >>> NPBinaryField().to_python(compressed).shape
+        (100, 10)
+
+        >>> # Old base64 representation from NPArrayField
+        >>> print(NPBinaryField().to_python("1:4:AACAPwAAAEAAAEBAAACAQA=="))
+        [ 1.  2.  3.  4.]
+
+        :param value: Bytes from database
+        :return: A numpy matrix
+        """
+        if value is None or isinstance(value, np.ndarray):
+            return value
+        if not isinstance(value, bytes):
+            value = bytes(value) if not isinstance(value, unicode) else value.encode("utf-8")
+        if value[:1].isdigit():
+            return NPArrayField().to_python(value)
+        if not value.startswith(self.NPY_MAGIC):
+            value = zlib.decompress(value)
+        header = io.BytesIO(value[:self.NPY_HEADER_LIMIT])
+        version = np.lib.format.read_magic(header)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(header)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(header)
+        count = int(np.prod(shape))
+        matrix = np.frombuffer(value, dtype=dtype, count=count, offset=header.tell())
+        return matrix.reshape(shape, order="F" if fortran_order else "C")
+
+    def get_prep_value(self, value):
+        """
+        Prepare the value from python like object to database like value.
+
+        >>> np_bytes = NPBinaryField().get_prep_value(np.array([1, 2, 3, 4], dtype=np.float32))
+        >>> np_bytes.startswith(NPBinaryField.NPY_MAGIC)
+        True
+
+        :param value: Matrix to keep in database
+        :return: The .npy representation of the matrix, compressed if the field has a compression level
+        """
+        if isinstance(value, np.ndarray):
+            stream = io.BytesIO()
+            np.lib.format.write_array(stream, value)
+            value = stream.getvalue()
+            if self.compress_level:
+                value = zlib.compress(value, self.compress_level)
+        return value
+
+
 class Item(models.Model):
     """
     Item to be used by recommending system
@@ -119,7 +235,7 @@ class Item(models.Model):
         return Item.get_item_by_external_id(Item.get_item_external_id_by_id(item_id))
 
     @staticmethod
-    @Cached()
+    @Cached(local=CACHE_LOCAL_SIZE)
     def get_item_external_id_by_id(item_id):
         """
         Return item id from external_id.
@@ -127,7 +243,7 @@ class Item(models.Model):
         return Item.objects.filter(pk=item_id).values_list("external_id")[0][0]
 
     @staticmethod
-    @Cached()
+    @Cached(local=CACHE_LOCAL_SIZE)
     def get_item_by_external_id(external_id):
         """
         Return item from external id.
@@ -168,10 +284,9 @@ class Item(models.Model):
 
     @staticmethod
     def load_to_cache():
-        for item in Item.objects.all():
-        #with click.progressbar(Item.objects.all(), label="Loading items to cache") as bar:
-        #    for item in bar:
-                item.put_item_to_cache()
+        items = list(Item.objects.all())
+        Item.get_item_by_external_id.set_many({item.external_id: item for item in items})
+        Item.get_item_external_id_by_id.set_many({item.pk: item.external_id for item in items})
 
 
 @receiver(post_save, sender=Item)
@@ -218,7 +333,7 @@ class User(models.Model):
         return User.objects.get(pk=user_id)
 
     @staticmethod
-    @Cached()
+    @Cached(local=CACHE_LOCAL_SIZE)
     def get_user_id_by_external_id(external_id):
         """
         Get the user id from external id
@@ -237,7 +352,7 @@ class User(models.Model):
         return User.get_user_by_id(User.get_user_id_by_external_id(external_id))
 
     @staticmethod
-    @Cached(cache="owned_items", lock_id=0)
+    @Cached(cache="owned_items", lock_id=0, local=CACHE_LOCAL_SIZE)
     def get_user_items(user_id):
         """
         Get user items
@@ -283,36 +398,25 @@ class User(models.Model):
 
     @staticmethod
     def load_to_cache():
-        for user in User.objects.all():
-        #with click.progressbar(User.objects.all(), label="Loading users to cache") as bar:
-        #    for user in bar:
-                User.get_user_by_id.lock_this(
-                    User.get_user_by_id.cache.set
-                )(User.get_user_by_id.key(user.pk), user, User.get_user_by_id.timeout)
-                User.get_user_id_by_external_id.lock_this(
-                    User.get_user_id_by_external_id.cache.set
-                )(User.get_user_id_by_external_id.key(user.external_id), user.pk,
-                  User.get_user_id_by_external_id.timeout)
+        users = list(User.objects.all())
+        User.get_user_by_id.set_many({user.pk: user for user in users})
+        User.get_user_id_by_external_id.set_many({user.external_id: user.pk for user in users})
 
     @staticmethod
     def load_owned_items():
-        lenght = Inventory.objects.all().count()
         inventory = {}
         max_id = 0
-        for i in xrange(0, lenght, 100000):
-            #with click.progressbar(range(0, lenght, 100000),
-            #                       label="Loading owned items to cache") as bar:
-            #    for i in bar:
-            for max_id, user_id, item_id, is_dropped in Inventory.objects.filter(id__gt=max_id) \
-                    .order_by("pk")[i:i+100000].values_list("pk", "user_id", "item_id", "is_dropped"):
+        while True:
+            rows = list(Inventory.objects.filter(id__gt=max_id).order_by("pk")[:INVENTORY_CHUNK]
+                        .values_list("pk", "user_id", "item_id", "is_dropped"))
+            for max_id, user_id, item_id, is_dropped in rows:
                 try:
                     inventory[user_id][item_id] = is_dropped
                 except KeyError:
                     inventory[user_id] = {item_id: is_dropped}
-            for ueid, items in inventory.items():
-                User.get_user_items.lock_this(
-                    User.get_user_items.cache.set
-                )(User.get_user_items.key(ueid), items, User.get_user_items.timeout)
+            if len(rows) < INVENTORY_CHUNK:
+                break
+        User.get_user_items.set_many(inventory)
 
     def load_user(self):
         """
@@ -345,7 +449,7 @@ class User(models.Model):
         Load a single inventory entry
         """
         cache = User.get_user_items.cache
-        entries = cache.get(User.get_user_items.key(self.pk), {})
+        entries = dict(cache.get(User.get_user_items.key(self.pk), {}))  # Other threads may be reading them
         entries[entry.item_id] = entry.is_dropped
         cache.set(User.get_user_items.key(self.pk), entries)
 
@@ -354,7 +458,7 @@ class User(models.Model):
         Load a single inventory entry
         """
         cache = User.get_user_items.cache
-        entries = cache.get(User.get_user_items.key(self.pk), {})
+        entries = dict(cache.get(User.get_user_items.key(self.pk), {}))  # Other threads may be reading them
         try:
             del entries[entry.item.pk]
         except KeyError:
@@ -421,6 +525,34 @@ def delete_inventory_to_cache(sender, instance, using, *args, **kwargs):
     instance.user.delete_item(instance)
 
 
+def get_inventory_arrays(query=None, chunk=INVENTORY_CHUNK):
+    """
+    Read the user and item ids of the inventory into int32 arrays. The rows are read in chunks ordered by primary key
+    and each chunk starts after the last id of the previous one, so no query skips rows with an offset and only one
+    chunk of rows is in Python objects at a time.
+
+    :param query: An Inventory query set. Default is all the inventory.
+    :param chunk: The number of rows read in each query
+    :return: A tuple with the array of user ids and the array of item ids
+    """
+    query = Inventory.objects.all() if query is None else query
+    size = query.count()
+    users, items = np.empty(size, dtype=np.int32), np.empty(size, dtype=np.int32)
+    last_id, n = 0, 0
+    while True:
+        rows = query.filter(pk__gt=last_id).order_by("pk").values_list("pk", "user_id", "item_id")[:chunk]
+        block = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64).reshape(-1, 3)
+        if n + len(block) > len(users):  # Rows inserted after the count
+            users = np.concatenate([users, np.empty(n + len(block) - len(users), dtype=np.int32)])
+            items = np.concatenate([items, np.empty(len(users) - len(items), dtype=np.int32)])
+        users[n:n+len(block)] = block[:, 1]
+        items[n:n+len(block)] = block[:, 2]
+        n += len(block)
+        if len(block) < chunk:
+            return users[:n], items[:n]
+        last_id = block[-1, 0]
+
+
 class Matrix(models.Model):
     """
     Numpy Matrix in database
@@ -428,16 +560,395 @@ class Matrix(models.Model):
 
     name = models.CharField(_("name"), max_length=255)
     model_id = models.SmallIntegerField(_("model id"), null=True, blank=True)
-    numpy = NPArrayField(_("numpy array"))
+    numpy = NPBinaryField(_("numpy array"))
     timestamp = models.DateTimeField(_("timestamp"), auto_now_add=True)
 
+    shared_arrays = {}  # Memory maps of this process by matrix id
+
     class Meta:
         verbose_name = _("matrix")
         verbose_name_plural = _("matrix")
 
+    @staticmethod
+    def get_shared_path(matrix_id):
+        """
+        Path of the matrix file in the shared directory
+        :param matrix_id: The matrix id
+        :return: The path to the .npy file
+        """
+        return os.path.join(SHARED_MATRIX_DIR, "matrix_%d.npy" % matrix_id)
+
+    def share(self):
+        """
+        Write the matrix to the shared directory in numpy format. The file is written with a temporary name and then
+        renamed, so no worker maps a matrix half written. The files of older matrices with the same name and model id
+        are removed. The workers that still have them mapped keep the data until they drop the map.
+        :return: The path to the shared file
+        """
+        path = Matrix.get_shared_path(self.pk)
+        if not os.path.exists(path):
+            try:
+                os.makedirs(SHARED_MATRIX_DIR)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            tmp_path = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmp_path, "wb") as shared_file:
+                np.lib.format.write_array(shared_file, self.numpy)
+            os.rename(tmp_path, path)
+            old_matrices = Matrix.objects.filter(name=self.name, model_id=self.model_id, pk__lt=self.pk)
+            for old_id, in old_matrices.values_list("pk"):
+                try:
+                    os.remove(Matrix.get_shared_path(old_id))
+                except OSError:
+                    pass
+        return path
+
+    @staticmethod
+    def get_shared_array(matrix_id):
+        """
+        Get the matrix as a read only memory map of the file in the shared directory. Every worker in the machine maps
+        the same file, so the data lives only once in memory. The first worker to ask for a matrix writes the file.
+        :param matrix_id: The matrix id
+        :return: A read only numpy memory map
+        """
+        try:
+            return Matrix.shared_arrays[matrix_id]
+        except KeyError:
+            path = Matrix.get_shared_path(matrix_id)
+            if not os.path.exists(path):
+                path = Matrix.objects.get(pk=matrix_id).share()
+            for old_id in [i for i in Matrix.shared_arrays if not os.path.exists(Matrix.get_shared_path(i))]:
+                del Matrix.shared_arrays[old_id]
+            array = Matrix.shared_arrays[matrix_id] = np.load(path, mmap_mode="r")
+            return array
+
+    @staticmethod
+    def get_array(matrix_id):
+        """
+        Get the array of a matrix. It is the shared memory map when there is a shared matrix directory.
+        :param matrix_id: The matrix id
+        :return: A read only numpy array
+        """
+        if SHARED_MATRIX_DIR:
+            return Matrix.get_shared_array(matrix_id)
+        return Matrix.objects.get(pk=matrix_id).numpy
+
+
+@receiver(post_delete, sender=Matrix)
+def remove_shared_matrix(sender, instance, using, *args, **kwargs):
+    """
+    Remove the matrix from the shared directory
+    """
+    if SHARED_MATRIX_DIR:
+        try:
+            os.remove(Matrix.get_shared_path(instance.pk))
+        except OSError:
+            pass
+
+
+class Generation(models.Model):
+    """
+    A published generation of the models. It points to the user and item factors of TensorCoFi, to the factors of the
+    users folded in after the training and to the popularity matrix that are served together. Publishing a new
+    generation is a single insert, so the workers never mix users from one training with items from another. Every
+    value derived from a matrix is cached with the matrix id in the key. When the workers see a new generation they
+    start to use the new keys without any restart or cache flush.
+    """
+
+    ROLES = ("users", "items", "popularity", "users_delta")
+
+    users = models.ForeignKey(Matrix, verbose_name=_("users"), related_name="+", null=True, blank=True)
+    users_delta = models.ForeignKey(Matrix, verbose_name=_("users delta"), related_name="+", null=True, blank=True)
+    items = models.ForeignKey(Matrix, verbose_name=_("items"), related_name="+", null=True, blank=True)
+    popularity = models.ForeignKey(Matrix, verbose_name=_("popularity"), related_name="+", null=True, blank=True)
+    timestamp = models.DateTimeField(_("timestamp"), auto_now_add=True)
+
+    class Meta:
+        verbose_name = _("generation")
+        verbose_name_plural = _("generations")
+
+    def __str__(self):
+        return _("generation %(id)s of %(date)s") % {"id": self.pk, "date": self.timestamp}
+
+    def __unicode__(self):
+        return _("generation %(id)s of %(date)s") % {"id": self.pk, "date": self.timestamp}
+
+    @property
+    def factor_ids(self):
+        """
+        The ids of the factor matrices of the generation. The values derived from the factors are cached with these in
+        the key, so the generations that only change the popularity don't drop them.
+        """
+        return self.users_id, self.users_delta_id, self.items_id
+
+    @staticmethod
+    @Cached(timeout=GENERATION_REFRESH_INTERVAL)
+    def get_current():
+        """
+        Get the current generation. Each worker checks the database for a new generation once every
+        GENERATION_REFRESH_INTERVAL seconds.
+        :return: The last published generation
+        """
+        try:
+            return Generation.objects.order_by("-id")[0]
+        except IndexError:
+            return Generation.publish_latest()
+
+    @staticmethod
+    @transaction.atomic
+    def publish(**matrices):
+        """
+        Publish a new generation. The roles that are not given are taken from the current generation, except the
+        users delta that is dropped when new users are published.
+
+        :param matrices: The new matrices by role (users, items, popularity and users_delta)
+        :return: The new generation
+        """
+        try:
+            last = Generation.objects.select_for_update().order_by("-id")[0]
+        except IndexError:
+            last = None
+        generation = Generation()
+        for role in Generation.ROLES:
+            if matrices.get(role, None) is not None:
+                setattr(generation, role, matrices[role])
+            elif last is not None and not (role == "users_delta" and matrices.get("users", None) is not None):
+                setattr(generation, "%s_id" % role, getattr(last, "%s_id" % role))
+        generation.save()
+        Generation.get_current.lock_this(
+            Generation.get_current.cache.set
+        )(Generation.get_current.key(), generation, Generation.get_current.timeout)
+        return generation
+
+    @staticmethod
+    def publish_latest():
+        """
+        Publish the last matrices of each model as a generation. Used when the database has matrices from before the
+        generations.
+        :return: The new generation
+        """
+        latest = {
+            "users": Matrix.objects.filter(name="tensorcofi", model_id=0),
+            "items": Matrix.objects.filter(name="tensorcofi", model_id=1),
+            "popularity": Matrix.objects.filter(name="popularity")
+        }
+        matrices = {}
+        for role, query in latest.items():
+            try:
+                matrices[role] = query.order_by("-id")[0]
+            except IndexError:
+                pass
+        if not matrices:
+            raise NotCached("No model in db")
+        return Generation.publish(**matrices)
+
+
+class InventoryChange(models.Model):
+    """
+    Queue of the users whose inventory changed, with the time of the last change. The offline jobs refresh only these
+    users instead of everyone.
+    """
+    user = models.ForeignKey(User, verbose_name=_("user"), unique=True, related_name="+")
+    timestamp = models.DateTimeField(_("timestamp"), auto_now=True, db_index=True)
+
+    class Meta:
+        verbose_name = _("inventory change")
+        verbose_name_plural = _("inventory changes")
+
+    def __str__(self):
+        return _("inventory of user %(user)s changed at %(date)s") % {"user": self.user_id, "date": self.timestamp}
+
+    def __unicode__(self):
+        return _("inventory of user %(user)s changed at %(date)s") % {"user": self.user_id, "date": self.timestamp}
+
+    @staticmethod
+    def register(user_id):
+        """
+        Put the user in the queue or update the time of his last change
+        :param user_id: The user id
+        """
+        if not InventoryChange.objects.filter(user_id=user_id).update(timestamp=timezone.now()):
+            try:
+                with transaction.atomic():
+                    InventoryChange.objects.create(user_id=user_id)
+            except IntegrityError:
+                pass  # Other process put the user in the queue first
+
+    @staticmethod
+    def remove_taken(generation, user_ids=None):
+        """
+        Remove the changes that both offline jobs already took. A change was folded in when it is older than the user
+        factors of the generation, and it was precomputed when the user has candidates for the item factors of the
+        generation, since every change removes the candidates of the user.
+        :param generation: The generation with the factors
+        :param user_ids: Only look at these users. All the users by default.
+        """
+        if generation.users_id is None:
+            return
+        since = Matrix.objects.filter(pk=generation.users_delta_id or generation.users_id).values_list(
+            "timestamp", flat=True)[0]
+        query = InventoryChange.objects.filter(timestamp__lt=since, user_id__in=Candidates.objects.filter(
+            item_matrix_id=generation.items_id).values("user_id"))
+        if user_ids is not None:
+            query = query.filter(user_id__in=user_ids)
+        query.delete()
+
+
+class Candidates(models.Model):
+    """
+    The top items of a user computed offline, after the filters that don't change between requests. The items are
+    sorted by score. They are valid while the item factors they were computed with are in the current generation.
+    """
+    user = models.ForeignKey(User, verbose_name=_("user"), unique=True, related_name="+")
+    item_matrix = models.ForeignKey(Matrix, verbose_name=_("item matrix"), related_name="+")
+    items = NPBinaryField(_("items"))
+    scores = NPBinaryField(_("scores"))
+    timestamp = models.DateTimeField(_("timestamp"), auto_now=True)
+
+    class Meta:
+        verbose_name = _("candidates")
+        verbose_name_plural = _("candidates")
+
+    def __str__(self):
+        return _("%(size)s candidates for user %(user)s") % {"size": len(self.items), "user": self.user_id}
+
+    def __unicode__(self):
+        return _("%(size)s candidates for user %(user)s") % {"size": len(self.items), "user": self.user_id}
+
+    @staticmethod
+    @Cached(cache="owned_items")
+    def get_user_candidates(item_matrix_id, user_id):
+        """
+        Get the candidates of the user. They are in the cache shared by the workers, so the precompute command and the
+        inventory changes drop them for all the workers. The item factors are in the key, so new factors read the table
+        again.
+        :param item_matrix_id: The id of the current item factors
+        :param user_id: The user id
+        :return: A tuple with the item matrix id, the item ids and the scores. All None if the user has no candidates.
+        """
+        try:
+            candidates = Candidates.objects.get(user_id=user_id)
+        except Candidates.DoesNotExist:
+            return None, None, None
+        return candidates.item_matrix_id, candidates.items, candidates.scores
+
+    @staticmethod
+    def put_candidates(item_matrix_id, users, items, scores):
+        """
+        Replace the candidates of many users
+        :param item_matrix_id: The id of the item factors used to compute the candidates
+        :param users: A list of users
+        :param items: A matrix with the item ids of each user in a row
+        :param scores: A matrix with the scores of the items
+        """
+        with transaction.atomic():
+            Candidates.objects.filter(user_id__in=[user.pk for user in users]).delete()
+            Candidates.objects.bulk_create([
+                Candidates(user_id=user.pk, item_matrix_id=item_matrix_id, items=user_items, scores=user_scores)
+                for user, user_items, user_scores in zip(users, items.astype(np.int32), scores.astype(np.float32))
+            ])
+        dec = Candidates.get_user_candidates
+        dec.cache.delete_many([dec.key(item_matrix_id, user.pk) for user in users])
+
+    @staticmethod
+    def remove(user_id):
+        """
+        Remove the candidates of the user, so the recommendation is computed online until the next precomputation
+        :param user_id: The user id
+        """
+        Candidates.objects.filter(user_id=user_id).delete()
+        try:
+            item_matrix_id = Generation.get_current().items_id
+        except NotCached:
+            return
+        dec = Candidates.get_user_candidates
+        dec.lock_this(dec.cache.delete)(dec.key(item_matrix_id, user_id))
+
+    @staticmethod
+    def remove_many(user_ids):
+        """
+        Remove the candidates of many users, for changes made without signals (bulk creates)
+        :param user_ids: A list of user ids
+        """
+        Candidates.objects.filter(user_id__in=user_ids).delete()
+        try:
+            item_matrix_id = Generation.get_current().items_id
+        except NotCached:
+            return
+        dec = Candidates.get_user_candidates
+        dec.cache.delete_many([dec.key(item_matrix_id, user_id) for user_id in user_ids])
+
+
+class ResponseCache(object):
+    """
+    Short lived cache of the recommendations given to each user, so page reloads don't run the whole recommendation
+    again. All the recommendations of a user, for any engine, size and factors, are in one cache entry, so a change
+    in the user drops all of them at once. Entries of older factors are dropped on the next put. The
+    entries are in the cache shared by all the workers, so a change handled by one worker drops them for all.
+    """
+
+    cache = get_cache("owned_items")
+
+    @staticmethod
+    def key(user_id):
+        return "response_%s" % user_id
+
+    @staticmethod
+    def get(engine, user_id, n, factor_ids):
+        """
+        Get a cached recommendation
+        :param engine: The name of the engine
+        :param user_id: The user id
+        :param n: The size of the recommendation
+        :param factor_ids: The factor ids of the current generation
+        :return: The list of item ids or None
+        """
+        return (ResponseCache.cache.get(ResponseCache.key(user_id)) or {}).get((engine, n, factor_ids))
+
+    @staticmethod
+    def put(recommendation, engine, user_id, n, factor_ids, timeout=None):
+        """
+        Cache a recommendation
+        :param recommendation: The list of item ids
+        :param timeout: Seconds the recommendation is kept. Default is RESPONSE_CACHE_TIMEOUT.
+        """
+        key = ResponseCache.key(user_id)
+        responses = {k: v for k, v in (ResponseCache.cache.get(key) or {}).items() if k[2] == factor_ids}
+        responses[(engine, n, factor_ids)] = recommendation
+        ResponseCache.cache.set(key, responses, timeout or RESPONSE_CACHE_TIMEOUT)
+
+    @staticmethod
+    def drop(user_id):
+        """
+        Drop the cached recommendations of the user
+        :param user_id: The user id
+        """
+        ResponseCache.cache.delete(ResponseCache.key(user_id))
+
+
+@receiver(post_save, sender=Inventory)
+def register_inventory_change_on_save(sender, instance, created, raw, using, update_fields, *args, **kwargs):
+    """
+    Put user in the inventory change queue and drop his candidates and cached recommendations
+    """
+    InventoryChange.register(instance.user_id)
+    Candidates.remove(instance.user_id)
+    ResponseCache.drop(instance.user_id)
+
+
+@receiver(post_delete, sender=Inventory)
+def register_inventory_change_on_delete(sender, instance, using, *args, **kwargs):
+    """
+    Put user in the inventory change queue and drop his candidates and cached recommendations
+    """
+    InventoryChange.register(instance.user_id)
+    Candidates.remove(instance.user_id)
+    ResponseCache.drop(instance.user_id)
+
 
 from django.contrib import admin
-admin.site.register([Item, User, Inventory, Matrix])
+admin.site.register([Item, User, Inventory, Matrix, Generation, InventoryChange, Candidates])
 
 # Create test.fm models
 
@@ -462,29 +973,69 @@ class UserMatrix:
 
     @staticmethod
     @Cached()
-    def get_user_array(index):
+    def get_user_array(matrix_id, index):
+        if matrix_id is None:
+            raise KeyError("TensorCoFi users are not published")
         if not User.get_user_by_id(index+1).has_more_than(2):  # Index+1 = User ID
             raise KeyError("User %d static recommendation doesn't exist" % (index+1))
-        return Matrix.objects.filter(name="tensorcofi", model_id=0).order_by("-id")[0].numpy[index, :]
+        return Matrix.get_array(matrix_id)[index, :]
 
-    def __getitem__(self, index):
-        return self.get_user_array(index)
+    @staticmethod
+    @Cached()
+    def load_delta(matrix_id):
+        return Matrix.objects.get(pk=matrix_id).numpy
 
-    def __setitem__(self, index, value):
+    @staticmethod
+    def get_delta(matrix_id):
+        """
+        Get the users delta. It is a structured array sorted by user index with the fields user and factors.
+        :param matrix_id: The users delta matrix id
+        """
+        if SHARED_MATRIX_DIR:
+            return Matrix.get_shared_array(matrix_id)
+        return UserMatrix.load_delta(matrix_id)
+
+    @staticmethod
+    def get_user_factors(generation, index):
+        """
+        Get the factors of the user in the generation. The users folded in after the training are in the delta.
+        :param generation: The generation
+        :param index: The user index (user id - 1)
+        :return: The user factors
+        """
+        if generation.users_delta_id is not None:
+            delta = UserMatrix.get_delta(generation.users_delta_id)
+            position = np.searchsorted(delta["user"], index)
+            if position < len(delta) and delta["user"][position] == index:
+                return delta["factors"][position]
+        return UserMatrix.get_user_array(generation.users_id, index)
+
+    @staticmethod
+    def put_user_array(matrix_id, index, value):
         try:
             if User.get_user_by_id(index+1).has_more_than(2):  # Index+1 = User ID
                 dec = UserMatrix.get_user_array
                 dec.lock_this(
                     dec.cache.set
-                )(dec.key(index), value, dec.timeout)
+                )(dec.key(matrix_id, index), value, dec.timeout)
         except User.DoesNotExist:
             pass
 
+    def __getitem__(self, index):
+        return self.get_user_factors(Generation.get_current(), index)
+
+    def __setitem__(self, index, value):
+        self.put_user_array(Generation.get_current().users_id, index, value)
+
     def __delitem__(self, index):
+        try:
+            matrix_id = Generation.get_current().users_id
+        except NotCached:
+            return  # There is no model yet, so there is nothing to remove
         dec = UserMatrix.get_user_array
         dec.lock_this(
             dec.cache.delete
-        )(dec.key(index))
+        )(dec.key(matrix_id, index))
 
 
 class FactorsContainer:
@@ -496,6 +1047,58 @@ class FactorsContainer:
         return [self.__model.user_matrix, self.__model.get_item_matrix()][index]
 
 
+def fold_in(fixed, rows, alpha=FOLD_IN_ALPHA, regularization=FOLD_IN_REGULARIZATION, gram=None):
+    """
+    Solve the factors of new rows of a factorization against the fixed factors of the other side. It is the implicit
+    feedback least squares step of Hu, Koren and Volinsky. Each new row (a user or an item) relates to the fixed rows
+    (his items or its users) with confidence 1 + alpha and to all the others with confidence 1. The systems of
+    FOLD_IN_BATCH rows are built and solved together.
+
+    >>> fixed = np.array([[1., 0.], [0., 1.]])
+    >>> print(fold_in(fixed, [np.array([0]), np.array([], dtype=int)], alpha=1., regularization=0.).tolist())
+    [[1.0, 0.0], [0.0, 0.0]]
+
+    :param fixed: The fixed factors
+    :param rows: A list with an array of related fixed rows for each new row
+    :param alpha: The confidence of the observed relations
+    :param regularization: The regularization of the factors
+    :param gram: The product of the fixed factors by themselves, when it is already known
+    :return: A matrix with the factors of the new rows. Rows without relations get zeros.
+    """
+    fixed = np.asarray(fixed)
+    k = fixed.shape[1]
+    base = (np.dot(fixed.transpose(), fixed) if gram is None else gram) + regularization * np.eye(k)
+    result = np.zeros((len(rows), k), dtype=np.float32)
+    related = [i for i, r in enumerate(rows) if len(r) > 0]
+    for start in range(0, len(related), FOLD_IN_BATCH):
+        batch = related[start:start+FOLD_IN_BATCH]
+        a, b = np.empty((len(batch), k, k)), np.empty((len(batch), k, 1))
+        for j, i in enumerate(batch):
+            factors = fixed[rows[i]].astype(np.float64)
+            a[j] = np.dot(factors.transpose(), factors)
+            b[j, :, 0] = factors.sum(axis=0)
+        result[batch] = np.linalg.solve(base + alpha * a, (1. + alpha) * b)[:, :, 0]
+    return result
+
+
+def group_by(keys, values):
+    """
+    Group the values by key
+
+    >>> groups = group_by(np.array([2, 1, 2]), np.array([7, 8, 9]))
+    >>> print(sorted((k, v.tolist()) for k, v in groups.items()))
+    [(1, [8]), (2, [7, 9])]
+
+    :param keys: An array with the key of each value
+    :param values: An array of values
+    :return: A dictionary with an array of values by key
+    """
+    order = np.argsort(keys, kind="mergesort")
+    keys, values = keys[order], values[order]
+    unique, starts = np.unique(keys, return_index=True)
+    return dict(zip(unique.tolist(), np.split(values, starts[1:])))
+
+
 class TensorCoFi(PyTensorCoFi):
     """
     A creator of TensorCoFi models
@@ -530,43 +1133,86 @@ class TensorCoFi(PyTensorCoFi):
         return self.n_items
 
     def get_score(self, user, item):
-        factors = [Matrix.objects.filter(name="tensorcofi", model_id=0).order_by("-id")[0].numpy,
-                   Matrix.objects.filter(name="tensorcofi", model_id=1).order_by("-id")[0].numpy]
-        return np.dot(factors[0][self.data_map[self.get_user_column()][user]],
-                      factors[1][self.data_map[self.get_item_column()][item]].transpose())
+        generation = Generation.get_current()
+        return np.dot(UserMatrix.get_user_factors(generation, self.data_map[self.get_user_column()][user]),
+                      TensorCoFi.get_item_matrix(generation.items_id)[self.data_map[self.get_item_column()][item]])
 
     def get_recommendation(self, user, **context):
         """
-        Get the recommendation for this user
+        Get the recommendation for this user. The user and the item factors come from the same generation.
+        """
+        generation = Generation.get_current()
+        user_factors = UserMatrix.get_user_factors(generation, user.pk-1)
+        return np.dot(TensorCoFi.get_item_matrix(generation.items_id), user_factors)
+
+    def get_recommendations(self, users, **context):
         """
-        return self.get_not_mapped_recommendation(user.pk-1, **context)
+        Get the recommendation for many users with a single matrix product between their factors and the item
+        factors. The users folded in after the training take their factors from the delta. Users without factors in
+        the current generation (new users or users with less than 3 items) get an empty row and are marked as not
+        scored.
+
+        :param users: A list of users
+        :return: A matrix with a row of scores for each user and a boolean array with the users that were scored
+        """
+        generation = Generation.get_current()
+        items = TensorCoFi.get_item_matrix(generation.items_id)
+        scores = np.zeros((len(users), items.shape[0]), dtype=np.float32)
+        if generation.users_id is None:
+            return scores, np.zeros(len(users), dtype=bool)
+        user_matrix = Matrix.get_array(generation.users_id)
+        index = np.array([user.pk-1 for user in users], dtype=np.int64)
+        has_factors = np.array([user.pk <= user_matrix.shape[0] and user.has_more_than(2) for user in users],
+                               dtype=bool)
+        factors = np.zeros((len(users), items.shape[1]), dtype=np.float32)
+        factors[has_factors] = user_matrix[index[has_factors]]
+        if generation.users_delta_id is not None:
+            delta = UserMatrix.get_delta(generation.users_delta_id)
+            if len(delta) > 0:
+                position = np.minimum(np.searchsorted(delta["user"], index), len(delta)-1)
+                in_delta = delta["user"][position] == index
+                factors[in_delta] = delta["factors"][position[in_delta]]
+                has_factors |= in_delta
+        if has_factors.any():
+            scores[has_factors] = np.dot(factors[has_factors], items.transpose())
+        return scores, has_factors
 
     @staticmethod
     def load_to_cache():
-        try:
-            users = Matrix.objects.filter(name="tensorcofi", model_id=0).order_by("-id")[0]
-        except IndexError:
+        generation = Generation.get_current()
+        if generation.users_id is None:
             raise NotCached("TensorCoFi not in db")
 
-        for i, u in enumerate(users.numpy):
-        #with click.progressbar(enumerate(users.numpy),
-        #                       length=users.numpy.shape[0],
-        #                       label="Loading TensorCoFi users to cache") as bar:
-        #    for i, u in bar:
-                TensorCoFi.user_matrix[i] = u
-        TensorCoFi.get_item_matrix()
+        users = Matrix.get_array(generation.users_id)
+        owners = Inventory.objects.filter(is_dropped=False).values("user_id").annotate(count=models.Count("pk")) \
+            .filter(count__gt=2).values_list("user_id", flat=True)  # Users with static recommendation
+        UserMatrix.get_user_array.set_many({
+            (generation.users_id, user_id-1): users[user_id-1] for user_id in owners if user_id <= len(users)
+        })
+        TensorCoFi.get_item_matrix(generation.items_id)
 
     @staticmethod
-    @Cached()
-    def get_item_matrix():
-        try:
-            items = Matrix.objects.filter(name="tensorcofi", model_id=1).order_by("-id")[0]
-        except IndexError:
-            raise NotCached("tensocofi model not in db")
-        return items.numpy
+    def get_item_matrix(matrix_id=None):
+        """
+        Get the item factors. When there is a shared matrix directory the factors are mapped from there.
+
+        :param matrix_id: The item factors matrix id. Default is the one in the current generation.
+        """
+        if matrix_id is None:
+            matrix_id = Generation.get_current().items_id
+            if matrix_id is None:
+                raise NotCached("tensocofi model not in db")
+        if SHARED_MATRIX_DIR:
+            return Matrix.get_shared_array(matrix_id)
+        return TensorCoFi.load_item_matrix(matrix_id)
 
     @staticmethod
     @Cached()
+    def load_item_matrix(matrix_id):
+        return Matrix.objects.get(pk=matrix_id).numpy
+
+    @staticmethod
+    @Cached(single_flight=True)
     def get_model_from_cache(*args, **kwargs):
         tensor = TensorCoFi(n_users=User.objects.aggregate(max=models.Max("pk"))["max"],
                             n_items=Item.objects.aggregate(max=models.Max("pk"))["max"])
@@ -577,26 +1223,119 @@ class TensorCoFi(PyTensorCoFi):
     def get_model(*args, **kwargs):
         return TensorCoFi.get_model_from_cache(args, **kwargs).factors
 
-    @staticmethod
-    def train_from_db(*args, **kwargs):
+    @classmethod
+    def train_from_db(cls, *args, **kwargs):
         """
         Trains the model in to data base
         """
-        tensor = TensorCoFi(n_users=User.objects.aggregate(max=models.Max("pk"))["max"],
-                            n_items=Item.objects.aggregate(max=models.Max("pk"))["max"])
-        data = np.array(sorted([(u-1, i-1, 1) for u, i in Inventory.objects.all().values_list("user_id", "item_id")]))
-        return tensor.train(data)
+        tensor = cls(n_users=User.objects.aggregate(max=models.Max("pk"))["max"],
+                     n_items=Item.objects.aggregate(max=models.Max("pk"))["max"], **kwargs)
+        start = timezone.now()
+        users, items = get_inventory_arrays()
+        order = np.lexsort((items, users))
+        data = np.ones((len(order), 3), dtype=np.int32)
+        data[:, 0] = users[order] - 1
+        data[:, 1] = items[order] - 1
+        users, items = tensor.train(data)
+        # The inventory changes made while training are taken by the next fold in
+        Matrix.objects.filter(pk=users.pk).update(timestamp=start)
+        return users, items
+
+    @staticmethod
+    def fold_in_from_db(new_items=False):
+        """
+        Fold in the users whose inventory changed since the last training or fold in. Their factors are solved against
+        the current item factors and published as the users delta, together with the users of the last delta that
+        didn't change. The users matrix is not touched, so the workers keep their caches of the other users. With
+        new_items, the items newer than the item factors get factors from the users that own them first.
+
+        :param new_items: Fold in the new items too
+        :return: The new generation or None when there was nothing to fold in
+        """
+        start = timezone.now()
+        generation = Generation.get_current()
+        if generation.users_id is None:
+            raise NotCached("TensorCoFi not in db")
+        last = Matrix.objects.filter(pk=generation.users_delta_id or generation.users_id)
+        since = last.values_list("timestamp", flat=True)[0]
+        changed = [user_id for user_id, in InventoryChange.objects.filter(timestamp__gte=since).values_list("user_id")]
+        items, items_matrix = np.asarray(TensorCoFi.get_item_matrix(generation.items_id)), None
+        if new_items:
+            new_factors = TensorCoFi.fold_in_items(generation, items)
+            if new_factors is not None:
+                items = new_factors
+                items_matrix = Matrix(name="tensorcofi", model_id=1, numpy=items)
+        if not changed and items_matrix is None:
+            return None
+        owned = {}
+        for i in range(0, len(changed), 1000):
+            query = Inventory.objects.filter(user_id__in=changed[i:i+1000], is_dropped=False, item_id__lte=len(items))
+            pairs = np.array(list(query.values_list("user_id", "item_id").distinct()), dtype=np.int64).reshape(-1, 2)
+            owned.update(group_by(pairs[:, 0]-1, pairs[:, 1]-1))
+        index = sorted(user for user, user_items in owned.items() if len(user_items) > 2)
+        delta = np.zeros(len(index), dtype=[("user", np.int32), ("factors", np.float32, (items.shape[1],))])
+        delta["user"] = index
+        delta["factors"] = fold_in(items, [owned[user] for user in index])
+        if generation.users_delta_id is not None:
+            old = UserMatrix.get_delta(generation.users_delta_id)
+            delta = np.concatenate([old[~isin(old["user"], np.array(changed)-1)], delta])
+            delta = delta[np.argsort(delta["user"], kind="mergesort")]
+        with transaction.atomic():
+            if items_matrix is not None:
+                items_matrix.save()
+            users_delta = Matrix.objects.create(name="tensorcofi", model_id=2, numpy=delta)
+            # The inventory changes made while folding in are taken by the next one
+            Matrix.objects.filter(pk=users_delta.pk).update(timestamp=start)
+            generation = Generation.publish(users_delta=users_delta, items=items_matrix)
+            InventoryChange.remove_taken(generation)
+        return generation
+
+    @staticmethod
+    def fold_in_items(generation, items):
+        """
+        Get factors for the items that are newer than the item factors, from the factors of the users that own them
+
+        :param generation: The current generation
+        :param items: The current item factors
+        :return: The item factors with the new items or None when there are no new items
+        """
+        n_items = Item.objects.aggregate(max=models.Max("pk"))["max"] or 0
+        if n_items <= items.shape[0]:
+            return None
+        users = Matrix.get_array(generation.users_id)
+        delta = UserMatrix.get_delta(generation.users_delta_id) if generation.users_delta_id is not None else None
+        n_users = max(users.shape[0], int(delta["user"].max())+1 if delta is not None and len(delta) else 0)
+        fixed = np.zeros((n_users, items.shape[1]), dtype=np.float32)
+        fixed[:users.shape[0]] = users
+        if delta is not None:
+            fixed[delta["user"]] = delta["factors"]
+        query = Inventory.objects.filter(item_id__gt=items.shape[0], is_dropped=False)
+        pairs = np.array(list(query.values_list("item_id", "user_id").distinct()), dtype=np.int64).reshape(-1, 2)
+        pairs = pairs[pairs[:, 1] <= n_users]  # Only the users with factors
+        owners = group_by(pairs[:, 0]-1, pairs[:, 1]-1)
+        empty = np.zeros(0, dtype=np.int64)
+        return np.vstack([items, fold_in(fixed, [owners.get(i, empty) for i in range(items.shape[0], n_items)])])
 
     def train(self, data):
         """
         Trains the model in to data base
         """
         super(TensorCoFi, self).train(data)
-        users, items = super(TensorCoFi, self).get_model()
+        return TensorCoFi.publish_factors(*super(TensorCoFi, self).get_model())
+
+    @staticmethod
+    def publish_factors(users, items):
+        """
+        Save the user and the item factors and publish them in a new generation
+        :param users: The user factors
+        :param items: The item factors
+        :return: A tuple with the users and the items matrices
+        """
         users = Matrix(name="tensorcofi", model_id=0, numpy=users)
         users.save()
         items = Matrix(name="tensorcofi", model_id=1, numpy=items)
         items.save()
+        Generation.publish(users=users, items=items)
         return users, items
 
     @staticmethod
@@ -628,11 +1367,78 @@ def remove_user_from_tensorcofi_on_delete_user(sender, instance, using, *args, *
     del TensorCoFi.user_matrix[instance.pk-1]
 
 
+class PopularityCounter(object):
+    """
+    Counts the items acquired and removed in this process since the last push. A daemon thread pushes the counts to
+    the pending counts in database every POPULARITY_FLUSH_INTERVAL seconds. In each interval only the process that takes
+    the flush lease in the shared cache flushes the pending counts of all the processes to a new popularity generation.
+    The thread starts with the first count of the process.
+
+    >>> counter = PopularityCounter(interval=None)
+    >>> counter.add([2, 3, 3])
+    >>> counter.add(2, -1)
+    >>> print(counter.take().tolist(), counter.take().tolist())
+    [0, 0, 2] [0, 0, 0]
+    """
+
+    def __init__(self, interval=POPULARITY_FLUSH_INTERVAL):
+        self.interval = interval
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.lock = threading.Lock()
+        self.pid = None  # Process of the flush thread
+
+    def add(self, item_ids, value=1):
+        """
+        Count items
+        :param item_ids: An item id or a list of them
+        :param value: The value to add to each item. Negative for removals.
+        """
+        index = np.atleast_1d(np.asarray(item_ids, dtype=np.int64)) - 1
+        if len(index) == 0:
+            return
+        with self.lock:
+            if index.max() >= len(self.counts):
+                grown = np.zeros(max(index.max()+1, 2*len(self.counts)), dtype=np.int64)
+                grown[:len(self.counts)] = self.counts
+                self.counts = grown
+            np.add.at(self.counts, index, value)
+            if self.interval and self.pid != os.getpid():
+                self.pid = os.getpid()
+                thread = threading.Thread(target=self.work, name="popularity counter")
+                thread.daemon = True
+                thread.start()
+
+    def take(self):
+        """
+        Take the counts and start again from zero
+        :return: An array with the counts by item index (item id - 1)
+        """
+        with self.lock:
+            counts, self.counts = self.counts, np.zeros(len(self.counts), dtype=np.int64)
+        return counts
+
+    def work(self):
+        """
+        Flush the counts periodically
+        """
+        while True:
+            time.sleep(self.interval)
+            try:
+                Popularity.push_counter()
+                if get_cache("owned_items").add(POPULARITY_FLUSH_LEASE, os.getpid(), max(int(self.interval), 1)):
+                    Popularity.flush_counter()
+            except Exception:
+                logging.error(traceback.format_exc())
+
+
 class Popularity(TestFMPopularity):
     """
     Popularity connector for db and test.fm
     """
 
+    shared_models = {}  # Popularity models of this process over shared matrices by matrix id
+    counter = PopularityCounter()
+
     def __init__(self, n_items=None, *args, **kwargs):
 
         if not isinstance(n_items, int):
@@ -656,33 +1462,50 @@ class Popularity(TestFMPopularity):
 
     @property
     def recommendation(self):
-        return np.array(self.popularity_recommendation).astype(np.float32)
+        return np.array(self.popularity_recommendation, dtype=np.float32)
 
     @recommendation.setter
     def recommendation(self, value):
-        self.popularity_recommendation = value.tolist()
+        self.popularity_recommendation = value
         self._counts = {i+1: value[i] for i in xrange(self.n_items)}
 
     @staticmethod
-    @Cached()
-    def load_popularity():
+    @Cached(single_flight=True)
+    def load_popularity(matrix_id):
         model = Popularity(n_items=Item.objects.aggregate(max=models.Max("pk"))["max"])
-        pop = Matrix.objects.filter(name="popularity").order_by("-id")[0]
-        model.recommendation = pop.numpy
+        model.recommendation = Matrix.objects.get(pk=matrix_id).numpy
         return model
 
+    @staticmethod
+    def get_shared_model(matrix_id):
+        """
+        Get a popularity model over the memory map of the popularity matrix in the shared directory. The model is kept
+        in this process, so it is never pickled to cache.
+        :param matrix_id: The popularity matrix id
+        :return: A Popularity model
+        """
+        try:
+            return Popularity.shared_models[matrix_id]
+        except KeyError:
+            pop = Matrix.get_shared_array(matrix_id)
+            model = Popularity(n_items=len(pop))
+            model.popularity_recommendation = pop
+            Popularity.shared_models.clear()
+            Popularity.shared_models[matrix_id] = model
+            return model
+
     @staticmethod
     def load_to_cache():
-        model = Popularity(n_items=Item.objects.aggregate(max=models.Max("pk"))["max"])
-        pop = Matrix.objects.filter(name="popularity").order_by("-id")[0]
-        model.recommendation = pop.numpy
-        Popularity.load_popularity.lock_this(
-            Popularity.load_popularity.cache.set
-        )(Popularity.load_popularity.key(), model, Popularity.load_popularity.timeout)
+        Popularity.get_model()
 
     @staticmethod
     def get_model():
-        return Popularity.load_popularity()
+        matrix_id = Generation.get_current().popularity_id
+        if matrix_id is None:
+            raise NotCached("Popularity model not in db")
+        if SHARED_MATRIX_DIR:
+            return Popularity.get_shared_model(matrix_id)
+        return Popularity.load_popularity(matrix_id)
 
     def get_recommendation(self, user, **context):
         """
@@ -696,13 +1519,114 @@ class Popularity(TestFMPopularity):
         Train the popular model
         :return:
         """
-        popular_model = Popularity(n_items=Item.objects.aggregate(max=models.Max("pk"))["max"])
-        users, items = zip(*Inventory.objects.all().values_list("user_id", "item_id"))
-        data = pd.DataFrame({"item": items, "user": users})
-        popular_model.fit(data)
-        Matrix.objects.create(name="popularity", numpy=popular_model.recommendation)
+        n_items = Item.objects.aggregate(max=models.Max("pk"))["max"]
+        popular_model = Popularity(n_items=n_items)
+        _, items = get_inventory_arrays()
+        popular_model.recommendation = np.bincount(items-1, minlength=n_items)[:n_items].astype(np.float32)
+        Generation.publish(popularity=Matrix.objects.create(name="popularity", numpy=popular_model.recommendation))
     train_from_db = train
 
+    @staticmethod
+    def push_counter():
+        """
+        Add the counts of this process to the pending counts in database. The pending matrix is locked while it is
+        read and written, so the pushes of different processes don't lose each other counts.
+        :return: True when there were counts to push
+        """
+        counts = Popularity.counter.take()
+        if not counts.any():
+            return False
+        try:
+            with transaction.atomic():
+                try:
+                    pending = Matrix.objects.select_for_update().filter(name=POPULARITY_PENDING).order_by("id")[0]
+                except IndexError:
+                    Matrix.objects.create(name=POPULARITY_PENDING, numpy=counts.astype(np.float32))
+                else:
+                    total = np.zeros(max(len(pending.numpy), len(counts)), dtype=np.float32)
+                    total[:len(pending.numpy)] += pending.numpy
+                    total[:len(counts)] += counts
+                    pending.numpy = total
+                    pending.save()
+        except Exception:
+            Popularity.counter.add(np.flatnonzero(counts) + 1, counts[counts != 0])  # Count them in the next push
+            raise
+        return True
+
+    @staticmethod
+    def flush_counter():
+        """
+        Add the pending counts of all the processes and the counts of this process to the current popularity and
+        publish the result as a new generation. With POPULARITY_HALF_LIFE the current popularity decays by the time
+        since it was published, so the recent acquisitions weight more. The last generation is locked while the
+        popularity is read and written, so two flushes don't lose each other counts.
+
+        The old popularity matrices are removed, except the ones of the last POPULARITY_KEEP generations and of the
+        generations that a worker may still have as current (the ones published in the last GENERATION_REFRESH_INTERVAL
+        seconds and the last one before them). Only the generations that no worker can have as current are removed
+        with their matrices.
+        :return: The new generation or None when there was nothing to flush
+        """
+        Popularity.push_counter()
+        with transaction.atomic():
+            try:
+                last = Generation.objects.select_for_update().order_by("-id")[0]
+            except IndexError:
+                last = None
+            pending = list(Matrix.objects.select_for_update().filter(name=POPULARITY_PENDING))
+            if not pending:
+                return None
+            n_items = Item.objects.aggregate(max=models.Max("pk"))["max"] or 0
+            popularity = np.zeros(max([n_items] + [len(matrix.numpy) for matrix in pending]), dtype=np.float32)
+            if last is not None and last.popularity_id is not None:
+                current = Matrix.objects.get(pk=last.popularity_id)
+                size = min(len(current.numpy), len(popularity))
+                popularity[:size] = current.numpy[:size]
+                if POPULARITY_HALF_LIFE:
+                    elapsed = (timezone.now() - current.timestamp).total_seconds()
+                    popularity *= .5 ** (elapsed / POPULARITY_HALF_LIFE)
+            for matrix in pending:
+                popularity[:len(matrix.numpy)] += matrix.numpy
+            np.maximum(popularity, 0, out=popularity)
+            generation = Generation.publish(popularity=Matrix.objects.create(name="popularity", numpy=popularity))
+            Matrix.objects.filter(pk__in=[matrix.pk for matrix in pending]).delete()
+        generations = Generation.objects.order_by("-id").values_list("popularity_id", flat=True)
+        refresh = timezone.now() - timedelta(seconds=GENERATION_REFRESH_INTERVAL)
+        keep = set(generations[:POPULARITY_KEEP]) | set(generations.filter(timestamp__gte=refresh)) | \
+            set(generations.filter(timestamp__lt=refresh)[:1])
+        keep.discard(None)
+        Matrix.objects.filter(name="popularity", pk__lt=max(keep)).exclude(pk__in=keep).delete()
+        return generation
+
     @staticmethod
     def drop_cache():
-        get_cache("default").delete("load_popularity")
+        get_cache("default").delete(Popularity.load_popularity.key(Generation.get_current().popularity_id))
+
+
+def push_counter_on_exit():
+    """
+    Push the counts of this process that were not pushed yet when it exits
+    """
+    try:
+        Popularity.push_counter()
+    except Exception:
+        logging.error(traceback.format_exc())
+
+atexit.register(push_counter_on_exit)
+
+
+@receiver(post_save, sender=Inventory)
+def count_popularity_on_save(sender, instance, created, raw, using, update_fields, *args, **kwargs):
+    """
+    Count the new item in the live popularity
+    """
+    if created:
+        Popularity.counter.add(instance.item_id)
+
+
+@receiver(post_delete, sender=Inventory)
+def count_popularity_on_delete(sender, instance, using, *args, **kwargs):
+    """
+    Discount the removed item in the live popularity
+    """
+    Popularity.counter.add(instance.item_id, -1)
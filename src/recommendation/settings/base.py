@@ -10,6 +10,7 @@ https://docs.djangoproject.com/en/1.7/ref/recommendation.settings/
 """
 
 from __future__ import division, absolute_import, print_function
+import os
 from recommendation.settings import databases, caches, logs
 from recommendation.settings.contingency import CONTINGENCY_ITEMS
 
@@ -116,4 +117,73 @@ RECOMMENDATION_SETTINGS = {
 
 CONTINGENCY_ITEMS = CONTINGENCY_ITEMS
 
-RESPONSE_TIMEOUT = 1/3
\ No newline at end of file
+RESPONSE_TIMEOUT = 1/3
+CONTINGENCY_REFRESH = 600  # Seconds between the refreshes of the precomputed contingency recommendations
+CONTINGENCY_SIZE = 100
+
+# Seconds the hot lookups (item and user ids, owned items) are kept in each worker in front of the cache and the most
+# values kept for each of them. The changes made by other workers are seen after CACHE_LOCAL_TIMEOUT at most.
+
+CACHE_LOCAL_TIMEOUT = 5
+CACHE_LOCAL_SIZE = 100000
+
+# Seconds a worker waits for other worker or thread loading a slow cached value (models, genre matrix, locale index)
+# before loading it too.
+SINGLE_FLIGHT_WAIT = 10
+
+# Response cache
+
+RESPONSE_CACHE_TIMEOUT = 0  # Seconds a recommendation is given again to the same user. 0 turns it off.
+
+# Model storage
+
+MATRIX_COMPRESSION = 0  # zlib level (1-9) for the matrices stored in database. 0 stores them uncompressed.
+
+# Directory where the factor models are written to be memory mapped by all the workers. It should be a tmpfs like
+# /dev/shm. None keeps a copy of the models in the cache of each worker.
+SHARED_MATRIX_DIR = "/dev/shm/frappe" if os.path.isdir("/dev/shm") else None
+
+# Seconds between checks for a new generation of the models in each worker.
+GENERATION_REFRESH_INTERVAL = 60
+
+# Confidence of the owned items and regularization used to fold in users and items to the TensorCoFi factors.
+FOLD_IN_ALPHA = 40.
+FOLD_IN_REGULARIZATION = .05
+
+# Factors, iterations and processes of the ALS trainer (modelcrafter train als). None processes uses all the cpus.
+ALS_FACTORS = 20
+ALS_ITERATIONS = 5
+ALS_PROCESSES = None
+
+# Seconds between the pushes of the live popularity counts of each worker to the database. In each interval one worker,
+# the one that takes the lease in the owned_items cache, flushes the counts of all of them to a new popularity
+# generation. With a half life in seconds the popularity decays with time, so it follows the trends. None keeps all the
+# counts forever.
+POPULARITY_FLUSH_INTERVAL = 300
+POPULARITY_HALF_LIFE = None
+
+# Latency histograms of each stage of the recommendation, published by each worker every METRICS_INTERVAL seconds to
+# METRICS_CACHE, that must be shared by all the workers. Off the stages are not wrapped at all. See python manage.py
+# metrics and /api/v2/metrics/.
+METRICS = False
+METRICS_INTERVAL = 60
+METRICS_CACHE = "owned_items"
+
+# The hits, misses, miss latency and bytes of each cached function are in the metrics too (python manage.py
+# cachemetrics). The health check fails when a function with more than CACHE_MIN_CALLS calls has a lower hit ratio.
+CACHE_MIN_HIT_RATIO = .5
+CACHE_MIN_CALLS = 1000
+
+# Seconds between the writes of the queued logs of each worker and the most logs kept in the queue. The logs that
+# don't fit in the queue are dropped and counted in the metrics as logging.dropped.
+LOGGER_FLUSH_INTERVAL = 1.
+LOGGER_QUEUE_SIZE = 100000
+
+# Number of candidates of each user stored by the precompute command.
+PRECOMPUTED_SIZE = 200
+
+# Approximate nearest neighbour retrieval over the item factors. When on, only the items in the ANN_PROBES clusters
+# closer to the user are scored. ANN_CLUSTERS None uses the square root of the number of items.
+ANN_INDEX = False
+ANN_CLUSTERS = None
+ANN_PROBES = 8
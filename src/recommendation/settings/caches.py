@@ -12,10 +12,11 @@ __author__ = "joaonrb"
 
 
 LOCAL = {
-    "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    "BACKEND": "recommendation.cache.ObjectCache",
     "LOCATION": "django_default_cache",
     "OPTIONS": {
-        "MAX_ENTRIES": 10000000
+        "MAX_ENTRIES": 10000000,
+        "MAX_BYTES": 2 * 1024 ** 3  # Arrays are kept without copies, so this is the memory they take in the process
     }
 }
 
@@ -20,4 +20,6 @@ DATABASES = {
 
 CACHES["owned_items"] = caches.LOCAL
 
+SHARED_MATRIX_DIR = None
+
 TEST_RUNNER = "django_nose.NoseTestSuiteRunner"
\ No newline at end of file
@@ -9,9 +9,12 @@ from django.core.wsgi import get_wsgi_application
 
 application = get_wsgi_application()
 
+import logging
+import traceback
 from threading import Thread
 from django.conf import settings
 from recommendation.models import Item, User, TensorCoFi, Popularity
+from recommendation.core import get_controller
 
 
 def load_rest():
@@ -20,6 +23,9 @@ def load_rest():
     # Load main models
     Popularity.load_to_cache()
     TensorCoFi.load_to_cache()
+    if getattr(settings, "ANN_INDEX", False):
+        from recommendation.ann import IVFIndex
+        IVFIndex.load_to_cache()
     if "recommendation.language" in settings.INSTALLED_APPS:
         from recommendation.language.models import Region
         Region.load_to_cache()
@@ -27,6 +33,10 @@ def load_rest():
         from recommendation.diversity.models import ItemGenre, Genre
         Genre.load_to_cache()
         ItemGenre.load_to_cache()
+    try:
+        get_controller().load_contingency()
+    except Exception:
+        logging.error(traceback.format_exc())  # The workers start with the contingency items
 
 
 # Load user and items
@@ -5,14 +5,106 @@ A decorator to register events into log. Created on Fev 11, 2014
 """
 
 from __future__ import division, absolute_import, print_function
+import os
+import atexit
 import logging
+import threading
 import traceback
+from collections import deque
+from django.conf import settings
+from recommendation.models import ResponseCache
 from recommendation.simple_logging.models import LogEntry
 from recommendation.decorators import ILogger
+from recommendation.metrics import timed, count
 import functools
 
 __author__ = "joaonrb"
 
+LOGGER_FLUSH_INTERVAL = \
+    None if int(os.environ.get("FRAPPE_TEST", 0)) else getattr(settings, "LOGGER_FLUSH_INTERVAL", 1.)
+LOGGER_QUEUE_SIZE = getattr(settings, "LOGGER_QUEUE_SIZE", 100000)  # Logs waiting for the flush in each process
+LOGGER_BATCH_SIZE = 1000  # Logs written in each insert
+
+
+class LogWriter(object):
+    """
+    Queue of the logs to write in the database. A daemon thread writes them in batches every LOGGER_FLUSH_INTERVAL
+    seconds, or sooner when a full batch is waiting, and the logs left are written when the process exits. The queue
+    keeps up to LOGGER_QUEUE_SIZE logs and the logs that don't fit are dropped and counted in the metrics as
+    logging.dropped. Without interval the logs are written at once.
+
+    The logs only get their timestamp when they are written, so they can be late up to the flush interval. The logs
+    in cache used by the filters are updated at once by LogEvent.
+    """
+
+    def __init__(self, interval=LOGGER_FLUSH_INTERVAL, size=LOGGER_QUEUE_SIZE):
+        self.interval = interval
+        self.size = size
+        self.queue = deque()
+        self.lock = threading.Lock()
+        self.full_batch = threading.Event()
+        self.pid = None  # Process of the flush thread
+
+    def put(self, logs):
+        """
+        Queue logs to write
+        :param logs: A list of LogEntry
+        """
+        if not self.interval:
+            LogEntry.objects.bulk_create(logs)
+            return
+        with self.lock:
+            dropped = len(logs) - (self.size - len(self.queue))
+            if dropped > 0:
+                logs = logs[:len(logs)-dropped]
+            self.queue.extend(logs)
+            if len(self.queue) >= LOGGER_BATCH_SIZE:
+                self.full_batch.set()
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                thread = threading.Thread(target=self.work, name="log writer")
+                thread.daemon = True
+                thread.start()
+        if dropped > 0:
+            count("logging.dropped", dropped)
+            logging.warning("Log queue is full. %d logs were dropped" % dropped)
+
+    def take(self, size=LOGGER_BATCH_SIZE):
+        """
+        Take logs from the queue
+        :param size: The maximum number of logs to take
+        :return: A list of LogEntry
+        """
+        with self.lock:
+            return [self.queue.popleft() for _ in range(min(size, len(self.queue)))]
+
+    @timed("logging.flush")
+    def flush(self):
+        """
+        Write all the logs in the queue. When a batch fails it is dropped, so a bad log don't block the others.
+        """
+        logs = self.take()
+        while logs:
+            try:
+                LogEntry.objects.bulk_create(logs)
+            except Exception:
+                logging.error(traceback.format_exc())
+                count("logging.dropped", len(logs))
+            logs = self.take()
+
+    def work(self):
+        """
+        Flush the logs periodically
+        """
+        while True:
+            self.full_batch.wait(self.interval)
+            self.full_batch.clear()
+            self.flush()
+
+
+writer = LogWriter()
+atexit.register(writer.flush)
+
 
 class LogEvent(ILogger):
     """
@@ -32,15 +124,15 @@ class LogEvent(ILogger):
         else:
             self.do_call = self.std
 
-    #@ExecuteInBackground()
+    @timed("logging")
     def bulk_load(self, user, recommendation):
         try:
             new_logs = [
                 LogEntry(user=user, item_id=iid, type=self.log_type, value=i)
                 for i, iid in enumerate(recommendation, start=1)
             ]
-            LogEntry.objects.bulk_create(new_logs)
             LogEntry.add_logs(user, new_logs)
+            writer.put(new_logs)
         except Exception:
             logging.error(logging.error(traceback.format_exc()))
         else:
@@ -63,10 +155,10 @@ class LogEvent(ILogger):
         def decorated(*args, **kwargs):
             user, item = args[0], args[1]
             result = function(*args, **kwargs)
-            #GoToThreadQueue()(
-            #    LogEntry.objects.create
-            #)(user_id=uid, item=Item.get_item_by_external_id(iid], type=self.log_type)
-            LogEntry.objects.create(user=user, item=item, type=self.log_type)
+            log = LogEntry(user=user, item=item, type=self.log_type)
+            LogEntry.get_logs_for.lock_this(LogEntry.add_logs)(user, [log])  # The writer sends no post_save
+            ResponseCache.drop(user.pk)
+            writer.put([log])
             return result
         return decorated
 
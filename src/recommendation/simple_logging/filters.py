@@ -7,7 +7,8 @@ Log based re-ranker. I reads the logs from this user and re-rank items from the
 """
 
 from __future__ import division, absolute_import, print_function
-from recommendation.simple_logging.models import LogEntry
+import numpy as np
+from recommendation.simple_logging.models import LogEntry, LOG_DTYPE
 
 __author__ = "joaonrb"
 
@@ -27,31 +28,47 @@ class SimpleLogFilter(object):
     way the changes will be smother.
 
     """
-    points = (
-        lambda x, n: (x.value-n)/2.,  # LogEntry.RECOMMEND
-        lambda x, n: 0,  # LogEntry.CLICK_RECOMMENDED
-        lambda x, n: 0,  # LogEntry.INSTALL
-        lambda x, n: -10,  # LogEntry.REMOVE
-        lambda x, n: 3,  # LogEntry.CLICK
-    )
+    points = np.array([
+        0.,  # LogEntry.RECOMMEND gets (value-n)/2
+        0.,  # LogEntry.CLICK_RECOMMENDED
+        0.,  # LogEntry.INSTALL
+        -10.,  # LogEntry.REMOVE
+        3.,  # LogEntry.CLICK
+    ])
 
     @staticmethod
-    def evaluate(log, n):
-        return SimpleLogFilter.points[log.type](log, n)
+    def evaluate(logs, n):
+        """
+        Points of each log
+
+        >>> logs = np.array([(1, LogEntry.RECOMMEND, 2.), (1, LogEntry.REMOVE, np.nan)], dtype=LOG_DTYPE)
+        >>> print(SimpleLogFilter.evaluate(logs, 4).tolist())
+        [-1.0, -10.0]
+
+        :param logs: An array of logs as given by LogEntry.get_logs_for
+        :param n: The size of the recommendation
+        :return: An array with the points of each log
+        """
+        return np.where(logs["type"] == LogEntry.RECOMMEND, (logs["value"]-n)/2., SimpleLogFilter.points[logs["type"]])
 
     def __call__(self, user, recommendation, size=4, **kwargs):
         """
         Calculate the new rank based on logs
         """
         logs = LogEntry.get_logs_for(user.pk)
-        #m = recommendation.mean()
-        #print m
-        #rec = {v: k for k, v in enumerate(recommendation, start=1)}
-        for log in logs:
-            try:
-                recommendation[log.item_id-1] += (self.evaluate(log, size) * 0.01)
-            except IndexError:
-                pass
+        items = logs["item"].astype(np.int64) - 1
+        inside = items < len(recommendation)
+        np.add.at(recommendation, items[inside], self.evaluate(logs[inside], size) * 0.01)
         return recommendation
 
+    def batch(self, users, recommendations, size=4, **kwargs):
+        """
+        Calculate the new rank of many users with one read of the logs
+        """
+        for i, logs in enumerate(LogEntry.get_logs_for.get_many([user.pk for user in users])):
+            items = logs["item"].astype(np.int64) - 1
+            inside = items < recommendations.shape[1]
+            np.add.at(recommendations[i], items[inside], self.evaluate(logs[inside], size) * 0.01)
+        return recommendations
+
 
@@ -9,19 +9,21 @@ Models for the logging system
 
 from __future__ import division, absolute_import, print_function
 import os
+import numpy as np
 from django.conf import settings
 from django.utils.translation import ugettext as _
 from django.contrib.admin import site
 from django.db import models
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from recommendation.models import Item, User
-from recommendation.decorators import Cached
+from recommendation.models import Item, User, ResponseCache
+from recommendation.decorators import Cached, CACHE_BATCH_SIZE
 
 __author__ = "joaonrb"
 
 
 LOGGER_MAX_LOGS = 10 if int(os.environ.get("FRAPPE_TEST", 0)) else getattr(settings, "LOGGER_MAX_LOGS", 50)
+LOG_DTYPE = np.dtype([("item", np.int32), ("type", np.int8), ("value", np.float32)])  # Logs of a user in cache
 
 
 class LogEntry(models.Model):
@@ -73,14 +75,39 @@ class LogEntry(models.Model):
     @Cached()
     def get_logs_for(user_id):
         """
-        Get the user ids
+        Get the last logs of the user, from the newest, as an array with the fields item (the item id), type and value
         """
-        return list(LogEntry.objects.filter(user_id=user_id).order_by("-timestamp")[:LOGGER_MAX_LOGS])
+        return LogEntry.read_logs(user_id)
+
+    @staticmethod
+    def read_logs(user_id):
+        """
+        Read the last logs of the user from the database
+        """
+        return LogEntry.to_array(LogEntry.objects.filter(user_id=user_id).order_by("-timestamp")
+                                 .values_list("item_id", "type", "value")[:LOGGER_MAX_LOGS])
+
+    @staticmethod
+    def to_array(logs):
+        """
+        Pack logs in an array. Logs without value get NaN.
+
+        >>> print(LogEntry.to_array([(3, LogEntry.RECOMMEND, 1.), (5, LogEntry.CLICK, None)])["item"].tolist())
+        [3, 5]
+
+        :param logs: An iterable of tuples (item id, type, value)
+        :return: An array of LOG_DTYPE
+        """
+        return np.array([(item_id, log_type, np.nan if value is None else value) for item_id, log_type, value in logs],
+                        dtype=LOG_DTYPE)
 
     @staticmethod
     def load_to_cache():
-        for user in User.objects.all():
-            LogEntry.load_user(user)
+        users = list(User.objects.all().values_list("pk", flat=True))
+        for start in range(0, len(users), CACHE_BATCH_SIZE):
+            LogEntry.get_logs_for.set_many({
+                user_id: LogEntry.read_logs(user_id) for user_id in users[start:start+CACHE_BATCH_SIZE]
+            })
 
     @staticmethod
     def load_user(user):
@@ -89,16 +116,14 @@ class LogEntry(models.Model):
         """
         LogEntry.get_logs_for.lock_this(
             LogEntry.get_logs_for.cache.set
-        )(LogEntry.get_logs_for.key(user.pk),
-          list(LogEntry.objects.filter(user=user).order_by("-timestamp")[:LOGGER_MAX_LOGS]),
-          LogEntry.get_logs_for.timeout)
+        )(LogEntry.get_logs_for.key(user.pk), LogEntry.read_logs(user.pk), LogEntry.get_logs_for.timeout)
 
     @staticmethod
     def add_logs(user, logs):
         cache = LogEntry.get_logs_for.cache
         k = LogEntry.get_logs_for.key(user.pk)
         old_logs = LogEntry.get_logs_for(user.pk)
-        logs = logs + old_logs
+        logs = np.concatenate((LogEntry.to_array((log.item_id, log.type, log.value) for log in logs), old_logs))
         cache.set(k, logs[:LOGGER_MAX_LOGS], None)
 
 
@@ -106,9 +131,12 @@ class LogEntry(models.Model):
 @LogEntry.get_logs_for.lock_this
 def add_log_to_cache(sender, instance, created, raw, using, update_fields, *args, **kwargs):
     """
-    Add log to cache upon creation
+    Add log to cache upon creation. Other logs than the recommendations may change the next recommendation, so the
+    cached recommendations of the user are dropped.
     """
     LogEntry.add_logs(instance.user, [instance])
+    if instance.type != LogEntry.RECOMMEND:
+        ResponseCache.drop(instance.user_id)
 
 
 @receiver(post_delete, sender=User)
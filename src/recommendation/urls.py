@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 from django.conf.urls import patterns, include, url
 from health_check.plugins import plugin_dir
-from recommendation.backends import CheckDefaultCacheBackend, CheckOwnedItemsCacheBackend, CheckDatabaseCacheBackend
+from recommendation.backends import CheckDefaultCacheBackend, CheckOwnedItemsCacheBackend, CheckDatabaseCacheBackend, \
+    CheckCacheHitRatio
 #from django.contrib import admin
 #admin.autodiscover()
 
@@ -9,6 +10,7 @@ from recommendation.backends import CheckDefaultCacheBackend, CheckOwnedItemsCac
 plugin_dir.register(CheckDatabaseCacheBackend)
 plugin_dir.register(CheckDefaultCacheBackend)
 plugin_dir.register(CheckOwnedItemsCacheBackend)
+plugin_dir.register(CheckCacheHitRatio)
 
 urlpatterns = patterns(
     "",
@@ -40,4 +40,11 @@ if "recommendation.language" in settings.INSTALLED_APPS:
 if "recommendation.diversity" in settings.INSTALLED_APPS:
     from recommendation.diversity.models import ItemGenre, Genre
     Genre.load_to_cache()
-    ItemGenre.load_to_cache()
\ No newline at end of file
+    ItemGenre.load_to_cache()
+import logging
+import traceback
+from recommendation.core import get_controller
+try:
+    get_controller().load_contingency()
+except Exception:
+    logging.error(traceback.format_exc())  # The workers start with the contingency items
@@ -0,0 +1,56 @@
+#! -*- encoding: utf-8 -*-
+"""
+This test package test the approximate nearest neighbour index over the item factors.
+"""
+__author__ = "joaonrb"
+
+import numpy as np
+from django.test import TestCase
+from recommendation.ann import IVFIndex
+
+
+class TestIVFIndex(TestCase):
+    """
+    Test suite for the inverted file index
+
+    Must test:
+        - Every item is in one cluster
+        - All clusters give the exact scores
+        - Minimum number of candidates
+    """
+
+    factors = None
+
+    @classmethod
+    def setup_class(cls, *args, **kwargs):
+        """
+        Setup the item factors
+        """
+        cls.factors = np.random.RandomState(0).normal(size=(500, 10)).astype(np.float32)
+
+    def test_items_in_clusters(self):
+        """
+        [recommendation.ann.IVFIndex] Test every item is in one cluster
+        """
+        index = IVFIndex(self.factors)
+        assert sorted(index.order) == list(range(len(self.factors))), "Items are missing or repeated in the index"
+        assert index.offsets[-1] == len(self.factors), "Clusters don't cover all items"
+
+    def test_all_clusters_are_exact(self):
+        """
+        [recommendation.ann.IVFIndex] Test search in all clusters gives the exact scores
+        """
+        index = IVFIndex(self.factors)
+        user = self.factors[0]
+        candidates, result = index.get_recommendation(user, probes=index.n_clusters)
+        assert len(candidates) == len(self.factors), "Not all items are candidates (%d)" % len(candidates)
+        assert np.allclose(result, np.dot(self.factors, user), atol=1e-4), "Scores are not the exact ones"
+
+    def test_minimum_candidates(self):
+        """
+        [recommendation.ann.IVFIndex] Test search takes more clusters when they don't have enough items
+        """
+        index = IVFIndex(self.factors)
+        candidates, result = index.get_recommendation(self.factors[0], probes=1, size=100)
+        assert len(candidates) >= 100, "Only %d candidates for a minimum of 100" % len(candidates)
+        assert np.all(result[candidates] > -np.inf), "Candidates without score"
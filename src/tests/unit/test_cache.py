@@ -0,0 +1,127 @@
+#! -*- encoding: utf-8 -*-
+"""
+This test package test the cache backend in the memory of the process.
+"""
+__author__ = "joaonrb"
+
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+from django.test import TestCase
+from recommendation.cache import ObjectCache, freeze
+
+
+class TestObjectCache(TestCase):
+    """
+    Test the object cache
+
+    Must test:
+        - The least recently used values are dropped when the cache is over the bytes
+        - The values expire after the timeout
+        - Delete and clear free the bytes
+        - The values that are not arrays or immutable are pickled
+        - The arrays are kept without copy and read only, without changing the array of the caller
+        - The memory maps are kept as views without copy
+    """
+
+    @classmethod
+    def setup_class(cls, *args, **kwargs):
+        cls.array_bytes = freeze(np.zeros(1000))[1]
+        cls.cache = ObjectCache("test_object_cache", {
+            "OPTIONS": {"MAX_ENTRIES": 100, "MAX_BYTES": cls.array_bytes * 5 // 2}
+        })
+        cls.folder = tempfile.mkdtemp()
+
+    @classmethod
+    def teardown_class(cls, *args, **kwargs):
+        cls.cache.clear()
+        shutil.rmtree(cls.folder)
+
+    def setUp(self):
+        self.cache.clear()
+
+    def test_lru_by_bytes(self):
+        """
+        [recommendation.cache.ObjectCache] Test the least recently used values are dropped when over the bytes
+        """
+        self.cache.set("a", np.zeros(1000))
+        self.cache.set("b", np.ones(1000))
+        assert self.cache.get("a") is not None, "Value was dropped before the cache was full"
+        self.cache.set("c", np.ones(1000))
+        assert self.cache.get("b") is None, "Least recently used value was not dropped"
+        assert self.cache.get("a") is not None and self.cache.get("c") is not None, "Recently used value was dropped"
+        entries, size = self.cache.size()
+        assert entries == 2 and size <= self.array_bytes * 5 // 2, "Cache is over its bytes (%d)" % size
+
+    def test_timeout(self):
+        """
+        [recommendation.cache.ObjectCache] Test the values expire after the timeout
+        """
+        self.cache.set("expires", np.zeros(10), timeout=.05)
+        self.cache.set("stays", np.zeros(10))
+        assert self.cache.has_key("expires"), "Value expired before the timeout"
+        time.sleep(.1)
+        assert self.cache.get("expires") is None, "Value didn't expire"
+        assert not self.cache.has_key("expires"), "Expired value is still in cache"
+        assert self.cache.get("stays") is not None, "Value without timeout expired"
+
+    def test_delete_and_clear(self):
+        """
+        [recommendation.cache.ObjectCache] Test delete and clear remove the values and free the bytes
+        """
+        self.cache.set("a", np.zeros(1000))
+        self.cache.set("b", 1)
+        self.cache.delete("a")
+        assert self.cache.get("a") is None, "Deleted value is still in cache"
+        assert self.cache.size()[1] == freeze(1)[1], "Bytes of the deleted value were not freed"
+        self.cache.clear()
+        assert self.cache.size() == (0, 0), "Cache is not empty after clear"
+
+    def test_pickled_fallback(self):
+        """
+        [recommendation.cache.ObjectCache] Test the mutable values are pickled
+        """
+        self.cache.set("list", [1, 2, 3])
+        value = self.cache.get("list")
+        value.append(4)
+        assert self.cache.get("list") == [1, 2, 3], "Changing the value changed the cache"
+        assert self.cache.get("list") is not self.cache.get("list"), "Pickled value was not loaded in each read"
+
+    def test_array_without_copy(self):
+        """
+        [recommendation.cache.ObjectCache] Test the arrays are read only and kept by reference
+        """
+        array = np.arange(10)
+        self.cache.set("array", array)
+        cached = self.cache.get("array")
+        assert array.flags.writeable, "Array of the caller was made read only"
+        assert cached is self.cache.get("array"), "Array was copied in the read"
+        assert not np.may_share_memory(cached, array), "Cache shares the memory of a writable array"
+        try:
+            cached[0] = 1
+        except ValueError:
+            pass
+        else:
+            assert False, "Array in cache is writable"
+        read_only = np.arange(10)
+        read_only.setflags(write=False)
+        self.cache.set("read only", read_only)
+        assert self.cache.get("read only") is read_only, "Read only array was copied"
+
+    def test_memmap_without_copy(self):
+        """
+        [recommendation.cache.ObjectCache] Test the memory maps are kept as views of the same file
+        """
+        path = os.path.join(self.folder, "matrix.npy")
+        np.save(path, np.arange(100, dtype=np.float32))
+        mapped = np.load(path, mmap_mode="r")
+        self.cache.set("mapped", mapped)
+        assert self.cache.get("mapped") is mapped, "Read only memory map was copied"
+        writable = np.load(path, mmap_mode="r+")
+        self.cache.set("writable", writable)
+        cached = self.cache.get("writable")
+        assert isinstance(cached, np.memmap) and np.may_share_memory(cached, writable), "Memory map was copied"
+        assert not cached.flags.writeable and writable.flags.writeable, "Only the memory map in cache must be read only"
+        assert self.cache.size()[1] < 2 * freeze(np.zeros(100, dtype=np.float32))[1], "Memory map bytes were counted"
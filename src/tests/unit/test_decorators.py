@@ -0,0 +1,262 @@
+#! -*- encoding: utf-8 -*-
+"""
+This test package test the decorators of the recommendation.
+"""
+__author__ = "joaonrb"
+
+import os
+import time
+import threading
+from django.test import TestCase
+from django.core.cache import get_cache
+from recommendation import metrics
+from recommendation.decorators import ContingencyProtocol, LocalCache, Cached, check_deadline
+
+
+class SlowController(object):
+    """
+    Controller with a stage that sleeps or raises
+    """
+
+    def __init__(self, sleep=0., error=False):
+        self.sleep, self.error = sleep, error
+
+    def load_contingency(self):
+        pass
+
+    def get_contingency_recommendation(self, user, n=10):
+        return ["contingency"] * n
+
+    @ContingencyProtocol(budget=.05)
+    def get_recommendation(self, user, n=10):
+        time.sleep(self.sleep)
+        check_deadline()
+        if self.error:
+            raise ValueError("Stage failed")
+        return ["recommended"] * n
+
+
+class TestContingencyProtocol(TestCase):
+    """
+    Test the latency budget of the recommendation
+
+    Must test:
+        - A recommendation in the budget is given as it is
+        - A recommendation over the budget gives the contingency recommendation
+        - A recommendation that fails gives the contingency recommendation
+    """
+
+    @staticmethod
+    def fallbacks(reason):
+        histogram = metrics.histograms.get("contingency.%s" % reason)
+        return histogram.count if histogram else 0
+
+    def test_in_budget(self):
+        """
+        [recommendation.decorators.ContingencyProtocol] Test a recommendation in the budget is not replaced
+        """
+        before = self.fallbacks("timeout"), self.fallbacks("error")
+        assert SlowController().get_recommendation("user", 3) == ["recommended"] * 3, "Recommendation was replaced"
+        assert (self.fallbacks("timeout"), self.fallbacks("error")) == before, "Fallback recorded without fallback"
+
+    def test_timeout(self):
+        """
+        [recommendation.decorators.ContingencyProtocol] Test a recommendation over the budget is replaced
+        """
+        before = self.fallbacks("timeout")
+        result = SlowController(sleep=.1).get_recommendation("user", 3)
+        assert result == ["contingency"] * 3, "Recommendation over the budget was not replaced"
+        assert self.fallbacks("timeout") == before + 1, "Timeout was not recorded in the metrics"
+
+    def test_error(self):
+        """
+        [recommendation.decorators.ContingencyProtocol] Test a recommendation that fails is replaced
+        """
+        before = self.fallbacks("error")
+        result = SlowController(error=True).get_recommendation("user", 3)
+        assert result == ["contingency"] * 3, "Recommendation that failed was not replaced"
+        assert self.fallbacks("error") == before + 1, "Error was not recorded in the metrics"
+
+    def test_deadline_cleared(self):
+        """
+        [recommendation.decorators.ContingencyProtocol] Test the deadline doesn't last after the recommendation
+        """
+        SlowController(sleep=.1).get_recommendation("user", 3)
+        time.sleep(.06)
+        check_deadline()
+
+
+class TestLocalCache(TestCase):
+    """
+    Test the cache in the process in front of the Django cache
+
+    Must test:
+        - The local values are bounded by size and the least recently used are dropped
+        - The local values expire after local_timeout and the cache is read again
+        - A delete through the local cache drops the local value and the next call loads it again
+        - A delete made by other process is seen after local_timeout
+    """
+
+    @classmethod
+    def setup_class(cls, *args, **kwargs):
+        get_cache("default").clear()
+
+    @classmethod
+    def teardown_class(cls, *args, **kwargs):
+        get_cache("default").clear()
+
+    def test_size(self):
+        """
+        [recommendation.decorators.LocalCache] Test the local values are bounded by the size
+        """
+        cache = LocalCache(get_cache("default"), size=2, local_timeout=60)
+        for i in range(3):
+            cache.set("local_size_%d" % i, i)
+        cache.get("local_size_1")
+        cache.set("local_size_3", 3)
+        assert list(cache.entries) == ["local_size_1", "local_size_3"], \
+            "Least recently used values were not dropped (%s)" % list(cache.entries)
+        assert cache.get("local_size_0") == 0, "Value dropped from the process was not read from the cache"
+        assert len(cache.entries) == 2, "Local cache is over its size"
+
+    def test_local_timeout(self):
+        """
+        [recommendation.decorators.LocalCache] Test the local values expire after local_timeout
+        """
+        cache = LocalCache(get_cache("default"), size=10, local_timeout=.05)
+        cache.set("local_timeout", 1)
+        get_cache("default").set("local_timeout", 2)  # Changed by other process
+        assert cache.get("local_timeout") == 1, "Local value was not used"
+        time.sleep(.1)
+        assert cache.get("local_timeout") == 2, "Local value was used after local_timeout"
+
+    def test_invalidation(self):
+        """
+        [recommendation.decorators.Cached] Test a delete through the local cache loads the value again
+        """
+        loads = []
+        cached = Cached()
+        cached.cache = LocalCache(cached.cache, size=10, local_timeout=60)
+
+        @cached
+        def load_value(value):
+            loads.append(value)
+            return value * 2
+        assert load_value(1) == 2 and load_value(1) == 2, "Value was not cached"
+        assert loads == [1], "Value was loaded %d times" % len(loads)
+        load_value.lock_this(load_value.cache.delete)(load_value.key(1))
+        assert "load_value_1" not in load_value.cache.entries, "Delete didn't drop the local value"
+        assert load_value(1) == 2 and loads == [1, 1], "Value was not loaded again after the delete"
+
+    def test_delete_by_other_process(self):
+        """
+        [recommendation.decorators.LocalCache] Test a delete made by other process is seen after local_timeout
+        """
+        cache, other = [LocalCache(get_cache("default"), size=10, local_timeout=.05) for _ in range(2)]
+        cache.set("local_other", 1)
+        assert other.get("local_other") == 1, "Value is not shared in the cache"
+        cache.delete("local_other")
+        assert cache.get("local_other") is None, "Local value was used after the delete"
+        time.sleep(.1)
+        assert other.get("local_other") is None, "Value deleted by other process was used after local_timeout"
+
+
+class TestSingleFlight(TestCase):
+    """
+    Test the single flight load of the missing values
+
+    Must test:
+        - Many threads missing the same value load it once
+        - A caller waits for the value of other process that has the lease
+        - A caller loads the value when the lease of other process is dropped or expires
+        - A load that fails doesn't leave the lease or the flight behind
+    """
+
+    @classmethod
+    def setup_class(cls, *args, **kwargs):
+        get_cache("default").clear()
+
+    @classmethod
+    def teardown_class(cls, *args, **kwargs):
+        get_cache("default").clear()
+
+    @staticmethod
+    def slow_function(loads, sleep=.1, error=False):
+        """
+        Build a single flight function that sleeps and counts its loads
+        """
+        @Cached(single_flight=True)
+        def slow_value(value):
+            loads.append(value)
+            time.sleep(sleep)
+            if error:
+                raise ValueError("Load failed")
+            return value * 2
+        return slow_value
+
+    def test_threads(self):
+        """
+        [recommendation.decorators.Cached] Test many threads missing the same value load it once
+        """
+        loads, results = [], []
+        slow_value = self.slow_function(loads)
+        threads = [threading.Thread(target=lambda: results.append(slow_value(1))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert loads == [1], "Value was loaded %d times" % len(loads)
+        assert results == [2] * 8, "Callers got different values (%s)" % results
+
+    def test_wait_for_lease(self):
+        """
+        [recommendation.decorators.Cached] Test a caller waits for the value loaded by the holder of the lease
+        """
+        loads = []
+        slow_value = self.slow_function(loads)
+        key = slow_value.key(2)
+        slow_value.cache.add("lease_%s" % key, os.getpid(), 10)
+        timer = threading.Timer(.1, lambda: slow_value.cache.set(key, 4))
+        timer.start()
+        try:
+            assert slow_value(2) == 4, "Caller didn't get the value of the holder of the lease"
+        finally:
+            timer.join()
+            slow_value.cache.delete("lease_%s" % key)
+        assert loads == [], "Value was loaded while other process had the lease"
+
+    def test_lease_dropped(self):
+        """
+        [recommendation.decorators.Cached] Test a caller loads the value when the lease is dropped or expires
+        """
+        loads = []
+        slow_value = self.slow_function(loads, sleep=0)
+        slow_value.cache.add("lease_%s" % slow_value.key(3), os.getpid(), 10)
+        timer = threading.Timer(.1, lambda: slow_value.cache.delete("lease_%s" % slow_value.key(3)))
+        timer.start()
+        start = time.time()
+        assert slow_value(3) == 6, "Value was not loaded after the lease was dropped"
+        timer.join()
+        slow_value.cache.add("lease_%s" % slow_value.key(4), os.getpid(), .1)
+        assert slow_value(4) == 8, "Value was not loaded after the lease expired"
+        assert loads == [3, 4], "Values were loaded %d times" % len(loads)
+        assert time.time() - start < 5, "Caller waited for a lease that was gone"
+
+    def test_failed_load(self):
+        """
+        [recommendation.decorators.Cached] Test a load that fails drops its lease and flight
+        """
+        loads = []
+        failing_value = self.slow_function(loads, sleep=0, error=True)
+        try:
+            failing_value(5)
+        except ValueError:
+            pass
+        else:
+            assert False, "Error of the load was not raised"
+        assert failing_value.cache.get("lease_%s" % failing_value.key(5)) is None, "Lease was kept after the error"
+        try:
+            failing_value(5)
+        except ValueError:
+            pass
+        assert loads == [5, 5], "Value was not loaded again after the error"
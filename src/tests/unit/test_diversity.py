@@ -4,13 +4,14 @@ This test package test the diversity
 """
 __author__ = "joaonrb"
 
+import numpy as np
 from random import shuffle
 from django.test import TestCase
 from django.utils import timezone as dt
 from django.core.cache import get_cache
-from recommendation.models import Item, User, Inventory
+from recommendation.models import Item, User, Inventory, Generation
 from recommendation.diversity.models import Genre, ItemGenre
-from recommendation.diversity.rerankers import SimpleDiversityReRanker
+from recommendation.diversity.rerankers import SimpleDiversityReRanker, SimpleDiversity, MMRReRanker, mmr
 
 GENRES = [
     {"id": 1, "name": "games"},
@@ -116,4 +117,112 @@ class TestLanguageFilter(TestCase):
                 result = diversity(user=user, recommendation=recommendation[:], size=5)
 
             new_rec = [aid+1 for aid, _ in sorted(enumerate(result), key=lambda x: x[1], reverse=True)]
-            assert len(set(result)) == len(ITEMS), "Recommendation size changed (%d != %s)" % (len(new_rec), len(ITEMS))
\ No newline at end of file
+            assert len(set(result)) == len(ITEMS), "Recommendation size changed (%d != %s)" % (len(new_rec), len(ITEMS))
+
+    def test_genre_matrix(self):
+        """
+        [recommendation.diversity.models.ItemGenre] Test the genre matrix has the genres of each item
+        """
+        matrix = ItemGenre.get_genre_matrix()
+        for i in ITEMS:
+            item = Item.get_item_by_external_id(i["external_id"])
+            _, genres = ItemGenre.genres_of(matrix, np.array([item.pk-1]))
+            assert sorted(genres.tolist()) == sorted(ItemGenre.get_genre_by_item(item.pk)), \
+                "Genres of item %s in the matrix are %s" % (item, genres.tolist())
+        counts = Genre.get_genre_counts()
+        for genre in Genre.objects.all():
+            assert counts[genre.pk] == ItemGenre.objects.filter(type=genre).count(), \
+                "Count of genre %s is %d" % (genre, counts[genre.pk])
+
+    def test_diversity_quota(self):
+        """
+        [recommendation.diversity.rerankers.SimpleDiversity] Test the quota of each genre of the user
+        """
+        recommendation = np.array([Item.get_item_by_external_id(i["external_id"]).pk for i in ITEMS])
+        genre_ids = {genre.name: genre.pk for genre in Genre.objects.all()}
+        for u in USERS:
+            user = User.get_user_by_external_id(u["external_id"])
+            diversity = SimpleDiversity(recommendation, 5, user, .8, 1.)
+            for name, genre_id in genre_ids.items():
+                p_global = sum(name in i["genres"] for i in ITEMS) / float(len(ITEMS))
+                owned = [i for i in ITEMS if i["external_id"] in u["items"]]
+                p_local = sum(name in i["genres"] for i in owned) / float(len(owned)) if owned else 0.
+                expected = int((.8 * p_local + (1. - .8) * p_global) * 5)
+                assert diversity.counter[genre_id] == expected, "Quota of %s for user %s is %d and not %d" % \
+                    (name, user, diversity.counter[genre_id], expected)
+
+
+class TestMMR(TestCase):
+    """
+    Test the maximal marginal relevance selection
+
+    Must test:
+        - The selection is the greedy choice of the relevance discounted by the most similar item taken
+        - With lambda 1 the items are taken by relevance
+        - Similar items are taken after the different ones
+        - The re-ranker without factors keeps the recommendation
+    """
+
+    @classmethod
+    def setup_class(cls, *args, **kwargs):
+        random = np.random.RandomState(0)
+        cls.relevance = random.rand(30)
+        cls.factors = random.randn(30, 4)
+        Generation.objects.all().delete()  # No models for the re-ranker
+        get_cache("default").clear()
+
+    @classmethod
+    def teardown_class(cls, *args, **kwargs):
+        get_cache("default").clear()
+
+    @staticmethod
+    def greedy(relevance, factors, size, lambda_constant):
+        """
+        Maximal marginal relevance computed item by item
+        """
+        relevance = lambda_constant * (relevance - relevance.min()) / (relevance.max() - relevance.min())
+        taken = []
+        for _ in range(size):
+            best, best_value = None, None
+            for i in range(len(relevance)):
+                if i in taken:
+                    continue
+                similarity = max([np.dot(factors[i], factors[j]) / np.linalg.norm(factors[i]) /
+                                  np.linalg.norm(factors[j]) for j in taken] or [-1.])
+                value = relevance[i] - (1. - lambda_constant) * similarity
+                if best_value is None or value > best_value:
+                    best, best_value = i, value
+            taken.append(best)
+        return taken
+
+    def test_greedy_selection(self):
+        """
+        [recommendation.diversity.rerankers.mmr] Test the selection is the greedy maximal marginal relevance
+        """
+        for lambda_constant in (.3, .5, .7):
+            result = mmr(self.relevance, self.factors, 10, lambda_constant).tolist()
+            expected = self.greedy(self.relevance, self.factors, 10, lambda_constant)
+            assert result == expected, "Selection with lambda %s is %s and not %s" % (lambda_constant, result, expected)
+
+    def test_relevance_only(self):
+        """
+        [recommendation.diversity.rerankers.mmr] Test with lambda 1 the items are taken by relevance
+        """
+        result = mmr(self.relevance, self.factors, 10, 1.).tolist()
+        assert result == np.argsort(-self.relevance)[:10].tolist(), "Items were not taken by relevance"
+
+    def test_similar_items(self):
+        """
+        [recommendation.diversity.rerankers.mmr] Test the similar items are taken after the different ones
+        """
+        factors = np.array([[1., 0., 0.], [.99, .1, 0.], [.98, 0., .1], [0., 1., 0.], [0., 0., 1.]])
+        relevance = np.array([1., .95, .9, .6, .5])
+        result = mmr(relevance, factors, 3, .5).tolist()
+        assert result == [0, 3, 4], "Similar items were taken first (%s)" % result
+
+    def test_reranker_without_model(self):
+        """
+        [recommendation.diversity.rerankers.MMRReRanker] Test the re-ranker without factors keeps the recommendation
+        """
+        recommendation = [3, 1, 2]
+        assert MMRReRanker()(None, recommendation[:], 2) == recommendation, "Recommendation changed without factors"
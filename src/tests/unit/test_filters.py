@@ -0,0 +1,107 @@
+#! -*- encoding: utf-8 -*-
+"""
+This test package test the pipeline of the exclusion filters.
+"""
+__author__ = "joaonrb"
+
+import numpy as np
+from django.test import TestCase
+from recommendation.filters import ExclusionFilter, apply_filters, EXCLUDED_SCORE
+
+
+class IndexFilter(ExclusionFilter):
+    """
+    Exclusion filter that gives the indexes of the items of each user
+    """
+
+    def __init__(self, items, score=EXCLUDED_SCORE):
+        self.items, self.score = items, score
+
+    def exclude(self, user, n_items, size=None, **kwargs):
+        return np.array(self.items[user], dtype=np.int64)
+
+
+class MaskFilter(IndexFilter):
+    """
+    Exclusion filter that gives a boolean mask of the items of each user
+    """
+
+    def exclude(self, user, n_items, size=None, **kwargs):
+        mask = np.zeros(n_items, dtype=np.bool_)
+        mask[self.items[user]] = True
+        return mask
+
+
+class LoopFilter(object):
+    """
+    Filter of the old protocol that writes the score of each item in a loop
+    """
+
+    def __init__(self, items, score=EXCLUDED_SCORE):
+        self.items, self.score = items, score
+
+    def __call__(self, user, recommendation, size=None, **kwargs):
+        for item in self.items[user]:
+            recommendation[item] = self.score
+        return recommendation
+
+
+class TestExclusionFilters(TestCase):
+    """
+    Test the exclusion filters give the same scores as the filters that write each item
+
+    Must test:
+        - The joined exclusions give the scores of the filters running one by one
+        - The filters of the old protocol still run in the pipeline
+        - An item excluded with different scores gets the lowest
+    """
+
+    @classmethod
+    def setup_class(cls, *args, **kwargs):
+        random = np.random.RandomState(0)
+        cls.n_items = 50
+        cls.users = range(10)
+        cls.items = [{user: random.choice(cls.n_items, random.randint(0, 10), replace=False) for user in cls.users}
+                     for _ in range(3)]
+        cls.scores = random.rand(len(cls.users), cls.n_items)
+
+    @classmethod
+    def teardown_class(cls, *args, **kwargs):
+        pass
+
+    def baseline(self, user, filters):
+        recommendation = self.scores[user].copy()
+        for f in filters:
+            recommendation = f(user, recommendation)
+        return recommendation
+
+    def test_same_scores(self):
+        """
+        [recommendation.filters.apply_filters] Test the exclusion filters give the scores of the loop filters
+        """
+        loops = [LoopFilter(self.items[0]), LoopFilter(self.items[1]), LoopFilter(self.items[2], -np.inf)]
+        filters = [IndexFilter(self.items[0]), MaskFilter(self.items[1]), IndexFilter(self.items[2], -np.inf)]
+        for user in self.users:
+            result = apply_filters(user, self.scores[user].copy(), filters)
+            assert np.array_equal(result, self.baseline(user, loops)), "Scores of user %d are not the same" % user
+
+    def test_old_protocol(self):
+        """
+        [recommendation.filters.apply_filters] Test the filters of the old protocol run between exclusion filters
+        """
+        loops = [LoopFilter(self.items[0]), LoopFilter(self.items[1]), LoopFilter(self.items[2])]
+        filters = [IndexFilter(self.items[0]), LoopFilter(self.items[1]), MaskFilter(self.items[2])]
+        for user in self.users:
+            result = apply_filters(user, self.scores[user].copy(), filters)
+            assert np.array_equal(result, self.baseline(user, loops)), "Scores of user %d are not the same" % user
+
+    def test_lowest_score(self):
+        """
+        [recommendation.filters.apply_filters] Test an item excluded with different scores gets the lowest
+        """
+        items = {user: np.arange(self.n_items) for user in self.users}
+        lowest, excluded = IndexFilter(items, -np.inf), MaskFilter(items)
+        for filters in ([lowest, excluded], [excluded, lowest]):
+            for user in self.users:
+                result = apply_filters(user, self.scores[user].copy(), filters)
+                assert np.all(result == -np.inf), "Items of user %d don't have the lowest score" % user
@@ -4,12 +4,15 @@ This test package test the core methods and controller.
 """
 __author__ = "joaonrb"
 
+import time
 import unittest as ut
 from django.test import TestCase
 from django.utils import timezone as dt
 from django.core.cache import get_cache
-from recommendation.models import Item, User, Inventory, Matrix, TensorCoFi, Popularity
+from django.core.management import call_command
+from recommendation.models import Item, User, Inventory, Matrix, TensorCoFi, Popularity, InventoryChange
 from recommendation.core import IController, get_controller, RECOMMENDATION_SETTINGS, ControllerNotDefined
+from recommendation.language.models import Region, UserRegion
 
 
 class TestGetController(TestCase):
@@ -39,6 +42,16 @@ class TestGetController(TestCase):
         except ControllerNotDefined:
             pass
 
+    @ut.skipIf("default" not in RECOMMENDATION_SETTINGS, "Default recommendation is not defined")
+    def test_contingency_without_models(self):
+        """
+        [recommendation.core.TensorCoFiController] Test the contingency loads without any model in database
+        """
+        get_cache("default").clear()
+        rec = get_controller()
+        rec.load_contingency()
+        assert len(rec.get_contingency_recommendation("someone", 5)) == 5, "No contingency recommendation"
+
 
 ITEMS = [
     {"id": 1, "name": "facemagazine", "external_id": "10001"},
@@ -88,6 +101,7 @@ class TestTensorCoFiController(TestCase):
         """
         Item.objects.all().delete()
         User.objects.all().delete()
+        Region.objects.all().delete()
         Matrix.objects.all().delete()
         get_cache("default").clear()
 
@@ -101,6 +115,54 @@ class TestTensorCoFiController(TestCase):
             recommendation = rec_controller.get_recommendation(user=User.get_user_by_external_id(u["external_id"]), n=5)
             assert len(recommendation) == 5, "Size of recommendation is not right"
 
+    @ut.skipIf("default" not in RECOMMENDATION_SETTINGS, "Default recommendation is not defined")
+    def test_check_batch_recommendation(self):
+        """
+        [recommendation.core.TensorCoFiController] Test get recommendation for many users at once
+        """
+        rec_controller = get_controller()
+        users = [User.get_user_by_external_id(u["external_id"]) for u in USERS]
+        recommendations = rec_controller.get_recommendations(users, n=4)
+        assert len(recommendations) == len(users), "Number of recommendations is not the number of users"
+        for user, recommendation in zip(users, recommendations):
+            assert len(recommendation) == 4, "Size of recommendation is not right for user %s" % user
+            assert list(recommendation) == list(rec_controller.get_recommendation(user=user, n=4)), \
+                "Batch recommendation is not the recommendation of user %s" % user
+
+    @ut.skipIf("default" not in RECOMMENDATION_SETTINGS, "Default recommendation is not defined")
+    def test_check_precomputed_recommendation(self):
+        """
+        [recommendation.core.TensorCoFiController] Test get recommendation from the precomputed candidates
+        """
+        call_command("precompute", processes=1, size=len(ITEMS))
+        rec_controller = get_controller()
+        for u in USERS:
+            user = User.get_user_by_external_id(u["external_id"])
+            assert rec_controller.get_precomputed_recommendation(user) is not None, "User %s has no candidates" % user
+            recommendation = rec_controller.get_recommendation(user=user, n=5)
+            assert len(recommendation) == 5, "Size of recommendation is not right"
+        user = User.get_user_by_external_id(USERS[0]["external_id"])
+        Inventory.objects.create(user=user, item=Item.get_item_by_external_id("10002"))
+        assert rec_controller.get_precomputed_recommendation(user) is None, \
+            "Candidates of user %s were not removed when the inventory changed" % user
+        user = User.get_user_by_external_id(USERS[1]["external_id"])
+        UserRegion.objects.create(user=user, region=Region.objects.create(name="Precomputed", slug="precomputed"))
+        assert rec_controller.get_precomputed_recommendation(user) is None, \
+            "Candidates of user %s were not removed when the regions changed" % user
+
+    @ut.skipIf("default" not in RECOMMENDATION_SETTINGS, "Default recommendation is not defined")
+    def test_inventory_changes_taken(self):
+        """
+        [recommendation.models.InventoryChange] Test the changes leave the queue when folded in and precomputed
+        """
+        user = User.get_user_by_external_id(USERS[2]["external_id"])
+        Inventory.objects.create(user=user, item=Item.get_item_by_external_id("10001"))
+        time.sleep(1)  # The change is older than the fold in
+        TensorCoFi.fold_in_from_db()
+        assert InventoryChange.objects.filter(user=user).exists(), "Change left the queue before the precomputation"
+        call_command("precompute", processes=1, size=len(ITEMS), incremental=True)
+        assert not InventoryChange.objects.filter(user=user).exists(), "Change was not removed with the candidates"
+
     #@ut.skipIf("default" not in RECOMMENDATION_SETTINGS, "Default recommendation is not defined")
     #def test_check_alternative_recommendation(self):
     #    """
@@ -4,11 +4,17 @@ This test package is fully dedicated to models module in recommendation app.
 """
 __author__ = "joaonrb"
 
+import os
 import sys
+import shutil
+import tempfile
 import numpy as np
 from django.core.cache import get_cache
 from django.test import TestCase
-from recommendation.models import Matrix, Item, User, Inventory
+from recommendation import models
+from recommendation.models import Matrix, Item, User, Inventory, NPArrayField, NPBinaryField, Generation, TensorCoFi, \
+    Popularity, ResponseCache, get_inventory_arrays, POPULARITY_PENDING, POPULARITY_KEEP
+from recommendation.als import ALSTensorCoFi
 if sys.version_info >= (3, 0):
     from functools import reduce
 
@@ -91,6 +97,157 @@ class TestNPArrayField(TestCase):
                                                                       self.array_samples[i][coor])
 
 
+class TestNPBinaryField(TestCase):
+    """
+    Test suite for the binary storage of the matrices
+
+    Must test:
+        - Compressed arrays integrity
+        - Old base64 values are still readable
+        - Data type is kept
+    """
+
+    @classmethod
+    def teardown_class(cls, *args, **kwargs):
+        """
+        Take elements from db
+        """
+        Matrix.objects.all().delete()
+        get_cache("default").clear()
+
+    def test_compressed_array(self):
+        """
+        [recommendation.models.NPBinaryField] Test compressed numpy array integrity
+        """
+        field = NPBinaryField(compress_level=9)
+        array = np.random.random((100, 20)).astype(np.float32)
+        result = field.to_python(field.get_prep_value(array))
+        assert result.shape == array.shape, "Shape of the array changed (%s != %s)" % (result.shape, array.shape)
+        assert np.all(result == array), "Compressed array is not equal to the original"
+
+    def test_old_format(self):
+        """
+        [recommendation.models.NPBinaryField] Test read of the base64 format from NPArrayField
+        """
+        array = np.random.random((10, 5)).astype(np.float32)
+        result = NPBinaryField().to_python(NPArrayField().get_prep_value(array))
+        assert np.all(result == array), "Array in old format is not equal to the original"
+
+    def test_data_type(self):
+        """
+        [recommendation.models.NPBinaryField] Test data type of the array in database
+        """
+        array = np.arange(100, dtype=np.int32)
+        Matrix.objects.create(name="int32", numpy=array)
+        db_array = Matrix.objects.get(name="int32")
+        assert db_array.numpy.dtype == np.int32, "Data type changed (%s != int32)" % db_array.numpy.dtype
+        assert np.all(db_array.numpy == array), "Array from database is not equal to the original"
+
+
+class TestGeneration(TestCase):
+    """
+    Test suite for the publication of model generations
+
+    Must test:
+        - New generation is current in the publishing worker
+        - Roles not published are carried from the last generation
+    """
+
+    @classmethod
+    def teardown_class(cls, *args, **kwargs):
+        """
+        Take elements from db
+        """
+        Generation.objects.all().delete()
+        Matrix.objects.all().delete()
+        get_cache("default").clear()
+
+    def test_publish(self):
+        """
+        [recommendation.models.Generation] Test publish generations with partial models
+        """
+        users = Matrix.objects.create(name="tensorcofi", model_id=0, numpy=np.zeros((5, 2), dtype=np.float32))
+        items = Matrix.objects.create(name="tensorcofi", model_id=1, numpy=np.zeros((5, 2), dtype=np.float32))
+        first = Generation.publish(users=users, items=items)
+        assert Generation.get_current().pk == first.pk, "Published generation is not the current one"
+        assert first.popularity_id is None, "Popularity in generation without popularity"
+
+        popularity = Matrix.objects.create(name="popularity", numpy=np.zeros((5,), dtype=np.float32))
+        second = Generation.publish(popularity=popularity)
+        with self.assertNumQueries(0):
+            current = Generation.get_current()
+        assert current.pk == second.pk, "Second generation is not the current one"
+        assert (current.users_id, current.items_id) == (users.pk, items.pk), \
+            "TensorCoFi factors were not carried to the new generation"
+        assert current.popularity_id == popularity.pk, "Popularity is not in the new generation"
+
+
+class TestSharedMatrix(TestCase):
+    """
+    Test suite for the matrices shared by the workers in memory maps
+
+    Must test:
+        - Matrix is written to the shared directory and read as a read only memory map
+        - Files of the older matrices with the same name and model are removed
+        - File is removed when the matrix is deleted
+    """
+
+    @classmethod
+    def setup_class(cls, *args, **kwargs):
+        cls.shared_dir = models.SHARED_MATRIX_DIR
+        cls.folder = tempfile.mkdtemp()
+        models.SHARED_MATRIX_DIR = os.path.join(cls.folder, "matrices")
+        Matrix.shared_arrays.clear()
+
+    @classmethod
+    def teardown_class(cls, *args, **kwargs):
+        """
+        Take elements from db
+        """
+        Matrix.objects.all().delete()
+        Matrix.shared_arrays.clear()
+        models.SHARED_MATRIX_DIR = cls.shared_dir
+        shutil.rmtree(cls.folder)
+
+    def test_memory_map(self):
+        """
+        [recommendation.models.Matrix] Test the shared matrix is read as a memory map of the file
+        """
+        array = np.random.random((10, 4)).astype(np.float32)
+        matrix = Matrix.objects.create(name="shared", model_id=0, numpy=array)
+        shared = Matrix.get_array(matrix.pk)
+        assert isinstance(shared, np.memmap), "Shared matrix is not a memory map (%s)" % type(shared)
+        assert os.path.exists(Matrix.get_shared_path(matrix.pk)), "Matrix was not written to the shared directory"
+        assert np.all(shared == array) and shared.dtype == np.float32, "Shared matrix is not equal to the original"
+        assert not shared.flags.writeable, "Shared matrix is writable"
+        assert Matrix.get_array(matrix.pk) is shared, "Shared matrix was mapped again"
+
+    def test_older_removed(self):
+        """
+        [recommendation.models.Matrix] Test the files of the older matrices are removed when a new one is shared
+        """
+        old = Matrix.objects.create(name="replaced", model_id=1, numpy=np.zeros((5, 2), dtype=np.float32))
+        other = Matrix.objects.create(name="replaced", model_id=0, numpy=np.zeros((5, 2), dtype=np.float32))
+        Matrix.get_array(old.pk)
+        Matrix.get_array(other.pk)
+        new = Matrix.objects.create(name="replaced", model_id=1, numpy=np.ones((5, 2), dtype=np.float32))
+        assert np.all(Matrix.get_array(new.pk) == 1), "New matrix is not the one shared"
+        assert not os.path.exists(Matrix.get_shared_path(old.pk)), "File of the older matrix was not removed"
+        assert old.pk not in Matrix.shared_arrays, "Older matrix is still mapped"
+        assert os.path.exists(Matrix.get_shared_path(other.pk)), "File of a matrix of other model was removed"
+
+    def test_delete(self):
+        """
+        [recommendation.models.Matrix] Test the file is removed when the matrix is deleted
+        """
+        matrix = Matrix.objects.create(name="deleted", numpy=np.zeros((5,), dtype=np.float32))
+        path = Matrix.get_shared_path(matrix.pk)
+        Matrix.get_array(matrix.pk)
+        assert os.path.exists(path), "Matrix was not written to the shared directory"
+        matrix.delete()
+        assert not os.path.exists(path), "File was not removed with the matrix"
+
+
 ITEMS = [
     {"id": 1, "name": "facemagazine", "external_id": "10001"},
     {"id": 2, "name": "twister", "external_id": "10002"},
@@ -146,6 +303,18 @@ class TestItems(TestCase):
                 assert isinstance(item, Item), "Cached item is not instance of Item."
                 assert item.name == app["name"], "Name of the app is not correct"
 
+    def test_get_many_external_ids(self):
+        """
+        [recommendation.models.Item] Test the external ids of many items are read from cache and the missing loaded
+        """
+        item_ids = [app["id"] for app in ITEMS]
+        get_cache("default").delete(Item.get_item_external_id_by_id.key(item_ids[0]))
+        with self.assertNumQueries(1):
+            external_ids = Item.get_item_external_id_by_id.get_many(item_ids)
+        assert external_ids == [app["external_id"] for app in ITEMS], "External ids are %s" % external_ids
+        with self.assertNumQueries(0):
+            Item.get_item_external_id_by_id.get_many(item_ids)
+
 
 class TestUser(TestCase):
     """
@@ -214,3 +383,214 @@ class TestUser(TestCase):
                 ivent = Inventory.objects.get(item=user.all_items[Item.get_item_by_external_id(i).pk], user=user)
                 ivent.is_dropped = False
                 ivent.save()
+
+    def test_inventory_arrays(self):
+        """
+        [recommendation.models.get_inventory_arrays] Test read of the inventory in chunks to arrays
+        """
+        users, items = get_inventory_arrays(chunk=2)
+        assert users.dtype == items.dtype == np.int32, "Arrays are not int32 (%s, %s)" % (users.dtype, items.dtype)
+        expected = sorted(Inventory.objects.all().values_list("user_id", "item_id"))
+        assert sorted(zip(users.tolist(), items.tolist())) == expected, "Inventory arrays don't match the database"
+
+
+class TestFoldIn(TestCase):
+    """
+    Test the fold in of users to the TensorCoFi model
+
+    Must test:
+        - New users get factors without a training
+        - A training drops the users delta
+        - Training with ALS
+        - Training with ALS uses the parameters of the model
+    """
+
+    @classmethod
+    def setup_class(cls, *args, **kwargs):
+        """
+        Put elements in db
+        """
+        for app in ITEMS:
+            Item.objects.create(**app)
+        for u in USERS:
+            user = User.objects.create(external_id=u["external_id"])
+            for i in u["items"]:
+                Inventory.objects.create(user=user, item=Item.get_item_by_external_id(i))
+        TensorCoFi.train_from_db()
+
+    @classmethod
+    def teardown_class(cls, *args, **kwargs):
+        """
+        Take elements from db
+        """
+        Inventory.objects.all().delete()
+        Item.objects.all().delete()
+        User.objects.all().delete()
+        Generation.objects.all().delete()
+        Matrix.objects.all().delete()
+        get_cache("default").clear()
+
+    def test_als_training(self):
+        """
+        [recommendation.als.ALSTensorCoFi] Test training with ALS publishes the factors
+        """
+        users, items = ALSTensorCoFi.train_from_db()
+        current = Generation.get_current()
+        assert (current.users_id, current.items_id) == (users.pk, items.pk), "ALS factors are not the current ones"
+        assert users.numpy.shape[1] == items.numpy.shape[1], "Users and items have different number of factors"
+        assert np.all(np.isfinite(users.numpy)) and np.all(np.isfinite(items.numpy)), "ALS factors are not finite"
+
+    def test_als_parameters(self):
+        """
+        [recommendation.als.ALSTensorCoFi] Test training with ALS uses the number of factors of the model
+        """
+        users, items = ALSTensorCoFi.train_from_db(n_factors=3, n_iterations=2)
+        assert users.numpy.shape[1] == 3, "Users have %d factors and not 3" % users.numpy.shape[1]
+        assert items.numpy.shape[1] == 3, "Items have %d factors and not 3" % items.numpy.shape[1]
+
+    def test_fold_in_users(self):
+        """
+        [recommendation.models.TensorCoFi] Test fold in of a new user and the next training
+        """
+        user = User.objects.create(external_id="gepeto")
+        for i in ["10001", "10002", "98766"]:
+            Inventory.objects.create(user=user, item=Item.get_item_by_external_id(i))
+        generation = TensorCoFi.fold_in_from_db()
+        assert generation is not None and generation.users_delta_id is not None, "Fold in didn't publish a delta"
+        assert Generation.get_current().pk == generation.pk, "Fold in generation is not the current one"
+        assert len(TensorCoFi.user_matrix[user.pk-1]) == TensorCoFi.get_item_matrix().shape[1], \
+            "New user doesn't have factors"
+        scores, has_factors = TensorCoFi.get_model_from_cache().get_recommendations([user])
+        assert has_factors[0], "New user was not scored with his factors"
+        TensorCoFi.train_from_db()
+        assert Generation.get_current().users_delta_id is None, "Users delta was kept after the training"
+
+
+class TestPopularity(TestCase):
+    """
+    Test the live popularity
+
+    Must test:
+        - New acquisitions are flushed to a new popularity generation
+        - Counts pushed by other processes are flushed with them
+    """
+
+    @classmethod
+    def setup_class(cls, *args, **kwargs):
+        """
+        Put elements in db
+        """
+        for app in ITEMS:
+            Item.objects.create(**app)
+        for u in USERS:
+            user = User.objects.create(external_id=u["external_id"])
+            for i in u["items"]:
+                Inventory.objects.create(user=user, item=Item.get_item_by_external_id(i))
+        Popularity.train()
+        Popularity.counter.take()
+
+    @classmethod
+    def teardown_class(cls, *args, **kwargs):
+        """
+        Take elements from db
+        """
+        Inventory.objects.all().delete()
+        Item.objects.all().delete()
+        User.objects.all().delete()
+        Generation.objects.all().delete()
+        Matrix.objects.all().delete()
+        get_cache("default").clear()
+
+    def test_flush_counter(self):
+        """
+        [recommendation.models.Popularity] Test new acquisitions are added to the popularity by the flush
+        """
+        item = Item.get_item_by_external_id("10001")
+        before = Popularity.get_model().recommendation[item.pk-1]
+        user = User.objects.create(external_id="popular")
+        Inventory.objects.create(user=user, item=item)
+        generation = Popularity.flush_counter()
+        assert generation is not None and Generation.get_current().pk == generation.pk, "Flush didn't publish"
+        after = Popularity.get_model().recommendation[item.pk-1]
+        assert after == before + 1, "Popularity of the item is %s and not %s" % (after, before + 1)
+        assert Popularity.flush_counter() is None, "Flush without new counts published a generation"
+
+    def test_push_counter(self):
+        """
+        [recommendation.models.Popularity] Test the pushed counts wait in database for the next flush
+        """
+        item = Item.get_item_by_external_id("10001")
+        before = Popularity.get_model().recommendation[item.pk-1]
+        current = Generation.get_current().pk
+        Popularity.counter.add([item.pk, item.pk])
+        assert Popularity.push_counter(), "Counts were not pushed"
+        assert Generation.get_current().pk == current, "Push published a generation"
+        assert Matrix.objects.filter(name=POPULARITY_PENDING).exists(), "Pushed counts are not in database"
+        Popularity.flush_counter()
+        after = Popularity.get_model().recommendation[item.pk-1]
+        assert after == before + 2, "Popularity of the item is %s and not %s" % (after, before + 2)
+        assert not Matrix.objects.filter(name=POPULARITY_PENDING).exists(), "Pushed counts were flushed twice"
+
+    def test_flush_keeps_generations(self):
+        """
+        [recommendation.models.Popularity] Test the flush doesn't remove generations or recent popularity matrices
+        """
+        item = Item.get_item_by_external_id("10001")
+        generations = Generation.objects.count()
+        for _ in range(POPULARITY_KEEP + 2):
+            Popularity.counter.add(item.pk)
+            Popularity.flush_counter()
+        assert Generation.objects.count() == generations + POPULARITY_KEEP + 2, "Flush removed generations"
+        recent = Generation.objects.order_by("-id").values_list("popularity_id", flat=True)[:POPULARITY_KEEP + 2]
+        assert None not in recent, "Popularity of a generation published in the refresh interval was removed"
+
+
+class TestResponseCache(TestCase):
+    """
+    Test the cache of the recommendations
+
+    Must test:
+        - Recommendations are cached by engine, size and generation
+        - Changes in the inventory drop the recommendations of the user
+    """
+
+    @classmethod
+    def setup_class(cls, *args, **kwargs):
+        """
+        Put elements in db
+        """
+        for app in ITEMS:
+            Item.objects.create(**app)
+        for u in USERS:
+            User.objects.create(external_id=u["external_id"])
+
+    @classmethod
+    def teardown_class(cls, *args, **kwargs):
+        """
+        Take elements from db
+        """
+        Inventory.objects.all().delete()
+        Item.objects.all().delete()
+        User.objects.all().delete()
+        get_cache("default").clear()
+
+    def test_get_and_put(self):
+        """
+        [recommendation.models.ResponseCache] Test the recommendations are cached by engine, size and factors
+        """
+        ResponseCache.put([1, 2], "default", 1, 2, (1, None, 2), timeout=60)
+        ResponseCache.put([3, 4, 5], "default", 1, 3, (1, None, 2), timeout=60)
+        assert ResponseCache.get("default", 1, 2, (1, None, 2)) == [1, 2], "Recommendation of size 2 not cached"
+        assert ResponseCache.get("default", 1, 3, (1, None, 2)) == [3, 4, 5], "Recommendation of size 3 not cached"
+        assert ResponseCache.get("other", 1, 2, (1, None, 2)) is None, "Recommendation of other engine is cached"
+        ResponseCache.put([6, 7], "default", 1, 2, (1, 3, 2), timeout=60)
+        assert ResponseCache.get("default", 1, 3, (1, None, 2)) is None, "Recommendation of old factors is still cached"
+
+    def test_inventory_drop(self):
+        """
+        [recommendation.models.ResponseCache] Test a new item in the inventory drops the recommendations of the user
+        """
+        user = User.get_user_by_external_id(USERS[0]["external_id"])
+        ResponseCache.put([1, 2], "default", user.pk, 2, 1, timeout=60)
+        Inventory.objects.create(user=user, item=Item.get_item_by_external_id(ITEMS[0]["external_id"]))
+        assert ResponseCache.get("default", user.pk, 2, 1) is None, "Recommendation still cached"
@@ -6,10 +6,12 @@ __author__ = "joaonrb"
 
 import numpy as np
 import random
+import itertools
 from django.test import TestCase
 from django.core.cache import get_cache
-from recommendation.models import Item, User, Inventory
-from recommendation.language.models import Locale, ItemLocale, UserLocale, Region, ItemRegion, UserRegion
+from recommendation.models import Item, User, Inventory, InventoryChange
+from recommendation.language.models import Locale, ItemLocale, UserLocale, Region, ItemRegion, UserRegion, \
+    drop_user_languages
 from recommendation.language.filters import SimpleLocaleFilter, SimpleRegionFilter
 
 LANGUAGES = [
@@ -158,6 +160,31 @@ class TestLanguageFilter(TestCase):
             new_rec = [aid+1 for aid, _ in sorted(enumerate(result), key=lambda x: x[1], reverse=True)]
             assert len(new_rec) == len(ITEMS), "Recommendation size changed (%d != %s)" % (len(new_rec), len(ITEMS))
 
+    def test_locale_combinations(self):
+        """
+        [recommendation.language.models.Locale] Test the items out of each combination of locales
+        """
+        locales = {locale.country_code: locale.pk for locale in Locale.objects.all()}
+        no_locale = Item.objects.create(id=len(ITEMS)+1, name="nolocale", external_id="10006")
+        languages = [app["languages"] for app in ITEMS] + [[]]
+        keys = [Locale.locales_key([locales[code] for code in combination])
+                for n in range(len(LANGUAGES) + 1) for combination in itertools.combinations(sorted(locales), n)]
+        dec = Locale.get_items_out_of_locales
+        dec.cache.delete_many([Locale.get_locale_index.key()] + [dec.key(key) for key in keys])
+        try:
+            for n in range(len(LANGUAGES) + 1):
+                for combination in itertools.combinations(sorted(locales), n):
+                    out = np.unpackbits(Locale.get_items_out_of_locales(Locale.locales_key(
+                        [locales[code] for code in combination]))).view(np.bool_)[:len(languages)]
+                    expected = [bool(item_languages) and not set(item_languages) & set(combination)
+                                for item_languages in languages]
+                    assert out.tolist() == expected, "Items out of locales %s are %s and not %s" % \
+                        (combination, out.tolist(), expected)
+        finally:
+            no_locale.delete()
+            dec.cache.delete_many([Locale.get_locale_index.key()] + [dec.key(key) for key in keys])
+            Locale.load_to_cache()
+
 
 class TestRegionFilter(TestCase):
     """
@@ -207,6 +234,22 @@ class TestRegionFilter(TestCase):
                 assert reg.region_id in Region.get_user_regions(user.pk), \
                     "Region %s for user %s is not in cache (%s)" % (reg, user, Region.get_user_regions(user.pk))
 
+    def test_users_region_bulk_change(self):
+        """
+        [recommendation.language.models.drop_user_languages] Test regions created without signals are seen in cache
+        """
+        user = User.get_user_by_external_id("ana")
+        region = Region.objects.get(slug="lt")
+        assert region.pk not in Region.get_user_regions(user.pk), "User %s is already in region %s" % (user, region)
+        UserRegion.objects.bulk_create([UserRegion(user=user, region=region)])
+        drop_user_languages([user.pk])
+        try:
+            assert region.pk in Region.get_user_regions(user.pk), "Region %s of user %s is not in cache" % (region, user)
+            assert InventoryChange.objects.filter(user=user).exists(), "User %s was not put in the queue" % user
+        finally:
+            UserRegion.objects.filter(user=user, region=region).delete()
+        assert region.pk not in Region.get_user_regions(user.pk), "Removed region %s is still in cache" % region
+
     def test_filter_regions(self):
         """
         [recommendation.filter.Region] Test a region filter on recommendation
@@ -242,4 +285,17 @@ class TestRegionFilter(TestCase):
             with self.assertNumQueries(0):
                 result = rfilter(user, np.array(recommendation[:]))
             new_rec = [aid+1 for aid, _ in sorted(enumerate(result), key=lambda x: x[1], reverse=True)]
-            assert len(new_rec) == len(ITEMS), "Recommendation size changed (%d != %s)" % (len(new_rec), len(ITEMS))
\ No newline at end of file
+            assert len(new_rec) == len(ITEMS), "Recommendation size changed (%d != %s)" % (len(new_rec), len(ITEMS))
+
+    def test_region_combinations(self):
+        """
+        [recommendation.language.models.Region] Test the items out of each combination of regions
+        """
+        regions = {region.slug: region.pk for region in Region.objects.all()}
+        for n in range(1, len(REGIONS) + 1):
+            for combination in itertools.combinations(sorted(regions), n):
+                out = np.unpackbits(Region.get_items_out_of_regions(
+                    Region.regions_key([regions[slug] for slug in combination]))).view(np.bool_)[:len(ITEMS)]
+                expected = [not set(app["regions"]) & set(combination) for app in ITEMS]
+                assert out.tolist() == expected, "Items out of regions %s are %s and not %s" % \
+                    (combination, out.tolist(), expected)
@@ -0,0 +1,206 @@
+#! -*- encoding: utf-8 -*-
+"""
+This test package test the metrics of the recommendation.
+"""
+__author__ = "joaonrb"
+
+import json
+import numpy as np
+from django.test import TestCase
+from django.core.cache import get_cache
+from django.core.management import call_command
+from django.utils.six import StringIO
+from health_check.backends.base import ServiceUnavailable
+from recommendation import metrics, decorators, backends
+from recommendation.decorators import Cached
+from recommendation.filters import ExclusionFilter
+from recommendation.backends import CheckCacheHitRatio
+
+
+class NoneFilter(ExclusionFilter):
+    """
+    Exclusion filter that excludes nothing
+    """
+
+    def exclude(self, user, n_items, size=None, **kwargs):
+        return np.zeros((0,), dtype=np.int64)
+
+
+class TestStageMetrics(TestCase):
+    """
+    Test the latency histograms of the stages
+
+    Must test:
+        - The histograms count the latencies in buckets and give the percentiles
+        - The histograms of many workers are joined
+        - The timed stages and plugins record their latency and with METRICS off nothing is wrapped
+        - The metrics command shows the stages
+    """
+
+    @classmethod
+    def setup_class(cls, *args, **kwargs):
+        cls.metrics_on = metrics.METRICS
+        metrics.histograms.clear()
+        metrics.counters.clear()
+        get_cache(metrics.METRICS_CACHE).delete(metrics.WORKERS_KEY)
+
+    @classmethod
+    def teardown_class(cls, *args, **kwargs):
+        metrics.METRICS = cls.metrics_on
+        metrics.histograms.clear()
+        metrics.counters.clear()
+        get_cache(metrics.METRICS_CACHE).delete(metrics.WORKERS_KEY)
+
+    def test_histogram(self):
+        """
+        [recommendation.metrics.Histogram] Test the percentiles and the merge of histograms
+        """
+        histogram, other = metrics.Histogram(), metrics.Histogram()
+        for ms in range(1, 101):
+            (histogram if ms % 2 else other).add(float(ms))
+        histogram.merge(metrics.Histogram.from_dict(other.to_dict()))
+        summary = histogram.summary()
+        assert summary["count"] == 100 and summary["max"] == 100., "Merged histogram has %s" % summary
+        assert summary["mean"] == 50.5, "Mean is %s and not 50.5" % summary["mean"]
+        assert (summary["p50"], summary["p90"], summary["p99"]) == (50., 100., 100.), \
+            "Percentiles are not the bucket limits (%s)" % summary
+
+    def test_workers(self):
+        """
+        [recommendation.metrics.collect] Test the histograms and counters of the workers are joined
+        """
+        metrics.record("test.stage", .001)
+        metrics.count("test.events", 2)
+        metrics.publish()
+        other = metrics.Histogram()
+        other.add(3.)
+        cache = get_cache(metrics.METRICS_CACHE)
+        cache.set("metrics_other_worker", {"histograms": {"test.stage": other.to_dict()},
+                                           "counters": {"test.events": 3}})
+        cache.set(metrics.WORKERS_KEY, cache.get(metrics.WORKERS_KEY) + ["metrics_other_worker", "metrics_gone"])
+        workers, result, totals = metrics.collect()
+        assert workers == 2, "Metrics of %d workers and not 2" % workers
+        assert result["test.stage"].count == 2 and result["test.stage"].max == 3., "Histograms were not joined"
+        assert totals["test.events"] == 5, "Counters were not joined"
+        assert "metrics_gone" not in cache.get(metrics.WORKERS_KEY), "Worker that stopped publishing was kept"
+        cache.delete("metrics_other_worker")
+
+    def test_timed(self):
+        """
+        [recommendation.metrics.timed] Test the timed stages and plugins record their latency
+        """
+        metrics.METRICS = False
+        function = lambda: None
+        assert metrics.timed("test.off")(function) is function, "Function was wrapped with METRICS off"
+        assert metrics.timed_plugin("filter", function) is function, "Plugin was wrapped with METRICS off"
+        metrics.METRICS = True
+        try:
+            metrics.timed("test.timed")(function)()
+            metrics.timed_plugin("reranker", lambda user, recommendation, size: recommendation)(None, [1], 1)
+            exclusion = metrics.timed_plugin("filter", NoneFilter())
+            assert isinstance(exclusion, ExclusionFilter), "Exclusion filter lost its class"
+            exclusion.exclude(None, 3)
+            exclusion.exclude_batch([None], 3)
+        finally:
+            metrics.METRICS = False
+        for stage in ("test.timed", "reranker.function", "filter.NoneFilter", "filter.NoneFilter.batch"):
+            assert stage in metrics.histograms, "Latency of %s was not recorded" % stage
+
+    def test_command(self):
+        """
+        [recommendation.management.commands.metrics] Test the command shows the stages
+        """
+        metrics.record("test.command", .002)
+        out = StringIO()
+        call_command("metrics", stdout=out)
+        assert "test.command" in out.getvalue(), "Stage is not in the output:\n%s" % out.getvalue()
+        out = StringIO()
+        call_command("metrics", json=True, stdout=out)
+        assert json.loads(out.getvalue())["stages"]["test.command"]["count"] >= 1, "Stage is not in the JSON output"
+
+
+class TestCacheMetrics(TestCase):
+    """
+    Test the metrics of the cached functions
+
+    Must test:
+        - The hits and misses of the calls and of get_many are counted, with the bytes loaded in the misses
+        - The cachemetrics command shows the functions
+        - The health check fails when a function hits the cache less than CACHE_MIN_HIT_RATIO
+    """
+
+    @classmethod
+    def setup_class(cls, *args, **kwargs):
+        cls.metrics_on = decorators.METRICS, backends.METRICS, backends.CACHE_MIN_CALLS
+        decorators.METRICS = backends.METRICS = True
+        backends.CACHE_MIN_CALLS = 3
+        metrics.histograms.clear()
+        metrics.counters.clear()
+        get_cache("default").clear()
+        get_cache(metrics.METRICS_CACHE).delete(metrics.WORKERS_KEY)
+
+    @classmethod
+    def teardown_class(cls, *args, **kwargs):
+        decorators.METRICS, backends.METRICS, backends.CACHE_MIN_CALLS = cls.metrics_on
+        metrics.histograms.clear()
+        metrics.counters.clear()
+        get_cache("default").clear()
+        get_cache(metrics.METRICS_CACHE).delete(metrics.WORKERS_KEY)
+
+    def test_hits_and_misses(self):
+        """
+        [recommendation.decorators.Cached] Test the hits and misses of a cached function are counted
+        """
+        @Cached()
+        def counted_value(value):
+            return value * 2
+        counted_value(1)
+        counted_value(1)
+        counted_value(1)
+        counted_value.get_many([1, 2])
+        assert metrics.histograms["cache.counted_value"].count == 2, \
+            "Misses are %d and not 2" % metrics.histograms["cache.counted_value"].count
+        assert metrics.counters["cache.counted_value.hits"] == 3, \
+            "Hits are %d and not 3" % metrics.counters["cache.counted_value.hits"]
+        assert metrics.counters["cache.counted_value.bytes"] > 0, "Bytes loaded in the misses were not counted"
+        function = metrics.cache_report()["counted_value"]
+        assert (function["hits"], function["misses"]) == (3, 2), "Report has %(hits)d hits and %(misses)d misses" % \
+            function
+        assert function["hit_ratio"] == .6, "Hit ratio is %s and not 0.6" % function["hit_ratio"]
+
+    def test_command(self):
+        """
+        [recommendation.management.commands.cachemetrics] Test the command shows the cached functions
+        """
+        @Cached()
+        def shown_value(value):
+            return value
+        for _ in range(3):
+            shown_value(1)
+        out = StringIO()
+        call_command("cachemetrics", stdout=out)
+        assert "shown_value" in out.getvalue(), "Function is not in the output:\n%s" % out.getvalue()
+        out = StringIO()
+        call_command("cachemetrics", json=True, stdout=out)
+        function = json.loads(out.getvalue())["shown_value"]
+        assert (function["hits"], function["misses"]) == (2, 1), "JSON output has %(hits)d hits and %(misses)d " \
+                                                                  "misses" % function
+
+    def test_health_check(self):
+        """
+        [recommendation.backends.CheckCacheHitRatio] Test the health check fails for functions that miss the cache
+        """
+        @Cached()
+        def cold_value(value):
+            return value
+        for i in range(4):
+            cold_value(i)
+        try:
+            CheckCacheHitRatio().check_status()
+        except ServiceUnavailable as e:
+            assert "cold_value" in str(e), "Health check failed for other function: %s" % e
+        else:
+            assert False, "Health check didn't fail with a hit ratio of 0"
+        for i in range(4):
+            cold_value(i)
+        assert CheckCacheHitRatio().check_status(), "Health check failed with a hit ratio of 0.5"
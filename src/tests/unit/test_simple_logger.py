@@ -12,7 +12,7 @@ from django.test import TestCase
 from django.core.cache import get_cache
 from recommendation.models import Item, User, Inventory
 from recommendation.simple_logging.models import LogEntry, LOGGER_MAX_LOGS
-from recommendation.simple_logging.decorators import LogEvent
+from recommendation.simple_logging.decorators import LogEvent, LogWriter
 from recommendation.simple_logging.filters import SimpleLogFilter
 
 
@@ -126,6 +126,48 @@ class TestSimpleLoggerDecorator(TestCase):
             "The item in log is incorrect(1004 != %s)" % logs[0].item.external_id
 
 
+class TestLogWriter(TestCase):
+    """
+    Test suite for the log writer
+
+    Test:
+        - Queued logs are written by the flush
+        - Logs over the queue size are dropped
+    """
+
+    @classmethod
+    def setup_class(cls, *args, **kwargs):
+        """
+        Put elements in db
+        """
+        for app in ITEMS:
+            Item.objects.create(**app)
+        User.objects.create(external_id="joaonrb")
+
+    @classmethod
+    def teardown_class(cls, *args, **kwargs):
+        """
+        Take elements from db
+        """
+        LogEntry.objects.all().delete()
+        Item.objects.all().delete()
+        User.objects.all().delete()
+        get_cache("default").clear()
+
+    def test_bounded_queue(self):
+        """
+        [recommendation.simple_logging.LogWriter] Test the logs are written in the flush and the queue is bounded
+        """
+        writer = LogWriter(interval=60., size=3)
+        user = User.get_user_by_external_id("joaonrb")
+        writer.put([LogEntry(user=user, item_id=i["id"], type=LogEntry.CLICK) for i in ITEMS])
+        assert LogEntry.objects.filter(user=user).count() == 0, "Logs written before the flush"
+        writer.flush()
+        logs = LogEntry.objects.filter(user=user).values_list("item_id", flat=True)
+        assert sorted(logs) == [1, 2, 3], "Logs written are %s and not [1, 2, 3]" % list(logs)
+        assert len(writer.queue) == 0, "Logs left in queue after flush"
+
+
 class TestSimpleLoggerCache(TestCase):
     """
     Test suite for recommendation simple logger cache